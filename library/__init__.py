@@ -1,4 +1,7 @@
 """Initialize FastAPI app."""
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
@@ -6,6 +9,7 @@ from fastapi.security import OAuth2PasswordBearer
 from .config import Settings
 
 from library.database import models
+from library.database import database
 from library.database.database import engine
 
 
@@ -29,10 +33,31 @@ def create_app(config=None, aargs=None, disable_database=False):
         }
 
     ]
+    from library.utilities_api.sweeper import expiry_sweeper
+    from library.utilities_api.executor import inference_executor
+    from library.utilities_api.export_jobs import export_jobs
+    from library.utilities_api.file_exports import shutdown_thumbnail_pool
+    # Image rows are only swept when there is a database
+    expiry_sweeper.sweep_database = not disable_database
+
+    @asynccontextmanager
+    async def lifespan(app):
+        expiry_sweeper.start()
+        yield
+        await expiry_sweeper.stop()
+        # The pools are recreated if the app is started again
+        inference_executor.shutdown()
+        # Running exports (and the thumbnails they wait for) are finished rather than left half written
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, export_jobs.shutdown)
+        await loop.run_in_executor(None, shutdown_thumbnail_pool)
+        if database.async_engine is not None:
+            await database.async_engine.dispose()
+
     if Settings.ENV_TYPE == "development":
-        app = FastAPI(openapi_tags=tags_metadata)
+        app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan)
     else:
-        app = FastAPI(openapi_tags=tags_metadata,
+        app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan,
                       docs_url=None, redoc_url=None)
 
     origins = [
@@ -64,6 +89,7 @@ def create_app(config=None, aargs=None, disable_database=False):
     )
 
     from library.utilities_api import utilities, file_exports
+    from library.utilities_api.inference import model_registry
     from library.admin_api import api as admin_api
     from library.auth_api import api as auth_api
     app.include_router(utilities.utils_api)
@@ -71,6 +97,10 @@ def create_app(config=None, aargs=None, disable_database=False):
     app.include_router(admin_api.admin_api)
     app.include_router(auth_api.auth_api)
 
+    # Load frequently used models up front, the rest are loaded on first use
+    if Settings.PRELOAD_MODELS:
+        model_registry.warm_up(Settings.PRELOAD_MODELS)
+
     # Only deploy react build only if it is a client+server deployment
     if Settings.ENV_TYPE != "server" or Settings.ENV_TYPE == "development":
         from library.home_api import home
@@ -1,9 +1,15 @@
 import io
-from fastapi import APIRouter, HTTPException, status, Depends, Security, status
+import os
+from fastapi import APIRouter, HTTPException, status, Depends, Security, status, Query
 from fastapi.responses import ORJSONResponse, JSONResponse, FileResponse, Response
 
-from library.utilities_api.utilities import clear_cache
-from library.database.database import SessionLocal
+from library.utilities_api.utilities import clear_cache, available_models, inference_cache, start_prewarm, prewarm_jobs
+from library.utilities_api.inference import model_registry, SwapInProgressError
+from library.utilities_api.scheduler import inference_scheduler
+from library.utilities_api.executor import inference_executor
+from library.utilities_api.workers import worker_pool
+from library.utilities_api.storage import blob_store
+from library.utilities_api.sweeper import expiry_sweeper
 from library.auth_api.api import check_if_user_admin, credentials_exception
 from library.config import Settings
 
@@ -20,13 +26,6 @@ models_path = Settings.MODEL_FOLDER
 isProduction = Settings.ENV_TYPE == 'production'
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 ################ API Endpoints ################
 
 
@@ -45,6 +44,53 @@ def clear_inference_cache(is_admin: Annotated[bool, Security(check_if_user_admin
         return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
 
 
+@admin_api.get('/inference_cache_stats', responses={200: {"description": "Success"}})
+def get_inference_cache_stats(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])]):
+    """
+        Returns the inference cache's size and hit, miss and eviction counters
+    """
+    if not is_admin:
+        raise credentials_exception
+    return JSONResponse(content=inference_cache.stats())
+
+
+@admin_api.post('/prewarm_inference_cache', status_code=202, responses={202: {"description": "Accepted (Prewarm started)"}, 400: {"description": "Bad Request"}, 500: {"description": "Internal Server Error"}})
+async def prewarm_inference_cache(
+        is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])],
+        directory: str = Query(..., description="Server directory of images to predict."),
+        model: str = Query(..., description="Model to predict the images with."),
+        top_k: int = Query(Settings.DEFAULT_TOP_K, ge=1, le=Settings.MAX_TOP_K, description="Number of predictions to cache per image.")):
+    """
+        Starts predicting every image in a server directory in the background and storing the results in the inference cache.
+        Returns the job, its progress is reported by /prewarm_inference_cache/{job_id}
+    """
+    if not is_admin:
+        raise credentials_exception
+    if model not in available_models():
+        return ORJSONResponse(content={"error": "Invalid Model"}, status_code=400)
+    if not os.path.isdir(directory):
+        return ORJSONResponse(content={"error": "Directory not found"}, status_code=400)
+    try:
+        job = await start_prewarm(directory, model, top_k)
+        return JSONResponse(content=job, status_code=202)
+    except Exception as e:
+        logging.error(f"Cache prewarm error: {traceback.format_exc()}")
+        return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@admin_api.get('/prewarm_inference_cache/{job_id}', responses={200: {"description": "Success"}, 404: {"description": "Job not found"}})
+def get_prewarm_job(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])], job_id: str):
+    """
+        Returns the progress of a cache prewarm job: the images found, done and predicted
+    """
+    if not is_admin:
+        raise credentials_exception
+    job = prewarm_jobs.get(job_id)
+    if job is None:
+        return ORJSONResponse(content={"error": "Job not found"}, status_code=404)
+    return JSONResponse(content=job)
+
+
 @admin_api.get('/get_log')
 def get_file_logs(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])]):
     """
@@ -66,3 +112,135 @@ def get_file_logs(is_admin: Annotated[bool, Security(check_if_user_admin, scopes
     except Exception as e:
         logging.error(f"LogFile error: {traceback.format_exc()}")
         return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@admin_api.get('/loaded_models', responses={200: {"description": "Success"}, 500: {"description": "Internal Server Error"}})
+def get_loaded_models(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])]):
+    """
+        Returns the models currently resident in memory
+    """
+    if not is_admin:
+        raise credentials_exception
+    return JSONResponse(content=model_registry.loaded_models())
+
+
+@admin_api.post('/load_model', responses={200: {"description": "Success"}, 400: {"description": "Bad Request"}, 500: {"description": "Internal Server Error"}})
+def load_model(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])], model: str = Query(..., description="Model to load.")):
+    """
+        Loads a model into memory, does nothing if it is already loaded
+    """
+    if not is_admin:
+        raise credentials_exception
+    if model not in available_models():
+        return ORJSONResponse(content={"error": "Invalid Model"}, status_code=400)
+    try:
+        model_registry.load(model)
+        return JSONResponse(content={"success": f"{model} loaded"})
+    except Exception as e:
+        logging.error(f"Model load error: {traceback.format_exc()}")
+        return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@admin_api.post('/reload_model', responses={200: {"description": "Success"}, 400: {"description": "Bad Request"}, 500: {"description": "Internal Server Error"}})
+def reload_model(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])], model: str = Query(..., description="Model to reload.")):
+    """
+        Reloads a model from disk, the old copy keeps serving until the new one is loaded
+    """
+    if not is_admin:
+        raise credentials_exception
+    if model not in available_models():
+        return ORJSONResponse(content={"error": "Invalid Model"}, status_code=400)
+    try:
+        model_registry.reload(model)
+        return JSONResponse(content={"success": f"{model} reloaded"})
+    except Exception as e:
+        logging.error(f"Model reload error: {traceback.format_exc()}")
+        return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@admin_api.post('/unload_model', responses={200: {"description": "Success"}, 400: {"description": "Bad Request"}, 500: {"description": "Internal Server Error"}})
+def unload_model(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])], model: str = Query(..., description="Model to unload.")):
+    """
+        Unloads a model from memory, it will be loaded again on its next use
+    """
+    if not is_admin:
+        raise credentials_exception
+    try:
+        if not model_registry.unload(model):
+            return ORJSONResponse(content={"error": "Model not loaded"}, status_code=400)
+        return JSONResponse(content={"success": f"{model} unloaded"})
+    except Exception as e:
+        logging.error(f"Model unload error: {traceback.format_exc()}")
+        return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@admin_api.get('/model_versions', responses={200: {"description": "Success"}, 400: {"description": "Bad Request"}})
+def get_model_versions(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])], model: str = Query(..., description="Model to list the versions of.")):
+    """
+        Returns a model's versions, its active and loaded version and the progress of its last swap
+    """
+    if not is_admin:
+        raise credentials_exception
+    if model not in available_models():
+        return ORJSONResponse(content={"error": "Invalid Model"}, status_code=400)
+    return JSONResponse(content=model_registry.versions(model))
+
+
+@admin_api.post('/swap_model', status_code=202, responses={202: {"description": "Accepted (Swap started)"}, 400: {"description": "Bad Request"}, 409: {"description": "Conflict (Swap in progress)"}})
+def swap_model(
+        is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])],
+        model: str = Query(..., description="Model to swap."),
+        version: str = Query(..., description="Version folder to make active, e.g. v2.")):
+    """
+        Loads and warms up another version of a model in the background, then makes it the active version.
+        Requests keep being served by the old version until the swap, which is unloaded once they are done.
+    """
+    if not is_admin:
+        raise credentials_exception
+    if model not in available_models():
+        return ORJSONResponse(content={"error": "Invalid Model"}, status_code=400)
+    versions = model_registry.versions(model)
+    if version not in versions["versions"]:
+        return ORJSONResponse(content={"error": "Invalid Version"}, status_code=400)
+
+    # Errors are logged and reported through /model_versions
+    try:
+        model_registry.start_swap(model, version)
+    except SwapInProgressError:
+        return ORJSONResponse(content={"error": "Swap in progress"}, status_code=409)
+    return ORJSONResponse(content={"success": f"swapping {model} to {version}"}, status_code=202)
+
+
+@admin_api.get('/inference_stats', responses={200: {"description": "Success"}})
+def get_inference_stats(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])]):
+    """
+        Returns the inference queue's usage, the worker pool's health and the scheduler's queue depth, batch size and wait time statistics per model
+    """
+    if not is_admin:
+        raise credentials_exception
+    return JSONResponse(content={"executor": inference_executor.stats(), "workers": worker_pool.stats(), "models": inference_scheduler.stats()})
+
+
+@admin_api.get('/storage_stats', responses={200: {"description": "Success"}})
+def get_storage_stats(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])]):
+    """
+        Returns the upload store's size and the expiry sweeper's duration and bytes reclaimed
+    """
+    if not is_admin:
+        raise credentials_exception
+    return JSONResponse(content={"uploads": blob_store.stats(), "sweeper": expiry_sweeper.stats()})
+
+
+@admin_api.post('/sweep', responses={200: {"description": "Success"}, 500: {"description": "Internal Server Error"}})
+def sweep_expired(is_admin: Annotated[bool, Security(check_if_user_admin, scopes=["admin"])]):
+    """
+        Deletes expired uploads, image records and exports now, without waiting for the next scheduled sweep
+    """
+    if not is_admin:
+        raise credentials_exception
+    try:
+        reclaimed = expiry_sweeper.sweep()
+        return JSONResponse(content={"success": "swept", "bytes_reclaimed": reclaimed})
+    except Exception as e:
+        logging.error(f"Sweep error: {traceback.format_exc()}")
+        return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
@@ -1,16 +1,19 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Security, Form
+from fastapi import APIRouter, HTTPException, status, Depends, Security, Form, Request
 from fastapi.responses import ORJSONResponse, JSONResponse
 from fastapi.security import OAuth2PasswordRequestForm, SecurityScopes
 from pydantic import BaseModel, ValidationError
-from library.database.database import SessionLocal
-from library.database import crud, models
+from library.database.database import get_db
+from library.database import async_crud as crud, models
+from library.auth_api.cache import auth_cache
+from library.auth_api.principals import decode_token, load_principal
+from library.auth_api.passwords import (password_hasher, login_user_limiter, login_ip_limiter,
+                                        ConcurrencyLimitError, PasswordQueueFullError)
 from library.config import Settings
 
 from datetime import datetime, timedelta, timezone
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 from passlib.context import CryptContext
-from passlib.hash import argon2
 from typing import Annotated
 from jose import JWTError, jwt
 
@@ -34,6 +37,12 @@ credentials_exception = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
 )
 
+login_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Incorrect username or password",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
 
 class Token(BaseModel):
     access_token: str
@@ -45,14 +54,6 @@ class TokenData(BaseModel):
     scopes: list[str] = []
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
     if expires_delta:
@@ -67,8 +68,7 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 async def get_current_user(
         security_scopes: SecurityScopes,
-        token: Annotated[str, Depends(Settings.OAUTH_SCHEME)],
-        db: Annotated[Session, Depends(get_db)]
+        token: Annotated[str, Depends(Settings.OAUTH_SCHEME)]
 ):
 
     if security_scopes.scopes:
@@ -76,8 +76,7 @@ async def get_current_user(
     else:
         authenticate_value = "Bearer"
     try:
-        payload = jwt.decode(token, Settings.AUTH_SECRET_KEY,
-                             algorithms=[Settings.AUTH_ALGORITHM])
+        payload = auth_cache.claims(token, decode_token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -87,7 +86,7 @@ async def get_current_user(
     except JWTError:
         raise credentials_exception
 
-    user = crud.get_users_by_username(db, token_data.username)
+    user = await auth_cache.user(token_data.username, load_principal)
     if user is None:
         raise credentials_exception
     for scope in security_scopes.scopes:
@@ -113,8 +112,7 @@ async def get_current_active_user(current_user: Annotated[models.User, Security(
 
 async def check_if_user_admin(
         security_scopes: SecurityScopes,
-        token: Annotated[str, Depends(Settings.OAUTH_SCHEME)],
-        db: Annotated[Session, Depends(get_db)]
+        token: Annotated[str, Depends(Settings.OAUTH_SCHEME)]
 ):
     if security_scopes.scopes:
         authenticate_value = f'Bearer scope="{security_scopes.scope_str}"'
@@ -122,8 +120,7 @@ async def check_if_user_admin(
     else:
         authenticate_value = "Bearer"
     try:
-        payload = jwt.decode(token, Settings.AUTH_SECRET_KEY,
-                             algorithms=[Settings.AUTH_ALGORITHM])
+        payload = auth_cache.claims(token, decode_token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
@@ -131,7 +128,7 @@ async def check_if_user_admin(
         token_data = TokenData(scopes=token_scopes, username=username)
     except (JWTError, ValidationError):
         raise credentials_exception
-    user = crud.get_users_by_username(db, token_data.username)
+    user = await auth_cache.user(token_data.username, load_principal)
     if user is None:
         raise credentials_exception
     for scope in security_scopes.scopes:
@@ -147,47 +144,73 @@ async def check_if_user_admin(
 ################ Auth ####################
 
 
+def client_ip(request: Request):
+    return request.client.host if request.client else None
+
+
+def too_many_requests(detail):
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers={"Retry-After": str(Settings.LOGIN_RETRY_AFTER)},
+    )
+
+
 @auth_api.post("/create_user")
-def create_user(username: Annotated[str, Form()], email: Annotated[str, Form()], password: Annotated[str, Form()], db: Session = Depends(get_db)):
+async def create_user(request: Request, username: Annotated[str, Form()], email: Annotated[str, Form()], password: Annotated[str, Form()], db: AsyncSession = Depends(get_db)):
     try:
-        if crud.create_user(db, username, email, password) == None:
-            raise IntegrityError
+        with login_ip_limiter.hold(client_ip(request)):
+            if await crud.create_user(db, username, email, password) == None:
+                raise IntegrityError
         logging.info(f"Created user {username}")
         return JSONResponse(content={"success": "user made"})
     except IntegrityError as e:
         return ORJSONResponse(content={"error": "Username already taken"}, status_code=500)
+    except ConcurrencyLimitError:
+        return ORJSONResponse(content={"error": "Too Many Requests"}, status_code=429,
+                              headers={"Retry-After": str(Settings.LOGIN_RETRY_AFTER)})
+    except PasswordQueueFullError:
+        return ORJSONResponse(content={"error": "Server Busy"}, status_code=503,
+                              headers={"Retry-After": str(Settings.LOGIN_RETRY_AFTER)})
     except Exception as e:
         logging.error(f"User creation error: {traceback.format_exc()}")
         return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
 
 
 @auth_api.post("/token")
-async def login(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db)) -> Token:
-    user = crud.get_users_by_username(db, form_data.username)
-    if not user:
+async def login(request: Request, form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_db)) -> Token:
+    try:
+        # A login storm against one account or from one client is turned away before it reaches the hasher
+        with login_ip_limiter.hold(client_ip(request)), login_user_limiter.hold(form_data.username):
+            user = await crud.get_users_by_username(db, form_data.username)
+            if not user:
+                raise login_exception
+            verified = await password_hasher.verify_async(form_data.password, user.password_hash)
+    except ConcurrencyLimitError as e:
+        logging.warning(f"Login limit reached for {e.key}")
+        raise too_many_requests("Too many login attempts")
+    except PasswordQueueFullError:
         raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server Busy",
+            headers={"Retry-After": str(Settings.LOGIN_RETRY_AFTER)},
         )
-    try:
-        if argon2.verify(str(form_data.password), user.password_hash):
-            access_token_expires = timedelta(
-                minutes=Settings.ACCESS_TOKEN_EXPIRE_MINUTES)
-            logging.debug(form_data.scopes)
-            access_token = create_access_token(
-                data={"sub": user.username, "scopes": form_data.scopes},
-                expires_delta=access_token_expires
-            )
-            return Token(access_token=access_token, token_type="bearer")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Login error: {traceback.format_exc()}")
-        logging.error(e)
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        raise login_exception
+
+    if not verified:
+        raise login_exception
+    access_token_expires = timedelta(
+        minutes=Settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    logging.debug(form_data.scopes)
+    access_token = create_access_token(
+        data={"sub": user.username, "scopes": form_data.scopes},
+        expires_delta=access_token_expires
+    )
+    return Token(access_token=access_token, token_type="bearer")
 
 
 @auth_api.get("/users/me")
@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from library.config import Settings
+
+
+class Principal(NamedTuple):
+    """
+        The fields of a user needed to authorize a request, detached from any database session.
+    """
+    id: str
+    username: str
+    email: str | None
+    is_admin: bool
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.email, bool(user.is_admin))
+
+
+class AuthCache:
+    """
+        Short lived cache of verified token claims and the users they name, so protected
+        requests skip decoding the JWT and looking the user up each time.
+        Claims are kept until AUTH_CACHE_TTL passes or the token expires, whichever is first.
+        Users are dropped as soon as crud changes them, other processes see the change
+        within AUTH_CACHE_TTL seconds. A TTL of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=None, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._claims = OrderedDict()
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _ttl(self):
+        return self.ttl if self.ttl is not None else Settings.AUTH_CACHE_TTL
+
+    def _max_entries(self):
+        return self.max_entries or Settings.AUTH_CACHE_MAX_ENTRIES
+
+    def _get(self, entries, key):
+        with self._lock:
+            entry = entries.get(key)
+            if entry is not None and time.time() < entry[1]:
+                entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del entries[key]
+            self.misses += 1
+            return None
+
+    def _put(self, entries, key, value, expires):
+        if expires <= time.time():
+            return
+        with self._lock:
+            entries[key] = (value, expires)
+            entries.move_to_end(key)
+            while len(entries) > self._max_entries():
+                entries.popitem(last=False)
+
+    def claims(self, token, decode):
+        """
+            Returns the claims of a token, calling decode(token) to verify it when they aren't cached.
+        """
+        claims = self._get(self._claims, token)
+        if claims is None:
+            claims = decode(token)
+            expires = time.time() + self._ttl()
+            if claims.get("exp") is not None:
+                expires = min(expires, claims["exp"])
+            self._put(self._claims, token, claims, expires)
+        return claims
+
+    async def user(self, username, load):
+        """
+            Returns the Principal of a user, awaiting load(username) when it isn't cached.
+            Unknown users (None) aren't cached.
+        """
+        principal = self._get(self._users, username)
+        if principal is None:
+            principal = await load(username)
+            if principal is not None:
+                self._put(self._users, username, principal, time.time() + self._ttl())
+        return principal
+
+    def invalidate_user(self, username):
+        with self._lock:
+            self._users.pop(username, None)
+
+    def clear(self):
+        with self._lock:
+            self._claims.clear()
+            self._users.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "claims": len(self._claims),
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from passlib.hash import argon2
+
+from library.config import Settings
+
+
+class PasswordQueueFullError(Exception):
+    """
+        Raised when too many passwords are already waiting to be hashed or verified.
+    """
+    pass
+
+
+class ConcurrencyLimitError(Exception):
+    """
+        Raised when a key (a username or an IP) already has its limit of operations in flight.
+    """
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.key = key
+
+
+class PasswordHasher:
+    """
+        Argon2 hashing and verification on a small dedicated thread pool.
+        Each hash takes tens to hundreds of milliseconds of CPU, run on the event loop a burst
+        of logins would stall every other request. At most queue_limit passwords wait at once.
+    """
+
+    def __init__(self, workers=None, queue_limit=None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._hasher = None
+        self._hasher_params = None
+
+    def _queue_limit(self):
+        return self.queue_limit or Settings.PASSWORD_HASH_QUEUE_LIMIT
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers or Settings.PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+            return self._pool
+
+    def hasher(self):
+        # New hashes use the configured costs, existing hashes are verified with the costs they were made with
+        params = (Settings.ARGON2_TIME_COST, Settings.ARGON2_MEMORY_COST, Settings.ARGON2_PARALLELISM)
+        if params != self._hasher_params:
+            self._hasher = argon2.using(rounds=params[0], memory_cost=params[1], parallelism=params[2])
+            self._hasher_params = params
+        return self._hasher
+
+    def _submit(self, func, *args):
+        with self._lock:
+            if self.pending >= self._queue_limit():
+                self.rejected += 1
+                raise PasswordQueueFullError()
+            self.pending += 1
+        try:
+            future = self.pool.submit(func, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future=None):
+        with self._lock:
+            self.pending -= 1
+
+    def _verify(self, password, password_hash):
+        return self.hasher().verify(str(password), password_hash)
+
+    def hash(self, password):
+        """
+            Hashes a password on the pool, for synchronous callers (e.g. crud).
+        """
+        return self._submit(self.hasher().hash, str(password)).result()
+
+    def verify(self, password, password_hash):
+        return self._submit(self._verify, password, password_hash).result()
+
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self._submit(self.hasher().hash, str(password)))
+
+    async def verify_async(self, password, password_hash):
+        return await asyncio.wrap_future(self._submit(self._verify, password, password_hash))
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "limit": self._queue_limit(),
+            "rejected": self.rejected,
+        }
+
+
+class ConcurrencyLimiter:
+    """
+        Caps the number of operations in flight per key.
+    """
+
+    def __init__(self, limit):
+        # A callable, so the limit follows Settings
+        self.limit = limit
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key):
+        if key is None:
+            yield
+            return
+        with self._lock:
+            if self._counts.get(key, 0) >= self.limit():
+                raise ConcurrencyLimitError(key)
+            self._counts[key] = self._counts.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._counts[key] -= 1
+                if not self._counts[key]:
+                    del self._counts[key]
+
+
+password_hasher = PasswordHasher()
+login_user_limiter = ConcurrencyLimiter(lambda: Settings.LOGIN_MAX_CONCURRENT_PER_USER)
+login_ip_limiter = ConcurrencyLimiter(lambda: Settings.LOGIN_MAX_CONCURRENT_PER_IP)
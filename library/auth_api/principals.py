@@ -0,0 +1,41 @@
+from fastapi import Request
+from fastapi.security.utils import get_authorization_scheme_param
+from jose import JWTError, jwt
+
+from library.auth_api.cache import auth_cache, Principal
+from library.database.database import AsyncSessionLocal, get_async_engine
+from library.database import async_crud as crud
+from library.config import Settings
+
+# Token and user resolution, kept apart from the auth router so the other
+# routers can identify users without depending on Settings.OAUTH_SCHEME
+
+
+def decode_token(token):
+    return jwt.decode(token, Settings.AUTH_SECRET_KEY, algorithms=[Settings.AUTH_ALGORITHM])
+
+
+async def load_principal(username):
+    # A session is only opened when the user isn't cached
+    get_async_engine()
+    async with AsyncSessionLocal() as db:
+        user = await crud.get_users_by_username(db, username)
+        return Principal.from_user(user) if user is not None else None
+
+
+async def optional_principal(request: Request):
+    """
+        Dependency resolving the user of the request's bearer token, if any.
+        Endpoints open to everyone use it to tell signed in users apart, so
+        a missing, invalid or expired token gives None rather than a 401.
+    """
+    scheme, token = get_authorization_scheme_param(request.headers.get("Authorization"))
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        username = auth_cache.claims(token, decode_token).get("sub")
+    except JWTError:
+        return None
+    if username is None:
+        return None
+    return await auth_cache.user(username, load_principal)
@@ -9,16 +9,63 @@ library_path = os.path.dirname(os.path.abspath(__file__))
 class settingsModel(BaseSettings):
     ENV_TYPE: str = "temp"
     UPLOAD_FOLDER: str = os.path.join(library_path, 'static/uploads/')
+    BLOB_FOLDER: str = os.path.join(library_path, 'static/uploads/blobs/')
     STORAGE_FOLDER: str = os.path.join(library_path, 'static/storage/')
+    THUMBNAIL_FOLDER: str = os.path.join(library_path, 'static/storage/thumbnails/')
     MODEL_FOLDER: str = os.path.join(library_path, 'models/')
     ALLOWED_IMAGE_EXTENSIONS: Any = ['PNG', 'JPG', 'JPEG', 'GIF', 'WEBP']
     IMAGE_DEFAULT_EXPIRY_PERIOD: int = 2592000
     CACHE_TIMEOUT_PERIOD: int = 900
+    CACHE_MAX_ENTRIES: int = 10000
+    CACHE_MAX_BYTES: int = 67108864
+    PERSISTENT_CACHE: bool = False
+    PERSISTENT_CACHE_MAX_ENTRIES: int = 1000000
+    DEFAULT_TOP_K: int = 5
+    MAX_TOP_K: int = 100
+    PRELOAD_MODELS: Any = []
+    MODEL_CATALOG_CHECK_INTERVAL: float = 2
+    MODEL_DRAIN_TIMEOUT: float = 60
+    INFERENCE_BATCH_SIZE: int = 32
+    BATCH_MAX_WAIT_MS: float = 10
+    INFERENCE_WORKERS: int = 2
+    INFERENCE_EXECUTOR: str = "thread"
+    INFERENCE_EXECUTORS: Any = {}
+    INFERENCE_QUEUE_LIMIT: int = 64
+    INFERENCE_RETRY_AFTER: int = 5
+    INFERENCE_PROCESSES: int = 2
+    WORKER_MAX_JOBS: int = 1000
+    SWEEP_INTERVAL: int = 3600
+    SWEEP_BATCH_SIZE: int = 500
+    SWEEP_TEMP_FILE_GRACE_PERIOD: int = 3600
+    EXPORT_CACHE_MAX_BYTES: int = 1073741824
+    THUMBNAIL_WORKERS: int = 4
+    EXPORT_WORKERS: int = 2
+    EXPORT_JOB_TTL: int = 3600
+    UPLOAD_CHUNK_SIZE: int = 1048576
+    UPLOAD_MEMORY_LIMIT: int = 16777216
+
+    DATABASE_URL: str = "sqlite:///./sql_app.db"
+    ASYNC_DATABASE_URL: str = ""
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    DATABASE_POOL_PRE_PING: bool = True
+    DATABASE_POOL_RECYCLE: int = 1800
+    SQLITE_BUSY_TIMEOUT: int = 5000
 
     OAUTH_SCHEME: Any = "temp"
     AUTH_SECRET_KEY: str = "blank"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     AUTH_ALGORITHM: str = "HS256"
+    AUTH_CACHE_TTL: float = 30
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    ARGON2_TIME_COST: int = 3
+    ARGON2_MEMORY_COST: int = 65536
+    ARGON2_PARALLELISM: int = 4
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_QUEUE_LIMIT: int = 32
+    LOGIN_MAX_CONCURRENT_PER_USER: int = 2
+    LOGIN_MAX_CONCURRENT_PER_IP: int = 8
+    LOGIN_RETRY_AFTER: int = 2
 
     model_config = SettingsConfigDict(
         env_file=(
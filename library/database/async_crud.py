@@ -0,0 +1,116 @@
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from time import time
+import uuid
+
+from library.database import models
+from library.database.crud import image_expiry, image_rows
+from library.auth_api.cache import auth_cache
+from library.auth_api.passwords import password_hasher
+from library.config import Settings
+
+# Async versions of the crud functions, for the async endpoints
+
+#### Images ####
+
+
+async def create_images(db: AsyncSession, images, uid: str, batch_size: int = 500):
+    """
+        Records a user's uploaded images in one transaction, as crud.create_images does.
+    """
+    expiry_time = int(time()) + image_expiry(await get_settings_by_uid(db, uid))
+    rows = image_rows(images, uid, expiry_time)
+    for i in range(0, len(rows), batch_size):
+        await db.execute(insert(models.Image).values(rows[i:i + batch_size]))
+    await db.commit()
+    return expiry_time
+
+#### Settings ####
+
+
+async def get_settings_by_uid(db: AsyncSession, uid: str):
+    return (await db.execute(select(models.Setting).where(models.Setting.id == uid))).scalars().first()
+
+
+async def get_image_expiry_by_uid(db: AsyncSession, uid: str):
+    db_settings = await get_settings_by_uid(db, uid)
+    return db_settings.image_expiry
+
+
+async def update_image_expiry_by_uid(db: AsyncSession, uid: str, new_expiry: int):
+    db_settings = await get_settings_by_uid(db, uid)
+    db_settings.image_expiry = new_expiry
+    await db.commit()
+    return db_settings
+
+#### Users ####
+
+
+async def get_user_by_uid(db: AsyncSession, uid: str):
+    return (await db.execute(select(models.User).where(models.User.id == uid))).scalars().first()
+
+
+async def get_users_by_username(db: AsyncSession, name: str):
+    return (await db.execute(select(models.User).where(models.User.username == name))).scalars().first()
+
+
+async def get_users_by_email(db: AsyncSession, email: str):
+    return (await db.execute(select(models.User).where(models.User.email == email))).scalars().first()
+
+
+async def create_user(db: AsyncSession, username: str, email: str, password: str):
+    if await get_users_by_username(db, username) != None:
+        return None
+    db_settings = models.Setting(
+        id=uuid.uuid4().hex, image_expiry=Settings.IMAGE_DEFAULT_EXPIRY_PERIOD)
+    db_user = models.User(id=db_settings.id, username=username,
+                          email=email, password_hash=await password_hasher.hash_async(password), is_admin=False)
+    db_settings.user = db_user
+
+    db.add(db_user)
+    db.add(db_settings)
+
+    # Sessions don't expire objects on commit, there is nothing to refresh
+    await db.commit()
+    return db_user
+
+
+async def set_user_email(db: AsyncSession, uid: str, email: str):
+    db_user = await get_user_by_uid(db, uid)
+    db_user.email = email
+    await db.commit()
+    # Cached principals of the user are stale now
+    auth_cache.invalidate_user(db_user.username)
+    return db_user
+
+
+async def set_user_password_by_uid(db: AsyncSession, uid: str, password: str):
+    db_user = await get_user_by_uid(db, uid)
+    db_user.password_hash = await password_hasher.hash_async(password)
+    await db.commit()
+    auth_cache.invalidate_user(db_user.username)
+    return db_user
+
+
+async def set_user_password_by_username(db: AsyncSession, username: str, password: str):
+    db_user = await get_users_by_username(db, username)
+    db_user.password_hash = await password_hasher.hash_async(password)
+    await db.commit()
+    auth_cache.invalidate_user(db_user.username)
+    return db_user
+
+
+async def set_user_admin_by_uid(db: AsyncSession, uid: str, is_admin: bool):
+    db_user = await get_user_by_uid(db, uid)
+    db_user.is_admin = is_admin
+    await db.commit()
+    auth_cache.invalidate_user(db_user.username)
+    return db_user
+
+
+async def set_user_admin_by_username(db: AsyncSession, username: str, is_admin: bool):
+    db_user = await get_users_by_username(db, username)
+    db_user.is_admin = is_admin
+    await db.commit()
+    auth_cache.invalidate_user(db_user.username)
+    return db_user
@@ -1,25 +1,50 @@
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 from requests import Response
 from time import time
-from passlib.hash import argon2
 import uuid
 
 from library.database import models
+from library.auth_api.cache import auth_cache
+from library.auth_api.passwords import password_hasher
 from library.config import Settings
 
 #### Images ####
 
 
+def image_expiry(db_settings):
+    return db_settings.image_expiry if db_settings is not None else Settings.IMAGE_DEFAULT_EXPIRY_PERIOD
+
+
+def image_rows(images, uid: str, expiry_time: int):
+    return [{"id": uuid.uuid4().hex, "image_hash": str(image_hash), "image_name": image_name,
+             "uid": uid, "expiry_time": expiry_time} for image_hash, image_name in images]
+
+
 def create_image(db: Session, image_hash: str, image_name: str, uid: str):
-    user = get_user_by_uid(uid)
+    expiry_time = int(time()) + image_expiry(get_settings_by_uid(db, uid))
     db_image = models.Image(id=uuid.uuid4().hex, image_hash=image_hash,
-                            image_name=image_name, uid=uid, user=user, expiry_time=time.time()+user.settings.image_expiry)
+                            image_name=image_name, uid=uid, expiry_time=expiry_time)
     db.add(db_image)
     db.commit()
     db.refresh(db_image)
     return db_image
 
 
+def create_images(db: Session, images, uid: str, batch_size: int = 500):
+    """
+        Records a user's uploaded images, given as (image_hash, image_name) pairs, in one transaction.
+        The user's image expiry is read once and the rows are inserted with multi-row INSERTs
+        (batch_size rows each) without loading them back. Returns the rows' expiry time.
+    """
+    expiry_time = int(time()) + image_expiry(get_settings_by_uid(db, uid))
+    rows = image_rows(images, uid, expiry_time)
+    for i in range(0, len(rows), batch_size):
+        db.execute(insert(models.Image).values(rows[i:i + batch_size]))
+    db.commit()
+    return expiry_time
+
+
 #### Settings ####
 
 
@@ -60,7 +85,7 @@ def create_user(db: Session, username: str, email: str, password: str):
     db_settings = models.Setting(
         id=uuid.uuid4().hex, image_expiry=Settings.IMAGE_DEFAULT_EXPIRY_PERIOD)
     db_user = models.User(id=db_settings.id, username=username,
-                          email=email, password_hash=argon2.hash(password), is_admin=False)
+                          email=email, password_hash=password_hasher.hash(password), is_admin=False)
     db_settings.user = db_user
 
     db.add(db_user)
@@ -77,30 +102,35 @@ def set_user_email(db: Session, uid: str, email: str):
     db_user.email = email
     db.commit()
     db.refresh(db_user)
+    # Cached principals of the user are stale now
+    auth_cache.invalidate_user(db_user.username)
     return db_user
 
 
 def set_user_password_by_uid(db: Session, uid: str, password: str):
     db_user = get_user_by_uid(db, uid)
-    db_user.password = argon2.hash(password)
+    db_user.password_hash = password_hasher.hash(password)
     db.commit()
     db.refresh(db_user)
+    auth_cache.invalidate_user(db_user.username)
     return db_user
 
 
 def set_user_password_by_username(db: Session, username: str, password: str):
     db_user = get_users_by_username(db, username)
-    db_user.password = argon2.hash(password)
+    db_user.password_hash = password_hasher.hash(password)
     db.commit()
     db.refresh(db_user)
+    auth_cache.invalidate_user(db_user.username)
     return db_user
 
 
 def set_user_admin_by_uid(db: Session, uid: str, is_admin: bool):
-    db_user = get_users_by_username(db, uid)
+    db_user = get_user_by_uid(db, uid)
     db_user.is_admin = is_admin
     db.commit()
     db.refresh(db_user)
+    auth_cache.invalidate_user(db_user.username)
     return db_user
 
 
@@ -109,4 +139,5 @@ def set_user_admin_by_username(db: Session, username: str, is_admin: bool):
     db_user.is_admin = is_admin
     db.commit()
     db.refresh(db_user)
+    auth_cache.invalidate_user(db_user.username)
     return db_user
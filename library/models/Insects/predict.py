@@ -1,34 +1,35 @@
+import numpy as np
 import tensorflow as tf
 
-def predict(img, path):
-    model =  tf.saved_model.load(f"{path}/aiy_vision_classifier_insects_V1_1")
-    infer = model.signatures["image_classifier"]
+def load_model(path):
+    model = tf.saved_model.load(f"{path}/aiy_vision_classifier_insects_V1_1")
 
-    # Make a prediction
-    output = infer(tf.constant(img))
+    with open(f"{path}/labels.txt", 'r') as file:
+        lines = file.readlines()
+    labels = np.array([line.strip() for line in lines])
 
-    # Get the output values    
-    logits = output['logits']
+    # Keep the SavedModel referenced, the signature alone does not keep it alive
+    return {"model": model, "infer": model.signatures["image_classifier"], "labels": labels}
 
-    # Get the predicted class labels
-    top_values, top_indices = tf.math.top_k(logits, k=102)
+def predict(img, path, model=None, top_k=5):
+    if model is None:
+        model = load_model(path)
+    logits = predict_logits(img, path, model)[0]
 
-    # Convert the tensors to Python lists
-    top_values = top_values.numpy().tolist()[0]
-    top_indices = top_indices.numpy().tolist()[0]
+    # Get the top_k predicted class labels, sorted highest first
+    top_indices = np.argpartition(logits, -top_k)[-top_k:]
+    top_indices = top_indices[np.argsort(-logits[top_indices])]
 
-    with open(f"{path}/labels.txt", 'r') as file:
-        lines = file.readlines()
-    labels = [line.strip() for line in lines]
+    # Pair the top values with their labels
+    return [[float(logits[index]), str(model["labels"][index])] for index in top_indices]
 
-    # Keep only top 100
-    values, val_labels = [], []
-    for value, index in zip(top_values, top_indices):
-        if len(values) < 100:
-            values.append(value)
-            val_labels.append(labels[index])
+def predict_logits(imgs, path, model=None):
+    if model is None:
+        model = load_model(path)
+    infer = model["infer"]
 
-    # Pair the top values with their labels
-    predictions_list = [[f'{prob:.20f}', label] for prob, label in zip(values, val_labels)]
+    # Make a prediction for the whole batch
+    output = infer(tf.constant(imgs))
 
-    return predictions_list
\ No newline at end of file
+    # Get the output values    
+    return output['logits'].numpy()
\ No newline at end of file
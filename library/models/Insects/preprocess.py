@@ -1,19 +1,12 @@
-import tensorflow as tf
+# The backend decodes, resizes and scales images itself from these declarations
+# (see library/utilities_api/preprocessing.py)
 
-def img_preprocess(image_path):    
-    # Load the image file and resize it to 224 x 224 pixels
-    img = tf.keras.utils.load_img(image_path, target_size=[224, 224])
-    
-    # Convert the image to an array
-    x = tf.keras.utils.img_to_array(img)
+# Load the image file and resize it to 224 x 224 pixels
+INPUT_SIZE = (224, 224)
 
-    # Scale the pixel values to [0, 1]
-    x = x / 255.0
+# Scale the pixel values to [0, 1]
+SCALE = 1 / 255.0
+OFFSET = 0.0
 
-    # Add a batch dimension
-    x = tf.expand_dims(x, axis=0)
-
-    # Preprocess the array for MobileNet
-    # x = tf.keras.applications.mobilenet.preprocess_input(x[tf.newaxis,...])
-
-    return x
\ No newline at end of file
+# Same sampling as tf.keras.utils.load_img
+INTERPOLATION = "nearest"
\ No newline at end of file
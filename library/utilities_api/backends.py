@@ -0,0 +1,106 @@
+import os
+import threading
+
+import numpy as np
+
+from library.utilities_api.catalog import read_labels
+
+################ Runtime Backends ################
+# Built in predict.py replacements for models converted to a lighter runtime.
+# A model whose metadata.txt names one of these frameworks is run from its
+# converted artifact (model.tflite / model.onnx) and labels.txt, its predict.py isn't used.
+
+
+def load_tflite_interpreter(model_file):
+    # The standalone runtimes are much lighter than TensorFlow, which is only a fallback
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+    return Interpreter(model_path=model_file, num_threads=os.cpu_count())
+
+
+class TFLiteBackend:
+    """
+        Runs a model.tflite file, float, float16 or int8 quantized.
+        Quantized inputs and outputs are converted with the model's own scale and zero point.
+    """
+    artifact = "model.tflite"
+
+    def __init__(self, path):
+        self.interpreter = load_tflite_interpreter(os.path.join(path, self.artifact))
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.shape = None
+        # An interpreter can only run one batch at a time
+        self._lock = threading.Lock()
+
+    def __call__(self, imgs):
+        imgs = np.asarray(imgs, dtype=np.float32)
+        with self._lock:
+            if imgs.shape != self.shape:
+                # Resized to the batch, only reallocated when the batch size changes
+                self.interpreter.resize_tensor_input(self.input["index"], imgs.shape)
+                self.interpreter.allocate_tensors()
+                self.shape = imgs.shape
+
+            scale, zero_point = self.input["quantization"]
+            if self.input["dtype"] != np.float32 and scale:
+                imgs = np.round(imgs / scale + zero_point)
+            self.interpreter.set_tensor(self.input["index"], imgs.astype(self.input["dtype"]))
+            self.interpreter.invoke()
+            logits = self.interpreter.get_tensor(self.output["index"])
+
+        scale, zero_point = self.output["quantization"]
+        if self.output["dtype"] != np.float32 and scale:
+            logits = (logits.astype(np.float32) - zero_point) * scale
+        return logits
+
+
+class ONNXBackend:
+    """
+        Runs a model.onnx file with ONNX Runtime on the CPU.
+    """
+    artifact = "model.onnx"
+
+    def __init__(self, path):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, self.artifact), options, providers=["CPUExecutionProvider"])
+        self.input = self.session.get_inputs()[0].name
+
+    def __call__(self, imgs):
+        # Sessions are thread safe
+        return self.session.run(None, {self.input: np.asarray(imgs, dtype=np.float32)})[0]
+
+
+backends = {"tflite": TFLiteBackend, "onnx": ONNXBackend}
+
+
+class BackendPlugin:
+    """
+        Stands in for a model's predict.py, with the same load_model/predict/predict_logits functions.
+    """
+
+    def __init__(self, framework):
+        self.backend = backends[framework]
+
+    def load_model(self, path):
+        return self.backend(path)
+
+    def predict_logits(self, imgs, path, model=None):
+        if model is None:
+            model = self.load_model(path)
+        return model(imgs)
+
+    def predict(self, img, path, model=None, top_k=None):
+        # Inside the backend the logits are labelled by LoadedModel, this is for use outside of it
+        from library.utilities_api.inference import format_predictions
+        return format_predictions(self.predict_logits(img, path, model), read_labels(path), top_k)[0]
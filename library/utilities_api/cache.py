@@ -0,0 +1,280 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from library.config import Settings
+
+
+def prediction_size(prediction):
+    """
+        Rough size in bytes of a cached prediction list.
+    """
+    return 64 + sum(48 + len(str(label)) for _, label in prediction)
+
+
+def encode_prediction(prediction):
+    """
+        Packs a prediction list as float32 scores followed by NUL separated labels.
+    """
+    scores = np.array([float(score) for score, _ in prediction], dtype=np.float32)
+    labels = "\0".join(str(label) for _, label in prediction).encode()
+    return len(prediction).to_bytes(4, "little") + scores.tobytes() + labels
+
+
+def decode_prediction(data):
+    count = int.from_bytes(data[:4], "little")
+    scores = np.frombuffer(data, dtype=np.float32, count=count, offset=4).tolist()
+    labels = data[4 + count * 4:].decode().split("\0") if count else []
+    return [[score, label] for score, label in zip(scores, labels)]
+
+
+class PersistentCache:
+    """
+        On-disk prediction cache in an SQLite database (WAL mode), shared by
+        every worker process and kept across restarts.
+    """
+
+    def __init__(self, db_path=None, max_entries=None):
+        self.db_path = db_path or os.path.join(Settings.STORAGE_FOLDER, "inference_cache.db")
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._puts = 0
+
+    def _max_entries(self):
+        return self.max_entries or Settings.PERSISTENT_CACHE_MAX_ENTRIES
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, each thread opens its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "key TEXT PRIMARY KEY, digest TEXT, model TEXT, data BLOB, created REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_predictions_created ON predictions (created)")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def _key(key):
+        return ":".join(str(part) for part in key)
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT data FROM predictions WHERE key = ?", (self._key(key),)).fetchone()
+        return decode_prediction(row[0]) if row else None
+
+    def put(self, key, prediction):
+        self.put_many([(key, prediction)])
+
+    def put_many(self, items):
+        """
+            Writes (key, prediction) pairs in one transaction.
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)",
+                [(self._key(key), key[0], key[1], encode_prediction(prediction), now) for key, prediction in items])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        # Trim the oldest entries every so often rather than on every write
+        trim = self._puts // 1000 != (self._puts + len(items)) // 1000
+        self._puts += len(items)
+        if trim:
+            connection.execute(
+                "DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries(),))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM predictions")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+
+
+class InferenceCache:
+    """
+        LRU cache of predictions keyed by (SHA-256 digest of the image, model, model version, top_k).
+        Entries expire ttl seconds after they were last used, and the least
+        recently used entries are evicted past max_entries or max_bytes.
+        An optional persistent cache is used as a second tier behind it, it is
+        written by a background thread so put() never waits on SQLite.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, persistent=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persistent = persistent
+        self.persistent_hits = 0
+        self.persistent_dropped = 0
+        self._writes = queue.Queue(maxsize=10000)
+        self._writer = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _max_entries(self):
+        return self.max_entries or Settings.CACHE_MAX_ENTRIES
+
+    def _max_bytes(self):
+        return self.max_bytes or Settings.CACHE_MAX_BYTES
+
+    def _ttl(self):
+        return self.ttl if self.ttl is not None else Settings.CACHE_TIMEOUT_PERIOD
+
+    @staticmethod
+    def key(digest, model, version, top_k):
+        return (digest, model, version, top_k)
+
+    def get(self, key):
+        with self._lock:
+            prediction = self._get(key)
+            if prediction is not None:
+                self.hits += 1
+                return prediction
+
+        prediction = self._get_persistent(key)
+        with self._lock:
+            if prediction is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.persistent_hits += 1
+        # Promote to memory for the next lookups
+        self._put(key, prediction)
+        return prediction
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        prediction, size, last_used = entry
+        if time.time() - last_used >= self._ttl():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        # Refresh both the LRU position and the expiry time
+        self._entries[key] = (prediction, size, time.time())
+        self._entries.move_to_end(key)
+        return prediction
+
+    def _get_persistent(self, key):
+        if self.persistent is None:
+            return None
+        try:
+            return self.persistent.get(key)
+        except sqlite3.Error:
+            logging.error("Persistent cache read error", exc_info=True)
+            return None
+
+    def put(self, key, prediction):
+        self._put(key, prediction)
+        if self.persistent is not None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(
+                        target=self._write_persistent, name="persistent-cache", daemon=True)
+                    self._writer.start()
+            try:
+                self._writes.put_nowait((key, prediction))
+            except queue.Full:
+                # The memory tier still has it, losing the copy on disk is harmless
+                self.persistent_dropped += 1
+
+    def _write_persistent(self):
+        while True:
+            items = [self._writes.get()]
+            while len(items) < 500:
+                try:
+                    items.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.persistent.put_many(items)
+            except sqlite3.Error:
+                logging.error("Persistent cache write error", exc_info=True)
+            finally:
+                for _ in items:
+                    self._writes.task_done()
+
+    def flush(self):
+        """
+            Waits until queued predictions are written to the persistent cache.
+        """
+        self._writes.join()
+
+    def _put(self, key, prediction):
+        size = prediction_size(prediction)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (prediction, size, time.time())
+            self.size += size
+            self._evict()
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def _evict(self):
+        # Expired entries are dropped first, they are the oldest in LRU order
+        now = time.time()
+        while self._entries:
+            key, (_, _, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self._ttl():
+                break
+            self._remove(key)
+            self.expirations += 1
+
+        while self._entries and (len(self._entries) > self._max_entries() or self.size > self._max_bytes()):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        if self.persistent is not None:
+            self.flush()
+            self.persistent.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_entries": self._max_entries(),
+            "max_bytes": self._max_bytes(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+            "persistent_hits": self.persistent_hits,
+            "persistent_entries": len(self.persistent) if self.persistent is not None else None,
+            "persistent_dropped": self.persistent_dropped,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
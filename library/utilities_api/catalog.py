@@ -0,0 +1,233 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from library.config import Settings
+
+# metadata.txt fields, in order
+metadata_keys = ["specVersion", "mlFramework", "fileTypes"]
+
+
+def read_metadata(model_path):
+    metadata = {}
+    with open(os.path.join(model_path, "metadata.txt"), 'r') as file:
+        lines = file.readlines()
+
+    for key, line in zip(metadata_keys, lines):
+        metadata[key] = line.strip().lower()
+
+    metadata["fileTypes"] = metadata["fileTypes"].upper().strip().split(",")
+    return metadata
+
+
+def read_labels(model_path):
+    labels_path = os.path.join(model_path, "labels.txt")
+    if not os.path.isfile(labels_path):
+        return None
+    with open(labels_path, 'r') as file:
+        return np.array([line.strip() for line in file.readlines()])
+
+
+def files_version(model_path):
+    """
+        Identifies the version of a model's files on disk (those of its active version folder
+        for versioned models), it changes whenever any file in the folder or its subfolders
+        (e.g. a SavedModel's variables/) is edited or replaced.
+    """
+    latest = 0
+    for path, folders, files in os.walk(model_path):
+        # __pycache__ changes whenever the model's plugins are imported, it isn't part of the model
+        folders[:] = [folder for folder in folders if folder != "__pycache__"]
+        for name in folders + files:
+            latest = max(latest, os.stat(os.path.join(path, name)).st_mtime_ns)
+    return format(latest, "x")
+
+
+def version_key(version):
+    # Natural order, v10 comes after v9
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", version)]
+
+
+def model_versions(folder):
+    """
+        Version folders of a versioned model (e.g. Birds/v1/, Birds/v2/), oldest first.
+    """
+    try:
+        versions = [entry.name for entry in os.scandir(folder)
+                    if entry.is_dir() and os.path.isfile(os.path.join(entry.path, "metadata.txt"))]
+    except FileNotFoundError:
+        return []
+    return sorted(versions, key=version_key)
+
+
+def active_version(folder):
+    """
+        The active version of a model folder: the one named in its ACTIVE file, or else its latest.
+        Unversioned models (with their files in the model folder itself) have no version.
+    """
+    if os.path.isfile(os.path.join(folder, "metadata.txt")):
+        return None
+    try:
+        with open(os.path.join(folder, "ACTIVE"), 'r') as file:
+            version = file.read().strip()
+        if os.path.isfile(os.path.join(folder, version, "metadata.txt")):
+            return version
+    except FileNotFoundError:
+        pass
+    versions = model_versions(folder)
+    return versions[-1] if versions else None
+
+
+def set_active_version(folder, version):
+    """
+        Points a model at one of its versions. The ACTIVE file is replaced in one step,
+        so every process reads either the old or the new version.
+    """
+    temp_path = os.path.join(folder, f"ACTIVE.{threading.get_ident()}.part")
+    with open(temp_path, 'w') as file:
+        file.write(version)
+    os.replace(temp_path, os.path.join(folder, "ACTIVE"))
+
+
+def resolve_model_path(folder, version=None):
+    """
+        Returns the folder holding a model's files, that of the given or the active version.
+    """
+    version = version or active_version(folder)
+    return os.path.join(folder, version) if version else folder
+
+
+class ModelEntry:
+    """
+        A model folder as found by the catalog, with its parsed metadata.
+        Labels are read the first time they are needed.
+    """
+
+    def __init__(self, name, folder, path, version, active):
+        self.name = name
+        self.folder = folder
+        self.path = path
+        self.version = version
+        self.active = active
+        self.metadata = read_metadata(path)
+        self.file_types = frozenset(self.metadata["fileTypes"])
+        self._labels = None
+        self._labels_read = False
+
+    @property
+    def labels(self):
+        if not self._labels_read:
+            self._labels = read_labels(self.path)
+            self._labels_read = True
+        return self._labels
+
+
+class ModelCatalog:
+    """
+        In memory catalog of the models in MODEL_FOLDER, versioned models are
+        represented by their active version.
+        The folder is scanned once, and rechecked at most every check_interval
+        seconds: new model folders are added, removed ones dropped, and a
+        model whose files changed has its metadata and labels read again.
+    """
+
+    def __init__(self, models_path=None, check_interval=None):
+        self.models_path = models_path or Settings.MODEL_FOLDER
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._names = []
+        self._folder_mtime = None
+        self._checked = 0
+
+    def _check_interval(self):
+        return self.check_interval if self.check_interval is not None else Settings.MODEL_CATALOG_CHECK_INTERVAL
+
+    def _check(self, force=False):
+        now = time.monotonic()
+        if not force and self._folder_mtime is not None and now - self._checked < self._check_interval():
+            return
+        with self._lock:
+            if not force and self._folder_mtime is not None and now - self._checked < self._check_interval():
+                return
+            self._checked = now
+
+            # Adding or removing a model folder changes the models folder's mtime
+            folder_mtime = os.stat(self.models_path).st_mtime_ns
+            if folder_mtime != self._folder_mtime:
+                self._folder_mtime = folder_mtime
+                self._scan()
+            else:
+                for name, entry in list(self._entries.items()):
+                    self._refresh(name, entry.folder, entry)
+                self._names = sorted(self._entries, key=str.lower)
+
+    def _scan(self):
+        entries = {}
+        for entry in os.scandir(self.models_path):
+            # Only folders with a metadata.txt, or versions with one, are models (this skips __pycache__)
+            if entry.is_dir() and (os.path.isfile(os.path.join(entry.path, "metadata.txt")) or model_versions(entry.path)):
+                model = self._refresh(entry.name, entry.path, self._entries.get(entry.name))
+                if model is not None:
+                    entries[entry.name] = model
+        self._entries = entries
+        self._names = sorted(entries, key=str.lower)
+
+    def _refresh(self, name, folder, entry):
+        try:
+            active = active_version(folder)
+            model_path = resolve_model_path(folder, active)
+            # Versioned models are identified by their active version as well as its files
+            version = files_version(model_path)
+            if active is not None:
+                version = f"{active}-{version}"
+            if entry is not None and entry.version == version:
+                return entry
+            entry = ModelEntry(name, folder, model_path, version, active)
+            self._entries[name] = entry
+            logging.info(f"Model catalog: found {name} (version {version})")
+            return entry
+        except (OSError, KeyError):
+            logging.error(f"Model catalog: invalid model folder {folder}", exc_info=True)
+            self._entries.pop(name, None)
+            return None
+
+    def refresh(self):
+        """
+            Rescans the models folder now.
+        """
+        self._check(force=True)
+
+    def names(self):
+        self._check()
+        return list(self._names)
+
+    def __contains__(self, name):
+        self._check()
+        return name in self._entries
+
+    def get(self, name):
+        """
+            Returns a model's entry, raises KeyError for unknown models.
+        """
+        self._check()
+        return self._entries[name]
+
+    def metadata(self, name):
+        return self.get(name).metadata
+
+    def file_types(self, name):
+        return self.get(name).file_types
+
+    def labels(self, name):
+        return self.get(name).labels
+
+    def version(self, name):
+        return self.get(name).version
+
+
+model_catalog = ModelCatalog()
@@ -0,0 +1,251 @@
+"""
+Converts a model's TensorFlow SavedModel to TFLite or ONNX as a new version of the model,
+then checks that the converted model predicts the same as the SavedModel.
+
+    python -m library.utilities_api.convert Birds --saved-model aiy_vision_classifier_birds_V1_1 \
+        --signature image_classifier --to tflite --quantize int8 --samples ./sample_images
+
+The new version only becomes active with --activate, and only if it passes the parity check.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from library.config import Settings
+from library.utilities_api.catalog import (active_version, model_versions, resolve_model_path, set_active_version,
+                                           version_key)
+from library.utilities_api.backends import backends
+from library.utilities_api.inference import load_plugin
+from library.utilities_api.preprocessing import ImageSource, preprocess_images, stack_images
+
+quantizations = {
+    "tflite": ["none", "float16", "dynamic", "int8"],
+    "onnx": ["none", "dynamic", "int8"],
+}
+
+################ Samples ################
+
+
+def load_samples(preprocess, samples_dir=None, count=32, seed=0):
+    """
+        Preprocessed sample images for calibration and the parity check: the images in
+        samples_dir, or random noise images when no directory is given.
+    """
+    if samples_dir:
+        sources = [entry.path for entry in sorted(os.scandir(samples_dir), key=lambda entry: entry.name)
+                   if entry.is_file() and entry.name.rsplit(".", 1)[-1].upper() in Settings.ALLOWED_IMAGE_EXTENSIONS]
+        return np.asarray(stack_images(preprocess_images(preprocess, sources)), dtype=np.float32)
+
+    from PIL import Image
+    import io
+    rng = np.random.default_rng(seed)
+    sources = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (256, 256, 3), dtype=np.uint8)).save(buffer, format="PNG")
+        sources.append(ImageSource(None, buffer.getvalue()))
+    return np.asarray(stack_images(preprocess_images(preprocess, sources)), dtype=np.float32)
+
+
+def batches(imgs, batch_size=None):
+    batch_size = batch_size or Settings.INFERENCE_BATCH_SIZE
+    for i in range(0, len(imgs), batch_size):
+        yield imgs[i:i + batch_size]
+
+################ Conversion ################
+
+
+def logits_function(saved_model_dir, signature, output_key, input_shape):
+    """
+        Loads a SavedModel signature as a function from a batch of images to its logits only.
+    """
+    import tensorflow as tf
+
+    loaded = tf.saved_model.load(saved_model_dir)
+    infer = loaded.signatures[signature]
+    input_name = next(iter(infer.structured_input_signature[1]))
+
+    @tf.function(input_signature=[tf.TensorSpec([None, *input_shape], tf.float32)])
+    def logits(imgs):
+        return infer(**{input_name: imgs})[output_key]
+
+    # The SavedModel must outlive the function
+    logits.saved_model = loaded
+    return logits
+
+
+def convert_tflite(logits, output_file, quantize, samples):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions(
+        [logits.get_concrete_function()], logits.saved_model)
+    if quantize != "none":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantize == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantize == "int8":
+        # Activations are calibrated on the sample images, inputs and outputs stay float
+        converter.representative_dataset = lambda: ([samples[i:i + 1]] for i in range(len(samples)))
+    with open(output_file, "wb") as file:
+        file.write(converter.convert())
+
+
+def convert_onnx(logits, output_file, quantize, samples):
+    import tf2onnx
+
+    if quantize == "none":
+        tf2onnx.convert.from_function(logits, input_signature=logits.input_signature, output_path=output_file)
+        return
+
+    from onnxruntime import quantization
+    with tempfile.TemporaryDirectory() as temp_dir:
+        float_file = os.path.join(temp_dir, "model.onnx")
+        tf2onnx.convert.from_function(logits, input_signature=logits.input_signature, output_path=float_file)
+        if quantize == "dynamic":
+            quantization.quantize_dynamic(float_file, output_file, weight_type=quantization.QuantType.QInt8)
+        else:
+            quantization.quantize_static(float_file, output_file, SampleReader(float_file, samples))
+
+
+class SampleReader:
+    """
+        Feeds the sample images to ONNX Runtime's static quantization calibration.
+    """
+
+    def __init__(self, model_file, samples):
+        import onnxruntime
+        input_name = onnxruntime.InferenceSession(model_file, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+        self._samples = iter([{input_name: samples[i:i + 1]} for i in range(len(samples))])
+
+    def get_next(self):
+        return next(self._samples, None)
+
+    def rewind(self):
+        pass
+
+
+converters = {"tflite": convert_tflite, "onnx": convert_onnx}
+
+################ Parity ################
+
+
+def check_parity(reference, converted, top_k=5):
+    """
+        Compares the logits of the original and converted model for the same images.
+    """
+    reference = np.asarray(reference, dtype=np.float32)
+    converted = np.asarray(converted, dtype=np.float32)
+    top_k = min(top_k, reference.shape[1])
+
+    reference_top = np.argsort(-reference, axis=1)[:, :top_k]
+    converted_top = np.argsort(-converted, axis=1)[:, :top_k]
+    overlap = [len(set(a) & set(b)) / top_k for a, b in zip(reference_top.tolist(), converted_top.tolist())]
+    difference = np.abs(reference - converted)
+    return {
+        "images": len(reference),
+        "top1_agreement": float(np.mean(reference_top[:, 0] == converted_top[:, 0])),
+        f"top{top_k}_overlap": float(np.mean(overlap)),
+        "max_abs_diff": float(difference.max()),
+        "mean_abs_diff": float(difference.mean()),
+    }
+
+################ Model Versions ################
+
+
+def next_version(folder):
+    versions = model_versions(folder)
+    numbers = [version_key(version)[1] for version in versions if len(version_key(version)) == 3]
+    return f"v{max(numbers, default=0) + 1}"
+
+
+def migrate_unversioned(folder):
+    """
+        Moves an unversioned model's files into a v1 folder, making it a versioned model.
+    """
+    temp_dir = os.path.join(folder, ".v1")
+    os.makedirs(temp_dir)
+    for entry in list(os.scandir(folder)):
+        if entry.name not in (".v1", "__pycache__"):
+            shutil.move(entry.path, os.path.join(temp_dir, entry.name))
+    os.rename(temp_dir, os.path.join(folder, "v1"))
+    set_active_version(folder, "v1")
+
+
+def create_version(source_path, target_path, framework):
+    """
+        Creates the converted version's folder from the source's files, with metadata.txt naming its framework.
+    """
+    os.makedirs(target_path)
+    for entry in os.scandir(source_path):
+        # The SavedModel and predict.py aren't used by the backends
+        if entry.is_file() and entry.name not in ("predict.py", "metadata.txt"):
+            shutil.copy2(entry.path, target_path)
+    with open(os.path.join(source_path, "metadata.txt"), 'r') as file:
+        lines = file.read().splitlines()
+    lines[1] = framework
+    with open(os.path.join(target_path, "metadata.txt"), 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a model's SavedModel to TFLite or ONNX as a new model version.")
+    parser.add_argument("model", help="Model folder name, e.g. Birds")
+    parser.add_argument("--saved-model", required=True, help="SavedModel folder, relative to the model's folder")
+    parser.add_argument("--signature", default="serving_default", help="SavedModel signature to convert")
+    parser.add_argument("--output-key", default="logits", help="Output of the signature holding the logits")
+    parser.add_argument("--to", choices=sorted(converters), required=True, help="Runtime to convert to")
+    parser.add_argument("--quantize", default="none", help="none, float16 (tflite), dynamic or int8")
+    parser.add_argument("--samples", help="Folder of sample images for int8 calibration and the parity check")
+    parser.add_argument("--version", help="Version folder to create, defaults to the next vN")
+    parser.add_argument("--min-agreement", type=float, default=0.99, help="Minimum top-1 agreement with the SavedModel")
+    parser.add_argument("--migrate", action="store_true", help="Move an unversioned model's files into v1 first")
+    parser.add_argument("--activate", action="store_true", help="Make the new version active if it passes the parity check")
+    parser.add_argument("--models-path", default=Settings.MODEL_FOLDER)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if args.quantize not in quantizations[args.to]:
+        parser.error(f"--quantize must be one of {', '.join(quantizations[args.to])} for {args.to}")
+
+    folder = os.path.join(args.models_path, args.model)
+    if active_version(folder) is None:
+        if not args.migrate:
+            parser.error(f"{args.model} isn't versioned, pass --migrate to move its files into {args.model}/v1 first")
+        logging.info(f"Moving the files of {args.model} into {args.model}/v1")
+        migrate_unversioned(folder)
+
+    source_path = resolve_model_path(folder)
+    preprocess = load_plugin(source_path, args.model, "preprocess")
+    samples = load_samples(preprocess, args.samples)
+    logits = logits_function(os.path.join(source_path, args.saved_model), args.signature, args.output_key, samples.shape[1:])
+
+    version = args.version or next_version(folder)
+    target_path = os.path.join(folder, version)
+    create_version(source_path, target_path, args.to)
+    artifact = os.path.join(target_path, backends[args.to].artifact)
+    logging.info(f"Converting {args.model} ({os.path.basename(source_path)}) to {args.to} ({args.quantize}) as {version}")
+    converters[args.to](logits, artifact, args.quantize, samples)
+    logging.info(f"Wrote {artifact} ({os.path.getsize(artifact) / 2 ** 20:.1f} MiB)")
+
+    backend = backends[args.to](target_path)
+    reference = np.concatenate([logits(batch).numpy() for batch in batches(samples)])
+    converted = np.concatenate([backend(batch) for batch in batches(samples)])
+    parity = check_parity(reference, converted)
+    logging.info(f"Parity with the SavedModel: {parity}")
+
+    if parity["top1_agreement"] < args.min_agreement:
+        logging.error(f"{version} failed the parity check (top-1 agreement {parity['top1_agreement']:.3f} < {args.min_agreement})")
+        return 1
+    if args.activate:
+        set_active_version(folder, version)
+        logging.info(f"{args.model} now uses {version}, running servers pick it up through the Admin API's /swap_model")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from library.config import Settings
+from library.utilities_api.inference import get_predictions
+from library.utilities_api.catalog import active_version
+from library.utilities_api.workers import worker_pool
+
+
+class QueueFullError(Exception):
+    """
+        Raised when the inference queue has no room left for a request.
+    """
+    pass
+
+
+class InferenceExecutor:
+    """
+        Dedicated pools for inference work, kept separate from Starlette's threadpool
+        so cheap endpoints stay responsive while uploads are being predicted.
+        Admission is bounded: at most queue_limit images can be in flight at once.
+    """
+
+    def __init__(self, workers=None, queue_limit=None):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.pending = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._thread_pool = None
+        self._process_pool = None
+
+    def _workers(self):
+        return self.workers or Settings.INFERENCE_WORKERS
+
+    def _queue_limit(self):
+        return self.queue_limit or Settings.INFERENCE_QUEUE_LIMIT
+
+    @property
+    def thread_pool(self):
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(
+                    max_workers=self._workers(), thread_name_prefix="inference")
+            return self._thread_pool
+
+    @property
+    def process_pool(self):
+        with self._lock:
+            if self._process_pool is None:
+                # Each worker process keeps its own resident copy of the models it is sent.
+                # Spawned rather than forked, forking a process running threads and TF is unsafe
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self._workers(), mp_context=multiprocessing.get_context("spawn"))
+            return self._process_pool
+
+    def executor_type(self, model_name):
+        return Settings.INFERENCE_EXECUTORS.get(model_name, Settings.INFERENCE_EXECUTOR)
+
+    def executor_for(self, model_name):
+        if self.executor_type(model_name) == "process":
+            return self.process_pool
+        return self.thread_pool
+
+    def concurrency(self, model_name):
+        """
+            The number of batches of a model the executor can run at once.
+        """
+        if self.executor_type(model_name) == "workers":
+            return worker_pool._processes()
+        return self._workers()
+
+    async def predict(self, model_name, images, top_k=None):
+        """
+            Predicts the images on the pool configured for the model.
+        """
+        loop = asyncio.get_running_loop()
+        if self.executor_type(model_name) == "workers":
+            # The thread only waits on the worker process, the model runs there
+            return await loop.run_in_executor(self.thread_pool, worker_pool.predict, model_name, images, top_k)
+        # Both pools follow model swaps (made by any process) through the model's active version
+        version = active_version(os.path.join(Settings.MODEL_FOLDER, model_name))
+        if self.executor_type(model_name) == "process":
+            return await loop.run_in_executor(self.process_pool, get_predictions, images, model_name, top_k, version)
+        return await loop.run_in_executor(self.thread_pool, get_predictions, images, model_name, top_k, version)
+
+    ################ Backpressure ################
+
+    def reserve(self, count=1):
+        with self._lock:
+            # An oversized request is still let in when nothing else is queued
+            if self.pending and self.pending + count > self._queue_limit():
+                self.rejected += 1
+                raise QueueFullError()
+            self.pending += count
+
+    def try_reserve(self, count=1):
+        """
+            Reserves room for count images if there is some, for background work that waits
+            for room rather than being rejected (it isn't counted as a rejection).
+        """
+        with self._lock:
+            if self.pending and self.pending + count > self._queue_limit():
+                return False
+            self.pending += count
+            return True
+
+    def release(self, count=1):
+        with self._lock:
+            self.pending -= count
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "limit": self._queue_limit(),
+            "rejected": self.rejected,
+            "workers": self._workers(),
+        }
+
+    def shutdown(self):
+        with self._lock:
+            for pool in (self._thread_pool, self._process_pool):
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+            self._thread_pool = None
+            self._process_pool = None
+        worker_pool.stop()
+
+
+inference_executor = InferenceExecutor()
@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from library.config import Settings
+
+# Job ids are the export's file name: its content key and format
+job_id_pattern = re.compile(r"^[0-9a-f]{32}\.(xlsx|csv|ndjson|parquet)$")
+
+
+class ExportJob:
+    def __init__(self, job_id, total):
+        self.id = job_id
+        self.format = job_id.rsplit(".", 1)[1]
+        self.file_path = os.path.join(Settings.STORAGE_FOLDER, job_id)
+        self.status = "queued"
+        self.done = 0
+        self.total = total
+        self.error = None
+        self.finished = None
+
+    def progress(self, done):
+        self.done = done
+
+    def info(self):
+        return {
+            "id": self.id,
+            "format": self.format,
+            "status": self.status,
+            "rows_done": self.done,
+            "rows_total": self.total,
+            "error": self.error,
+        }
+
+
+class ExportJobs:
+    """
+        Builds exports in the background and tracks their progress.
+        Jobs are identified by the export's content key, so identical requests,
+        even concurrent ones, share a single build and file.
+        Finished jobs are forgotten after EXPORT_JOB_TTL seconds, their files are
+        left to the expiry sweeper.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers
+        self._pool = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.workers or Settings.EXPORT_WORKERS, thread_name_prefix="export")
+        return self._pool
+
+    def shutdown(self):
+        """
+            Waits for the running jobs to finish writing their exports, queued jobs are cancelled.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        pool.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for job in self._jobs.values():
+                if job.status == "queued":
+                    job.error = "Cancelled"
+                    self._finish(job, "failed")
+
+    def submit(self, job_id, results, build):
+        """
+            Starts building an export with build(file_path, results, progress),
+            unless the same export is already built or being built. Returns its job.
+        """
+        with self._lock:
+            self._forget_finished()
+            job = self._jobs.get(job_id)
+            if job is not None and (job.status in ("queued", "running") or os.path.isfile(job.file_path)):
+                return job
+
+            job = ExportJob(job_id, len(results))
+            self._jobs[job_id] = job
+            if os.path.isfile(job.file_path):
+                # Built before, possibly by an earlier process
+                self._finish(job, "done")
+                job.done = job.total
+                return job
+            self._executor().submit(self._run, job, results, build)
+            return job
+
+    def _run(self, job, results, build):
+        job.status = "running"
+        try:
+            build(job.file_path, results, job.progress)
+            self._finish(job, "done")
+        except Exception as e:
+            logging.error(f"Export job {job.id} error: {traceback.format_exc()}")
+            job.error = "Internal Server Error" if Settings.ENV_TYPE == 'production' else str(e)
+            self._finish(job, "failed")
+
+    def _finish(self, job, status):
+        job.status = status
+        job.finished = time.time()
+
+    def _forget_finished(self):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and time.time() - job.finished > Settings.EXPORT_JOB_TTL]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """
+            Returns a job by its id, or None. Exports built by a forgotten job or an
+            earlier process are reported as done.
+        """
+        if not job_id_pattern.match(job_id):
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = ExportJob(job_id, None)
+            if not os.path.isfile(job.file_path):
+                return None
+            self._finish(job, "done")
+        return job
+
+
+export_jobs = ExportJobs()
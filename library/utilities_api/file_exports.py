@@ -1,14 +1,30 @@
-from fastapi import APIRouter, Request, Body
-from fastapi.responses import FileResponse, ORJSONResponse, JSONResponse
+from fastapi import APIRouter, Request, Body, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, ORJSONResponse, JSONResponse, StreamingResponse, Response
 
 from PIL import Image as PILimg
 from PIL import ImageOps
+import csv
+import importlib.util
+import io
+import itertools
 import os
+import re
+import threading
+from contextlib import contextmanager
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import orjson
 from openpyxl import Workbook
 from openpyxl.drawing.image import Image
 
 import hashlib
+import logging
+import traceback
 from ..config import Settings
+from .storage import upload_path
+from .export_jobs import export_jobs
 
 ################ Blueprint/Namespace Configuration ################
 
@@ -20,13 +36,281 @@ storage_path = Settings.STORAGE_FOLDER
 img_path = Settings.UPLOAD_FOLDER
 isProduction = Settings.ENV_TYPE == 'production'
 
+# Created on first use, and again after shutdown_thumbnail_pool()
+_thumbnail_pool = None
+_thumbnail_lock = threading.Lock()
+
+
+def thumbnail_pool():
+    global _thumbnail_pool
+    with _thumbnail_lock:
+        if _thumbnail_pool is None:
+            _thumbnail_pool = ThreadPoolExecutor(max_workers=Settings.THUMBNAIL_WORKERS, thread_name_prefix="thumbnail")
+        return _thumbnail_pool
+
+
+def shutdown_thumbnail_pool():
+    """
+        Waits for the thumbnails being generated, queued ones are cancelled.
+    """
+    global _thumbnail_pool
+    with _thumbnail_lock:
+        pool, _thumbnail_pool = _thumbnail_pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
 
 ################ Helper Functions ################
 
-async def resize_img(path):
-    img = PILimg.open(path)
-    img = ImageOps.fit(img, (100, 100), method=PILimg.Resampling.LANCZOS)
-    img.save(path)
+def export_key(results):
+    """
+        Name of the export of a set of results, identical results share it.
+    """
+    return hashlib.md5(str(results).encode()).hexdigest()
+
+
+@contextmanager
+def write_in_place(file_path):
+    """
+        Yields a temporary path to write a file to, renamed to file_path once written so a
+        partial file is never served. The temporary file is removed if writing it fails.
+    """
+    temp_path = f"{file_path}.{threading.get_ident()}.part"
+    try:
+        yield temp_path
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def save_export(file_path, chunks):
+    """
+        Writes an export to disk from its chunks.
+    """
+    with write_in_place(file_path) as temp_path:
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+
+def csv_chunks(results, rows_per_chunk=1000, progress=None):
+    """
+        Yields a CSV of the results in encoded chunks of rows_per_chunk rows.
+        progress, if given, is called with the number of results written so far.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(["Filename", "Model", "Predictions", "Label", "Rank"])
+    rows = 0
+    for done, result in enumerate(results, start=1):
+        filename = result["name"]
+        model = result["model"]
+        for rank, (score, label) in enumerate(result["pred"], start=1):
+            writer.writerow([filename, model, score, label, rank])
+            rows += 1
+            if rows % rows_per_chunk == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        if progress is not None:
+            progress(done)
+    yield buffer.getvalue().encode()
+
+
+def build_csv(file_path, results, progress=None):
+    save_export(file_path, csv_chunks(results, progress=progress))
+
+
+def ndjson_chunks(results, rows_per_chunk=1000, progress=None):
+    """
+        Yields the results as newline delimited JSON, one result per line, in chunks of rows_per_chunk lines.
+    """
+    lines = []
+    for done, result in enumerate(results, start=1):
+        lines.append(orjson.dumps({key: result.get(key) for key in ("name", "pred", "model", "hash")}))
+        if done % rows_per_chunk == 0:
+            yield b"\n".join(lines) + b"\n"
+            lines.clear()
+        if progress is not None:
+            progress(done)
+    if lines:
+        yield b"\n".join(lines) + b"\n"
+
+
+def build_ndjson(file_path, results, progress=None):
+    save_export(file_path, ndjson_chunks(results, progress=progress))
+
+
+def has_pyarrow():
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def build_parquet(file_path, results, progress=None):
+    """
+        Writes the results to a Parquet file, one row per result with its predictions as a list of (score, label).
+        Models and labels are dictionary encoded.
+    """
+    # pyarrow is optional, only needed for Parquet exports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Predictions are flattened into one array per field, with offsets marking each result's predictions
+    lengths = np.fromiter((len(result["pred"]) for result in results), dtype=np.int32, count=len(results))
+    offsets = np.zeros(len(results) + 1, dtype=np.int32)
+    np.cumsum(lengths, out=offsets[1:])
+    preds = list(itertools.chain.from_iterable(result["pred"] for result in results))
+    scores = np.fromiter((float(score) for score, _ in preds), dtype=np.float32, count=len(preds))
+    labels = pa.array([str(label) for _, label in preds], type=pa.string()).dictionary_encode()
+
+    table = pa.table({
+        "name": pa.array([result["name"] for result in results], type=pa.string()),
+        "model": pa.array([result["model"] for result in results], type=pa.string()).dictionary_encode(),
+        "hash": pa.array([result.get("hash") for result in results], type=pa.int64()),
+        "pred": pa.ListArray.from_arrays(
+            pa.array(offsets), pa.StructArray.from_arrays([pa.array(scores), labels], names=["score", "label"])),
+    })
+    with write_in_place(file_path) as temp_path:
+        pq.write_table(table, temp_path)
+    if progress is not None:
+        progress(len(results))
+
+
+async def cached_export(results, format):
+    """
+        Builds the export of the results if it isn't on disk yet, returns its file name and path.
+    """
+    file_name = f"{export_key(results)}.{format}"
+    file_path = os.path.join(storage_path, file_name)
+    if not os.path.isfile(file_path):
+        await run_in_threadpool(export_builders[format], file_path, results)
+    else:
+        # Marks the export as recently used for the expiry sweeper
+        os.utime(file_path)
+    return file_name, file_path
+
+
+def stream_export(request, chunks, filename, media_type):
+    """
+        Sends an export as it is generated, gzip encoded when the client accepts it.
+    """
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        chunks = gzip_chunks(chunks)
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+def read_range(file_path, start, length, chunk_size=65536):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(request, file_path, media_type, filename):
+    """
+        Serves a file, or the single byte range asked for by a Range header so interrupted downloads can resume.
+    """
+    size = os.path.getsize(file_path)
+    headers = {"Accept-Ranges": "bytes"}
+    range_header = request.headers.get("range")
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip()) if range_header else None
+    # Multiple ranges aren't supported, the whole file is sent instead
+    if match is None or match.groups() == ("", ""):
+        return FileResponse(file_path, media_type=media_type, filename=filename, headers=headers)
+
+    start, end = match.groups()
+    if start == "":
+        # Suffix range, the last end bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    headers.update({
+        "Content-Range": f"bytes {start}-{end}/{size}",
+        "Content-Length": str(end - start + 1),
+        "Content-Disposition": f'attachment; filename="{filename}"',
+    })
+    return StreamingResponse(read_range(file_path, start, end - start + 1), status_code=206,
+                             media_type=media_type, headers=headers)
+
+
+def gzip_chunks(chunks):
+    """
+        Gzip compresses a stream of chunks.
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def thumbnail(path):
+    """
+        Returns the path of an upload's 100x100 thumbnail, generating it the first time it is needed.
+        Thumbnails are kept in THUMBNAIL_FOLDER, the upload itself is never modified.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    thumbnail_path = os.path.join(Settings.THUMBNAIL_FOLDER, f"{name}.png")
+    if not os.path.isfile(thumbnail_path):
+        os.makedirs(Settings.THUMBNAIL_FOLDER, exist_ok=True)
+        with PILimg.open(path) as img, write_in_place(thumbnail_path) as temp_path:
+            img = ImageOps.fit(img, (100, 100), method=PILimg.Resampling.LANCZOS)
+            img.save(temp_path, format="PNG")
+    return thumbnail_path
+
+
+def find_thumbnail(result):
+    filepath = upload_path(result["name"], result.get("hash"))
+    return thumbnail(filepath) if filepath is not None else None
+
+
+def build_xlsx(file_path, results, progress=None):
+    """
+        Writes an XLSX file of the results with a thumbnail of each image.
+        The workbook is streamed to disk in write-only mode, only the rows' thumbnail paths are kept.
+    """
+    # Thumbnails are generated in parallel, and in order as the rows are written
+    thumbnails = thumbnail_pool().map(find_thumbnail, results)
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+
+    # Write-only sheets need their column widths before the first row is written
+    max_length = max((len(str(result["name"])) for result in results), default=0)
+    ws.column_dimensions['A'].width = (max(max_length, len("Filename")) + 2) * 1.2
+    ws.column_dimensions['B'].width = 14 # Found via trial and error
+    ws.sheet_format.defaultRowHeight = 80 # Found via trial and error
+    ws.sheet_format.customHeight = True
+
+    ws.append(["Filename", "Image", "Model", "Predictions"])
+    for row, (result, thumbnail_path) in enumerate(zip(results, thumbnails), start=2):
+        pred = [item for subpred in result["pred"] for item in subpred]
+        ws.append([result["name"]]+[""]+[result["model"]]+pred)
+        if thumbnail_path is not None:
+            ws.add_image(Image(thumbnail_path), "B"+str(row))
+        if progress is not None:
+            progress(row - 1)
+
+    with write_in_place(file_path) as temp_path:
+        wb.save(temp_path)
+
+export_builders = {"xlsx": build_xlsx, "csv": build_csv, "ndjson": build_ndjson, "parquet": build_parquet}
+export_media_types = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
 
 ################ API Endpoints ################
 
@@ -42,51 +326,16 @@ async def json_to_xlsx(request: Request, results: list[dict]= Body(...)):
             if "name" not in obj or "pred" not in obj or "model" not in obj:
                 return ORJSONResponse(content={"error": "Invalid JSON"}, status_code=400)            
         # File name is based on the hash of the JSON data
-        file_name = hashlib.md5(str(results).encode()).hexdigest()
+        file_name = export_key(results)
         file_path = os.path.join(storage_path, file_name+".xlsx")
 
         # Create the file if it doesn't exist
         if not os.path.isfile(file_path):
-            wb = Workbook()
-            ws = wb.active
-            
-            # Write the data to the file
-            ws.append(["Filename","Image","Model" "Predictions"])
-            for result in results:
-                filename = result["name"]
-                pred = [item for subpred in result["pred"] for item in subpred]
-                hash = result["hash"]
-                
-                file_ext = os.path.splitext(filename)[1]
-                filename_without_ext = os.path.splitext(filename)[0]
-                filename_with_hash = f"{filename_without_ext}.{hash}{file_ext}"
-
-                ws.append([filename]+[""]+[result["model"]]+pred)
-
-                filepath = os.path.join(img_path, filename_with_hash)
-                if os.path.isfile(filepath):
-                    await resize_img(filepath)
-
-                    img = Image(filepath)
-                    ws.add_image(img, "B"+str(ws.max_row))
-            
-            #Auto adjust column width A (FILENAME)
-            max_length = 0
-            for cell in ws['A']:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = (max_length + 2) * 1.2
-            ws.column_dimensions['A'].width = adjusted_width
-
-            # Adjust column width B (IMAGE)
-            ws.column_dimensions['B'].width = 14 # Found via trial and error
-            for row in ws.iter_rows(min_row=2):
-                ws.row_dimensions[row[0].row].height = 80 # Found via trial and error
-
-            wb.save(file_path)
+            # Image and file I/O, kept off the event loop
+            await run_in_threadpool(build_xlsx, file_path, results)
+        else:
+            # Marks the export as recently used for the expiry sweeper
+            os.utime(file_path)
         return FileResponse(file_path, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", filename=file_name+".xlsx")
     except Exception as e:
         if isProduction:
@@ -95,7 +344,7 @@ async def json_to_xlsx(request: Request, results: list[dict]= Body(...)):
             return JSONResponse(content={"error": str(e)}, status_code=500)
 
 @utils_api.post('/create_csv', responses={200: {"description": "Success"}, 400: {"description": "Bad Request (Likely Invalid JSON)"}, 405: {"description": "Method Not Allowed"}, 500: {"description": "Internal Server Error"}}, tags=["Utilities"])
-async def json_to_csv(request: Request, results: list[dict]= Body(...)):
+async def json_to_csv(request: Request, results: list[dict]= Body(...), cache: bool = Query(False, description="Save the file on the server and serve it from there for identical requests.")):
     """
         Creates a CSV file from JSON prediction data
     """
@@ -103,25 +352,108 @@ async def json_to_csv(request: Request, results: list[dict]= Body(...)):
         for obj in results:
             if "name" not in obj or "pred" not in obj or "model" not in obj:
                 return ORJSONResponse(content={"error": "Invalid JSON"}, status_code=400)    
-            
-        file_name = hashlib.md5(str(results).encode()).hexdigest()
-        file_path = os.path.join(storage_path, file_name+".csv")
 
-        if not os.path.isfile(file_path):
-            with open(file_path, 'w') as f:
-                f.write("Filename,Model,Predictions,Label,Rank\n")
-                for result in results:
-                    filename = result["name"]
-                    model = result["model"]
-                    pred = [item for subpred in result["pred"] for item in subpred]
-                    for i in range(0, len(pred), 2):
-                        f.write(filename+","+model+","+pred[i]+","+pred[i+1]+f",{i//2+1}")
-                        f.write("\n")
-        return FileResponse(file_path, media_type="text/csv", filename=file_name+".csv")
+        if cache:
+            file_name, file_path = await cached_export(results, "csv")
+            return FileResponse(file_path, media_type="text/csv", filename=file_name)
+
+        # Rows are sent as they are generated, the file never exists in full
+        return stream_export(request, csv_chunks(results), "predictions.csv", "text/csv")
     except Exception as e:
         if isProduction:
             return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
         else:
             return JSONResponse(content={"error": str(e)}, status_code=500)
-           
 
+
+@utils_api.post('/create_ndjson', responses={200: {"description": "Success"}, 400: {"description": "Bad Request (Likely Invalid JSON)"}, 500: {"description": "Internal Server Error"}}, tags=["Utilities"])
+async def json_to_ndjson(request: Request, results: list[dict]= Body(...), cache: bool = Query(False, description="Save the file on the server and serve it from there for identical requests.")):
+    """
+        Creates a newline delimited JSON file from JSON prediction data, one result per line
+    """
+    try:
+        for obj in results:
+            if "name" not in obj or "pred" not in obj or "model" not in obj:
+                return ORJSONResponse(content={"error": "Invalid JSON"}, status_code=400)
+
+        if cache:
+            file_name, file_path = await cached_export(results, "ndjson")
+            return FileResponse(file_path, media_type=export_media_types["ndjson"], filename=file_name)
+        return stream_export(request, ndjson_chunks(results), "predictions.ndjson", export_media_types["ndjson"])
+    except Exception as e:
+        if isProduction:
+            return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+        else:
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@utils_api.post('/create_parquet', responses={200: {"description": "Success"}, 400: {"description": "Bad Request (Likely Invalid JSON)"}, 500: {"description": "Internal Server Error"}, 501: {"description": "Not Implemented (pyarrow is not installed)"}}, tags=["Utilities"])
+async def json_to_parquet(request: Request, results: list[dict]= Body(...)):
+    """
+        Creates a Parquet file from JSON prediction data
+    """
+    try:
+        for obj in results:
+            if "name" not in obj or "pred" not in obj or "model" not in obj:
+                return ORJSONResponse(content={"error": "Invalid JSON"}, status_code=400)
+        if not has_pyarrow():
+            return ORJSONResponse(content={"error": "Parquet exports are not available"}, status_code=501)
+
+        file_name, file_path = await cached_export(results, "parquet")
+        return FileResponse(file_path, media_type=export_media_types["parquet"], filename=file_name)
+    except Exception as e:
+        if isProduction:
+            return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+        else:
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+
+
+@utils_api.post('/exports', status_code=202, responses={202: {"description": "Accepted (Export job started)"}, 400: {"description": "Bad Request (Likely Invalid JSON)"}, 500: {"description": "Internal Server Error"}, 501: {"description": "Not Implemented (pyarrow is not installed)"}}, tags=["Utilities"])
+async def create_export(results: list[dict] = Body(...), format: str = Query("xlsx", description="Export format: xlsx, csv, ndjson or parquet.")):
+    """
+        Starts building an export of JSON prediction data in the background and returns its job
+    """
+    try:
+        for obj in results:
+            if "name" not in obj or "pred" not in obj or "model" not in obj:
+                return ORJSONResponse(content={"error": "Invalid JSON"}, status_code=400)
+        if format not in export_builders:
+            return ORJSONResponse(content={"error": "Invalid Format"}, status_code=400)
+        if format == "parquet" and not has_pyarrow():
+            return ORJSONResponse(content={"error": "Parquet exports are not available"}, status_code=501)
+
+        # Identical requests share the job, and the file, of the first one
+        job = export_jobs.submit(f"{export_key(results)}.{format}", results, export_builders[format])
+        return ORJSONResponse(content=job.info(), status_code=202)
+    except Exception as e:
+        logging.error(f"Export job error: {traceback.format_exc()}")
+        return ORJSONResponse(content={"error": "Internal Server Error"}, status_code=500)
+
+
+@utils_api.get('/exports/{job_id}', responses={200: {"description": "Success"}, 404: {"description": "Export Not Found"}}, tags=["Utilities"])
+def get_export(job_id: str):
+    """
+        Returns the status and progress of an export job
+    """
+    job = export_jobs.get(job_id)
+    if job is None:
+        return ORJSONResponse(content={"error": "Export not found"}, status_code=404)
+    return ORJSONResponse(content=job.info())
+
+
+@utils_api.get('/exports/{job_id}/download', responses={200: {"description": "Success"}, 206: {"description": "Partial Content"}, 404: {"description": "Export Not Found"}, 409: {"description": "Conflict (Export not finished)"}, 416: {"description": "Range Not Satisfiable"}}, tags=["Utilities"])
+def download_export(request: Request, job_id: str):
+    """
+        Downloads a finished export, Range requests are supported to resume interrupted downloads
+    """
+    job = export_jobs.get(job_id)
+    if job is None:
+        return ORJSONResponse(content={"error": "Export not found"}, status_code=404)
+    if job.status != "done":
+        return ORJSONResponse(content={"error": "Export not finished", "status": job.status}, status_code=409)
+    if not os.path.isfile(job.file_path):
+        return ORJSONResponse(content={"error": "Export not found"}, status_code=404)
+
+    # Marks the export as recently used for the expiry sweeper
+    os.utime(job.file_path)
+    return ranged_file_response(request, job.file_path, export_media_types[job.format], job.id)
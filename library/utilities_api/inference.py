@@ -1,52 +1,421 @@
-import imp
+import importlib.util
+import io
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image as PILImage
+
 from library.config import Settings
+from library.utilities_api.preprocessing import ImageSource, preprocess_images, stack_images, split_images
+from library.utilities_api.catalog import (ModelCatalog, model_catalog, read_labels, read_metadata, model_versions,
+                                           active_version, set_active_version, resolve_model_path)
+from library.utilities_api.backends import backends, BackendPlugin
 
 current_model = "general_insects"
 path = Settings.MODEL_FOLDER
 isProduction = Settings.ENV_TYPE == 'production'
 
-metadata_cache = {}
-keys = ["specVersion", "mlFramework", "fileTypes"]
-
 
 def get_labels(model_name="general_insects"):
-    filename = f'{path}/{model_name}/labels.txt'
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-    labels = [line.strip() for line in lines]
-    return labels
+    return model_catalog.labels(model_name).tolist()
 
 
 def get_metadata(model_name):
-    # Check if the metadata is already in the cache
-    if model_name in metadata_cache:
-        return metadata_cache[model_name]
+    return model_catalog.metadata(model_name)
+
+
+def get_model_version(model_name):
+    """
+        Identifies the version of a model's files on disk, it changes whenever
+        any file in the model's folder is replaced.
+    """
+    return model_catalog.version(model_name)
+
+
+def format_predictions(logits, labels, top_k=None):
+    """
+        Turns a batch of logits into one labelled prediction list per image,
+        keeping the top_k predictions sorted highest first.
+    """
+    logits = np.asarray(logits)
+    labels = np.asarray(labels)
+    top_k = min(top_k or Settings.DEFAULT_TOP_K, logits.shape[1])
+
+    # Only the top_k entries of each row are sorted, not the whole row
+    top_indices = np.argpartition(logits, -top_k, axis=1)[:, -top_k:]
+    top_values = np.take_along_axis(logits, top_indices, axis=1)
+    order = np.argsort(-top_values, axis=1)
+    top_indices = np.take_along_axis(top_indices, order, axis=1)
+    top_values = np.take_along_axis(top_values, order, axis=1).tolist()
+    top_labels = labels[top_indices].tolist()
+
+    return [[list(pair) for pair in zip(values, image_labels)]
+            for values, image_labels in zip(top_values, top_labels)]
+
+################ Model Registry ################
+
+
+def model_framework(model_path):
+    """
+        The framework named in a model's metadata.txt, None if it has no metadata.
+    """
+    try:
+        return read_metadata(model_path).get("mlFramework")
+    except FileNotFoundError:
+        return None
+
+
+def load_plugin(model_path, model_name, plugin):
+    """
+        Imports a model's plugin file (preprocess.py/predict.py) as its own module.
+    """
+    # Each model gets a unique module name, imp.load_source would re-execute
+    # every model's predict.py into the same 'predict' module.
+    spec = importlib.util.spec_from_file_location(
+        f"library.models.{model_name}.{plugin}", os.path.join(model_path, f"{plugin}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class LoadedModel:
+    """
+        A model held resident in memory: its plugin modules, labels and the
+        object returned by the plugin's optional load_model(path).
+    """
+
+    def __init__(self, name, model_path, version=None):
+        self.name = name
+        self.path = model_path
+        self.version = version
+        # Number of batches being predicted, a swapped out model is unloaded once it reaches 0
+        self.in_flight = 0
+        self._idle = threading.Condition()
+        self.preprocess = load_plugin(model_path, name, "preprocess")
+        # Models converted to another runtime are run by the backend instead of their predict.py
+        self.framework = model_framework(model_path)
+        if self.framework in backends:
+            self.predict = BackendPlugin(self.framework)
+        else:
+            self.predict = load_plugin(model_path, name, "predict")
+
+        self.labels = read_labels(model_path)
+        if self.framework in backends and self.labels is None:
+            raise ValueError(f"Model {name} uses the {self.framework} backend, which needs a labels.txt file")
+
+        # Plugins without load_model() fall back to loading in predict()
+        self.model = None
+        if hasattr(self.predict, "load_model"):
+            self.model = self.predict.load_model(model_path)
+        self.loaded_at = time.time()
+
+    def run(self, image, top_k=None):
+        return self.run_batch([image], top_k=top_k)[0]
+
+    @contextmanager
+    def in_use(self):
+        with self._idle:
+            self.in_flight += 1
+        try:
+            yield self
+        finally:
+            with self._idle:
+                self.in_flight -= 1
+                self._idle.notify_all()
+
+    def drain(self, timeout=None):
+        """
+            Waits until no batch is being predicted, returns False if it timed out.
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self.in_flight == 0, timeout)
+
+    def unload(self):
+        # Frees the resident model, late callers fall back to predict() loading it
+        self.model = None
+
+    def warm_up(self):
+        """
+            Predicts a synthetic image so lazily initialised parts of the model are ready before real requests.
+        """
+        width, height = getattr(self.preprocess, "INPUT_SIZE", (224, 224))
+        buffer = io.BytesIO()
+        PILImage.new("RGB", (width, height)).save(buffer, format="PNG")
+        data = buffer.getvalue()
+        # Plugins with their own img_preprocess() read the image from disk
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as file:
+            file.write(data)
+        try:
+            self.run_batch([ImageSource(file.name, data)], top_k=1)
+        finally:
+            os.remove(file.name)
+
+    def run_batch(self, images, batch_size=None, top_k=None):
+        """
+            Preprocesses every image (a path or an ImageSource) then predicts them in chunks of batch_size.
+            Returns the top_k predictions of each image, in order.
+        """
+        return self.predict_images(self.preprocess_batch(images), batch_size, top_k)
+
+    def preprocess_batch(self, images):
+        return preprocess_images(self.preprocess, images)
+
+    def predict_images(self, imgs, batch_size=None, top_k=None):
+        batch_size = batch_size or Settings.INFERENCE_BATCH_SIZE
+        top_k = top_k or Settings.DEFAULT_TOP_K
+
+        # Models returning logits are labelled here, in one go for the whole batch
+        if self.has_logits() and self.labels is not None:
+            logits = [self.logits(stack_images(imgs[i:i + batch_size]))
+                      for i in range(0, len(imgs), batch_size)]
+            return format_predictions(np.concatenate(logits, axis=0), self.labels, top_k)
+
+        # Plugins without predict_batch() are predicted one image at a time
+        if not hasattr(self.predict, "predict_batch"):
+            return [self._predict(img)[:top_k] for img in split_images(imgs)]
+
+        predictions = []
+        for i in range(0, len(imgs), batch_size):
+            # Each preprocessed image has a batch dimension of 1, stack along it
+            batch = stack_images(imgs[i:i + batch_size])
+            predictions.extend(prediction[:top_k] for prediction in self._predict_batch(batch))
+        return predictions
+
+    def has_logits(self):
+        return hasattr(self.predict, "predict_logits")
+
+    def logits(self, imgs):
+        """
+            Returns the raw model output for a stacked batch of preprocessed images.
+        """
+        if self.model is None:
+            return self.predict.predict_logits(imgs, self.path)
+        return self.predict.predict_logits(imgs, self.path, self.model)
+
+    def _predict(self, img):
+        if self.model is None:
+            return self.predict.predict(img, self.path)
+        return self.predict.predict(img, self.path, self.model)
+
+    def _predict_batch(self, imgs):
+        if self.model is None:
+            return self.predict.predict_batch(imgs, self.path)
+        return self.predict.predict_batch(imgs, self.path, self.model)
+
+    def info(self):
+        return {"name": self.name, "version": self.version, "framework": self.framework, "resident": self.model is not None,
+                "loaded_at": self.loaded_at, "in_flight": self.in_flight}
+
+
+class SwapInProgressError(Exception):
+    """
+        Raised when a model is swapped while another swap of it hasn't finished.
+    """
+    pass
+
+
+class ModelRegistry:
+    """
+        Process-wide registry of loaded models.
+        Models are loaded lazily on first use, or up front through warm_up().
+    """
+
+    def __init__(self, models_path=path):
+        self.models_path = models_path
+        # The catalog of the models folder, a registry of another folder (e.g. in tests) scans its own
+        self.catalog = model_catalog if models_path == model_catalog.models_path else ModelCatalog(models_path)
+        self._models = {}
+        self._swaps = {}
+        self._swap_locks = {}
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_name, version=None):
+        """
+            Returns a loaded model, loading its active version on first use.
+            Given a version, a different loaded version is replaced by it (used by
+            processes following a swap made in the API process).
+        """
+        model = self._models.get(model_name)
+        if model is not None and (version is None or model.version == version):
+            return model
+        model = self._load_once(model_name, version)
+        with self._lock:
+            # A swap may have put this version in place while it loaded
+            current = self._models.get(model_name)
+            if current is not None and current.version == model.version:
+                return current
+            self._models[model_name] = model
+            return model
+
+    def _load_once(self, model_name, version=None):
+        """
+            Loads a model outside of the lock, so other models stay available.
+            Concurrent loads of the same version (e.g. by a swap and the requests
+            following it) wait for the first one rather than loading it again.
+        """
+        version = version or active_version(self._folder(model_name))
+        key = (model_name, version)
+        with self._lock:
+            future = self._loading.get(key)
+            loading = future is None
+            if loading:
+                future = self._loading[key] = Future()
+        if not loading:
+            return future.result()
+        try:
+            model = self._load(model_name, version)
+            future.set_result(model)
+            return model
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+
+    def _folder(self, model_name):
+        return os.path.join(self.models_path, model_name)
+
+    def _load(self, model_name, version=None):
+        start = time.time()
+        folder = self._folder(model_name)
+        version = version or active_version(folder)
+        model = LoadedModel(model_name, resolve_model_path(folder, version), version)
+        logging.info(f"Loaded model {model_name} ({version or 'unversioned'}) in {time.time() - start:.2f}s")
+        return model
+
+    def load(self, model_name):
+        return self.get(model_name)
+
+    def reload(self, model_name, version=None):
+        # Load outside of the lock so other models stay available, then swap
+        model = self._load(model_name, version)
+        with self._lock:
+            self._models[model_name] = model
+        return model
+
+    def versions(self, model_name):
+        folder = self._folder(model_name)
+        loaded = self._models.get(model_name)
+        return {
+            "versions": model_versions(folder),
+            "active": active_version(folder),
+            "loaded": loaded.version if loaded is not None else None,
+            "swap": self._swaps.get(model_name),
+        }
+
+    def _swap_lock(self, model_name):
+        with self._lock:
+            return self._swap_locks.setdefault(model_name, threading.Lock())
+
+    def swap(self, model_name, version, drain_timeout=None):
+        """
+            Switches a model to another of its versions without dropping requests.
+            The new version is loaded and warmed up while the old one keeps serving,
+            then the active pointer is flipped and the old version is unloaded once
+            the batches it was predicting are done.
+            Raises SwapInProgressError if the model is already being swapped.
+        """
+        lock = self._swap_lock(model_name)
+        if not lock.acquire(blocking=False):
+            raise SwapInProgressError(model_name)
+        try:
+            return self._swap(model_name, version, drain_timeout)
+        finally:
+            lock.release()
+
+    def start_swap(self, model_name, version, drain_timeout=None):
+        """
+            Runs swap() in the background. Raises SwapInProgressError straight away
+            if the model is already being swapped, the swap's progress and errors are
+            reported through versions().
+        """
+        lock = self._swap_lock(model_name)
+        if not lock.acquire(blocking=False):
+            raise SwapInProgressError(model_name)
+        self._swaps[model_name] = {"version": version, "status": "loading", "error": None}
+
+        def run():
+            try:
+                self._swap(model_name, version, drain_timeout)
+            except Exception:
+                pass  # Already logged
+            finally:
+                lock.release()
+
+        threading.Thread(target=run, name=f"swap-{model_name}", daemon=True).start()
+
+    def _swap(self, model_name, version, drain_timeout=None):
+        swap = self._swaps[model_name] = {"version": version, "status": "loading", "error": None}
+        try:
+            model = self._load_once(model_name, version)
+            swap["status"] = "warming"
+            model.warm_up()
+
+            # Flipped together, a request for the new active version finds it loaded
+            with self._lock:
+                set_active_version(self._folder(model_name), version)
+                old = self._models.get(model_name)
+                self._models[model_name] = model
+            # New cache keys from here on, results of the old version aren't served anymore
+            self.catalog.refresh()
 
-    filename = f'{path}/{model_name}/metadata.txt'
-    metadata = {}
+            swap["status"] = "draining"
+            if old is not None and old is not model:
+                timeout = drain_timeout if drain_timeout is not None else Settings.MODEL_DRAIN_TIMEOUT
+                if not old.drain(timeout):
+                    logging.warning(f"Model {model_name} ({old.version}) still busy after {timeout}s, unloading anyway")
+                old.unload()
+            swap["status"] = "done"
+            logging.info(f"Swapped model {model_name} to {version}")
+            return model
+        except Exception as e:
+            swap["status"] = "failed"
+            swap["error"] = str(e)
+            logging.error(f"Failed to swap model {model_name} to {version}", exc_info=True)
+            raise
 
-    with open(filename, 'r') as file:
-        lines = file.readlines()
+    def unload(self, model_name):
+        with self._lock:
+            model = self._models.pop(model_name, None)
+        if model is not None:
+            logging.info(f"Unloaded model {model_name}")
+        return model is not None
 
-    for key, line in zip(keys, lines):
-        metadata[key] = line.strip().lower()
+    def is_loaded(self, model_name):
+        return model_name in self._models
 
-    metadata["fileTypes"] = metadata["fileTypes"].upper().strip().split(",")
-    metadata_cache[model_name] = metadata
+    def loaded_models(self):
+        return [model.info() for model in list(self._models.values())]
 
-    return metadata
+    def warm_up(self, model_names):
+        """
+            Loads the given models, "*" loads every model in the catalog.
+        """
+        if "*" in model_names:
+            model_names = self.catalog.names()
+        for model_name in model_names:
+            try:
+                self.get(model_name)
+            except Exception:
+                logging.error(f"Failed to warm up model {model_name}", exc_info=True)
 
+    def clear(self):
+        with self._lock:
+            self._models.clear()
 
-def get_prediction(image_path, current_model):
-    metadata = get_metadata(current_model)
 
-    # Preprocess the image
-    preprocess = imp.load_source(
-        'img_preprocess', f'{path}/{current_model}/preprocess.py')
-    img = preprocess.img_preprocess(image_path)
+model_registry = ModelRegistry()
 
-    # Get the prediction from the model
-    predict = imp.load_source('predict', f'{path}/{current_model}/predict.py')
-    prediction = predict.predict(img, f'{path}/{current_model}')
 
-    return prediction
+def get_predictions(images, current_model, top_k=None, version=None):
+    model = model_registry.get(current_model, version)
+    with model.in_use():
+        return model.run_batch(images, top_k=top_k)
@@ -0,0 +1,94 @@
+import io
+from typing import NamedTuple
+
+import numpy as np
+from PIL import Image
+
+# PIL resampling filters a preprocess.py can ask for through INTERPOLATION
+interpolations = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+class ImageSource(NamedTuple):
+    """
+        An image to preprocess: its path on disk and, when it is still in memory, its bytes.
+    """
+    path: str
+    data: bytes | None = None
+
+
+def is_declarative(preprocess):
+    """
+        Whether a preprocess.py declares its input instead of implementing img_preprocess().
+    """
+    return hasattr(preprocess, "INPUT_SIZE")
+
+
+def decode_image(source, size, interpolation="nearest"):
+    """
+        Decodes an image (from memory when possible) and resizes it to size (width, height).
+    """
+    if isinstance(source, ImageSource):
+        source = io.BytesIO(source.data) if source.data is not None else source.path
+    img = Image.open(source)
+
+    # JPEGs are scaled down while decoding (by up to 8x), no-op for other formats
+    img.draft("RGB", size)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if img.size != tuple(size):
+        resample = interpolations[interpolation]
+        # Large downscales are reduced in integer steps first, unless sampling the nearest pixel
+        reducing_gap = None if resample == Image.Resampling.NEAREST else 3.0
+        img = img.resize(size, resample=resample, reducing_gap=reducing_gap)
+    return img
+
+
+def preprocess_images(preprocess, sources):
+    """
+        Preprocesses a list of images for a model's preprocess.py.
+        Declarative models get a single (images, height, width, 3) float32 array,
+        other models get a list of whatever their img_preprocess() returns.
+    """
+    if not is_declarative(preprocess):
+        return [preprocess.img_preprocess(source.path if isinstance(source, ImageSource) else source)
+                for source in sources]
+
+    width, height = preprocess.INPUT_SIZE
+    scale = getattr(preprocess, "SCALE", 1 / 255.0)
+    offset = getattr(preprocess, "OFFSET", 0.0)
+    interpolation = getattr(preprocess, "INTERPOLATION", "nearest")
+
+    # Every image is written straight into one preallocated buffer
+    imgs = np.empty((len(sources), height, width, 3), dtype=np.float32)
+    for i, source in enumerate(sources):
+        with decode_image(source, (width, height), interpolation) as img:
+            imgs[i] = np.asarray(img)
+
+    # Normalise in place, no extra copies of the batch
+    imgs *= scale
+    if offset:
+        imgs += offset
+    return imgs
+
+
+def stack_images(imgs):
+    """
+        Stacks preprocessed images that each have a batch dimension of 1.
+    """
+    if isinstance(imgs, np.ndarray):
+        return imgs
+    return np.concatenate(imgs, axis=0)
+
+
+def split_images(imgs):
+    """
+        Splits preprocessed images into a list of images with a batch dimension of 1.
+    """
+    if isinstance(imgs, np.ndarray):
+        return [imgs[i:i + 1] for i in range(len(imgs))]
+    return imgs
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from library.config import Settings
+from library.utilities_api.executor import inference_executor
+
+# Upper bounds (ms) of the wait time histogram buckets
+wait_buckets = [1, 2, 5, 10, 20, 50, 100, 250, 500, 1000]
+
+
+class InferenceScheduler:
+    """
+        Queues inference requests per model and runs them together.
+        A batch is flushed once it reaches max_batch_size images or its first
+        image has waited max_wait_ms, whichever comes first.
+        Each model has up to as many batches running as its executor has workers.
+    """
+
+    def __init__(self, max_batch_size=None, max_wait_ms=None):
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._loop = None
+        self._queues = {}
+        self._workers = {}
+        self._running = set()
+        self.reset_stats()
+
+    def _batch_size(self):
+        return self.max_batch_size or Settings.INFERENCE_BATCH_SIZE
+
+    def _max_wait(self):
+        wait_ms = self.max_wait_ms if self.max_wait_ms is not None else Settings.BATCH_MAX_WAIT_MS
+        return wait_ms / 1000
+
+    def _get_queue(self, model_name):
+        loop = asyncio.get_running_loop()
+        # Queues and workers are bound to the event loop they were made on
+        if loop is not self._loop:
+            self._loop = loop
+            self._queues = {}
+            self._workers = {}
+            self._running = set()
+        if model_name not in self._queues:
+            self._queues[model_name] = asyncio.Queue()
+            self._workers[model_name] = loop.create_task(self._worker(model_name))
+        return self._queues[model_name]
+
+    async def submit(self, model_name, image, top_k=None):
+        """
+            Queues a single image and waits for its top_k predictions.
+        """
+        future = asyncio.get_running_loop().create_future()
+        top_k = top_k or Settings.DEFAULT_TOP_K
+        await self._get_queue(model_name).put((image, future, time.perf_counter(), top_k))
+        return await future
+
+    async def submit_many(self, model_name, images, top_k=None):
+        return await asyncio.gather(*(self.submit(model_name, image, top_k) for image in images))
+
+    async def _worker(self, model_name):
+        queue = self._queues[model_name]
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(inference_executor.concurrency(model_name))
+        while True:
+            # Images keep queueing while every slot is busy, so the next batch is fuller
+            await slots.acquire()
+            batch = [await queue.get()]
+            deadline = loop.time() + self._max_wait()
+            while len(batch) < self._batch_size():
+                timeout = deadline - loop.time()
+                try:
+                    if timeout > 0:
+                        batch.append(await asyncio.wait_for(queue.get(), timeout))
+                    else:
+                        # Past the deadline, only take what is already queued
+                        batch.append(queue.get_nowait())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+            task = loop.create_task(self._run_batch(model_name, batch))
+            # Tasks are only weakly referenced by the loop
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            task.add_done_callback(lambda task: slots.release())
+
+    async def _run_batch(self, model_name, batch, record=True):
+        # Requests that gave up while queued don't need predicting
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+
+        if record:
+            now = time.perf_counter()
+            self._record(model_name, len(batch), [(now - queued) * 1000 for _, _, queued, _ in batch])
+        try:
+            # Predictions are sorted, so running with the largest top_k and
+            # cutting each one down serves every request in the batch
+            predictions = await inference_executor.predict(
+                model_name, [image for image, _, _, _ in batch], max(top_k for _, _, _, top_k in batch))
+        except Exception as e:
+            logging.error(f"Batch inference error ({model_name}): {e}")
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # One bad image (e.g. an undecodable upload) fails the whole batch, each image is
+            # predicted on its own again so only the requests of the bad ones fail
+            for item in batch:
+                await self._run_batch(model_name, [item], record=False)
+            return
+
+        for (_, future, _, top_k), prediction in zip(batch, predictions):
+            if not future.done():
+                future.set_result(prediction[:top_k])
+
+    ################ Stats ################
+
+    def reset_stats(self):
+        self._batch_sizes = {}
+        self._wait_histogram = {}
+        self._wait_total = {}
+        self._wait_max = {}
+
+    def _record(self, model_name, batch_size, waits):
+        self._batch_sizes.setdefault(model_name, Counter())[batch_size] += 1
+        histogram = self._wait_histogram.setdefault(model_name, Counter())
+        for wait in waits:
+            bucket = next((str(bound) for bound in wait_buckets if wait <= bound), "inf")
+            histogram[bucket] += 1
+        self._wait_total[model_name] = self._wait_total.get(model_name, 0) + sum(waits)
+        self._wait_max[model_name] = max(self._wait_max.get(model_name, 0), max(waits))
+
+    def stats(self):
+        stats = {}
+        for model_name in set(self._queues) | set(self._batch_sizes):
+            queue = self._queues.get(model_name)
+            batch_sizes = self._batch_sizes.get(model_name, Counter())
+            requests = sum(size * count for size, count in batch_sizes.items())
+            stats[model_name] = {
+                "queue_depth": queue.qsize() if queue else 0,
+                "batches": sum(batch_sizes.values()),
+                "requests": requests,
+                "batch_sizes": {str(size): count for size, count in sorted(batch_sizes.items())},
+                "wait_ms_histogram": dict(self._wait_histogram.get(model_name, {})),
+                "wait_ms_mean": self._wait_total.get(model_name, 0) / requests if requests else 0,
+                "wait_ms_max": self._wait_max.get(model_name, 0),
+            }
+        return stats
+
+
+inference_scheduler = InferenceScheduler()
@@ -0,0 +1,187 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from werkzeug.utils import secure_filename
+
+from library.config import Settings
+
+
+class BlobStore:
+    """
+        Content addressed store for uploads.
+        Each distinct file is stored once as blobs/ab/cd/<sha256><ext>, and an SQLite
+        index maps every (filename, hash) it was uploaded as to its blob.
+        Blobs are reference counted by the names pointing at them.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or Settings.BLOB_FOLDER
+        self.db_path = os.path.join(self.root, "index.db")
+        self._local = threading.local()
+        self.writes = 0
+        self.deduplicated = 0
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads, each thread opens its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(self.root, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "digest TEXT PRIMARY KEY, ext TEXT, size INTEGER, refcount INTEGER, created REAL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS names ("
+                "name TEXT, hash INTEGER, digest TEXT, expiry_time REAL, PRIMARY KEY (name, hash))")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_names_expiry_time ON names (expiry_time)")
+            self._local.connection = connection
+        return connection
+
+    def blob_path(self, digest, ext):
+        # Two levels of sharding keep every directory small
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}{ext}")
+
+    def _write(self, path, data, temp_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if temp_path is None:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".part", delete=False) as temp:
+                temp.write(data)
+            temp_path = temp.name
+        # Renamed into place, a partially written blob is never visible
+        os.replace(temp_path, path)
+
+    def put(self, name, hash, digest, size, data=None, temp_path=None, expiry_time=None):
+        """
+            Stores an upload under (name, hash) from its bytes or a temporary file.
+            The blob is only written if no upload had the same content before,
+            any temporary file is consumed either way. Returns the blob's path.
+        """
+        name = secure_filename(name)
+        ext = os.path.splitext(name)[1].lower()
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT ext FROM blobs WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                path = self.blob_path(digest, ext)
+                self._write(path, data, temp_path)
+                temp_path = None
+                connection.execute("INSERT INTO blobs VALUES (?, ?, ?, 0, ?)", (digest, ext, size, time.time()))
+                self.writes += 1
+            else:
+                path = self.blob_path(digest, row[0])
+                self.deduplicated += 1
+
+            previous = connection.execute(
+                "SELECT digest FROM names WHERE name = ? AND hash = ?", (name, hash)).fetchone()
+            if previous is None:
+                connection.execute("INSERT INTO names VALUES (?, ?, ?, ?)", (name, hash, digest, expiry_time))
+                connection.execute("UPDATE blobs SET refcount = refcount + 1 WHERE digest = ?", (digest,))
+            else:
+                # Uploaded under this name before, only its expiry moves
+                connection.execute(
+                    "UPDATE names SET expiry_time = MAX(COALESCE(expiry_time, 0), ?) WHERE name = ? AND hash = ?",
+                    (expiry_time or 0, name, hash))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            if temp_path is not None:
+                os.remove(temp_path)
+        return path
+
+    def extend_expiry(self, keys, expiry_time):
+        """
+            Keeps the uploads named by (name, hash) keys at least until expiry_time.
+        """
+        connection = self._connection()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(
+                "UPDATE names SET expiry_time = MAX(COALESCE(expiry_time, 0), ?) WHERE name = ? AND hash = ?",
+                [(expiry_time, secure_filename(name), hash) for name, hash in keys])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def path(self, name, hash):
+        """
+            Returns the path of the blob uploaded as (name, hash), or None.
+        """
+        row = self._connection().execute(
+            "SELECT blobs.digest, blobs.ext FROM names JOIN blobs ON names.digest = blobs.digest "
+            "WHERE names.name = ? AND names.hash = ?", (secure_filename(name), hash)).fetchone()
+        return self.blob_path(*row) if row else None
+
+    def remove(self, name, hash):
+        """
+            Removes the name (name, hash), deleting its blob once no name points at it.
+            Returns the number of bytes freed.
+        """
+        connection = self._connection()
+        freed = 0
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute(
+                "SELECT digest FROM names WHERE name = ? AND hash = ?", (secure_filename(name), hash)).fetchone()
+            if row is not None:
+                digest = row[0]
+                connection.execute("DELETE FROM names WHERE name = ? AND hash = ?", (secure_filename(name), hash))
+                connection.execute("UPDATE blobs SET refcount = refcount - 1 WHERE digest = ?", (digest,))
+                blob = connection.execute(
+                    "SELECT ext, size FROM blobs WHERE digest = ? AND refcount <= 0", (digest,)).fetchone()
+                if blob is not None:
+                    connection.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                    path, freed = self.blob_path(digest, blob[0]), blob[1]
+                    # Deleted while holding the write lock, a concurrent put of the same content
+                    # waits for the COMMIT and then writes the blob again rather than losing it
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        logging.warning(f"Blob {path} was already deleted")
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return freed
+
+    def stats(self):
+        connection = self._connection()
+        blobs, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        return {
+            "blobs": blobs,
+            "bytes": size,
+            "names": connection.execute("SELECT COUNT(*) FROM names").fetchone()[0],
+            "writes": self.writes,
+            "deduplicated": self.deduplicated,
+        }
+
+
+blob_store = BlobStore()
+
+
+def upload_path(name, hash):
+    """
+        Finds an upload by the name and hash it was uploaded with.
+        Uploads saved before the blob store are found under their old {name}.{hash}{ext} path.
+    """
+    try:
+        path = blob_store.path(name, int(hash))
+    except (TypeError, ValueError):
+        return None
+    if path is not None and os.path.isfile(path):
+        return path
+
+    filename = secure_filename(name)
+    filename_without_ext, file_ext = os.path.splitext(filename)
+    legacy_path = os.path.join(Settings.UPLOAD_FOLDER, f"{filename_without_ext}.{hash}{file_ext}")
+    return legacy_path if os.path.isfile(legacy_path) else None
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+
+from sqlalchemy import delete, select
+
+from library.config import Settings
+from library.database import models
+from library.database.database import SessionLocal
+from library.utilities_api.storage import blob_store
+
+# Exports the sweeper manages in STORAGE_FOLDER
+export_extensions = (".xlsx", ".csv", ".ndjson", ".parquet")
+
+
+class ExpirySweeper:
+    """
+        Background task that deletes expired uploads, expired image rows and the
+        least recently used exports past EXPORT_CACHE_MAX_BYTES.
+        Expired rows and uploads are deleted through their expiry_time indexes, in
+        batches of batch_size so a single sweep never holds a lock for long.
+    """
+
+    def __init__(self, interval=None, batch_size=None, sweep_database=True):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.sweep_database = sweep_database
+        self._task = None
+        self.runs = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_bytes_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.rows_deleted = 0
+        self.uploads_deleted = 0
+        self.exports_deleted = 0
+
+    def _interval(self):
+        return self.interval if self.interval is not None else Settings.SWEEP_INTERVAL
+
+    def _batch_size(self):
+        return self.batch_size or Settings.SWEEP_BATCH_SIZE
+
+    ################ Sweeps ################
+
+    def sweep(self):
+        """
+            Runs a full sweep, returns the number of bytes reclaimed.
+        """
+        start = time.perf_counter()
+        now = time.time()
+        reclaimed = self.sweep_uploads(now) + self.sweep_exports()
+        if self.sweep_database:
+            self.sweep_images(now)
+
+        self.runs += 1
+        self.last_run = now
+        self.last_duration = time.perf_counter() - start
+        self.last_bytes_reclaimed = reclaimed
+        self.bytes_reclaimed += reclaimed
+        logging.info(f"Expiry sweep reclaimed {reclaimed} bytes in {self.last_duration:.3f}s")
+        return reclaimed
+
+    def sweep_images(self, now):
+        """
+            Deletes expired image rows, batch by batch.
+        """
+        while True:
+            with SessionLocal() as db:
+                ids = db.scalars(
+                    select(models.Image.id).where(models.Image.expiry_time < now).limit(self._batch_size())).all()
+                if not ids:
+                    return
+                db.execute(delete(models.Image).where(models.Image.id.in_(ids)))
+                db.commit()
+            self.rows_deleted += len(ids)
+
+    def sweep_uploads(self, now):
+        """
+            Deletes expired upload names, and blobs no name points at anymore.
+        """
+        reclaimed = 0
+        connection = blob_store._connection()
+        while True:
+            names = connection.execute(
+                "SELECT name, hash FROM names WHERE expiry_time < ? LIMIT ?", (now, self._batch_size())).fetchall()
+            if not names:
+                break
+            for name, hash in names:
+                reclaimed += blob_store.remove(name, hash)
+            self.uploads_deleted += len(names)
+
+        # Uploads saved before the blob store, temporary files left by interrupted uploads and old thumbnails
+        image_extensions = tuple(f".{ext.lower()}" for ext in Settings.ALLOWED_IMAGE_EXTENSIONS)
+        reclaimed += self._sweep_files(
+            Settings.UPLOAD_FOLDER, now - Settings.IMAGE_DEFAULT_EXPIRY_PERIOD, extensions=image_extensions)
+        # Temporary files are written next to their blob, in the shard directories too
+        reclaimed += self._sweep_files(
+            blob_store.root, now - Settings.SWEEP_TEMP_FILE_GRACE_PERIOD, extensions=(".part",), recursive=True)
+        reclaimed += self._sweep_files(
+            Settings.THUMBNAIL_FOLDER, now - Settings.IMAGE_DEFAULT_EXPIRY_PERIOD, extensions=(".png", ".part"))
+        return reclaimed
+
+    def _sweep_files(self, directory, before, extensions=None, recursive=False):
+        reclaimed = 0
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            if recursive and entry.is_dir(follow_symlinks=False):
+                reclaimed += self._sweep_files(entry.path, before, extensions, recursive)
+                continue
+            if not entry.is_file() or (extensions and not entry.name.lower().endswith(extensions)):
+                continue
+            stat = entry.stat()
+            if stat.st_mtime < before:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    # Renamed into place or removed by its upload in the meantime
+                    continue
+                reclaimed += stat.st_size
+        return reclaimed
+
+    def sweep_exports(self):
+        """
+            Deletes the least recently used exports until they fit in EXPORT_CACHE_MAX_BYTES,
+            and temporary files left by exports that were interrupted.
+        """
+        reclaimed = self._sweep_files(
+            Settings.STORAGE_FOLDER, time.time() - Settings.SWEEP_TEMP_FILE_GRACE_PERIOD, extensions=(".part",))
+        try:
+            exports = [(entry.path, entry.stat()) for entry in os.scandir(Settings.STORAGE_FOLDER)
+                       if entry.is_file() and entry.name.endswith(export_extensions)]
+        except FileNotFoundError:
+            return reclaimed
+
+        size = sum(stat.st_size for _, stat in exports)
+        # Exports are touched whenever they are served, so mtime orders them by use
+        for path, stat in sorted(exports, key=lambda export: export[1].st_mtime):
+            if size <= Settings.EXPORT_CACHE_MAX_BYTES:
+                break
+            os.remove(path)
+            size -= stat.st_size
+            reclaimed += stat.st_size
+            self.exports_deleted += 1
+        return reclaimed
+
+    ################ Scheduling ################
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                # File and database I/O, kept off the event loop
+                await loop.run_in_executor(None, self.sweep)
+            except Exception:
+                logging.error(f"Expiry sweep error: {traceback.format_exc()}")
+            await asyncio.sleep(self._interval())
+
+    def start(self):
+        if self._task is None and self._interval() > 0:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "running": self._task is not None,
+            "interval": self._interval(),
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_duration": self.last_duration,
+            "last_bytes_reclaimed": self.last_bytes_reclaimed,
+            "bytes_reclaimed": self.bytes_reclaimed,
+            "rows_deleted": self.rows_deleted,
+            "uploads_deleted": self.uploads_deleted,
+            "exports_deleted": self.exports_deleted,
+        }
+
+
+expiry_sweeper = ExpirySweeper()
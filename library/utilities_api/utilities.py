@@ -1,15 +1,30 @@
-from fastapi import APIRouter, UploadFile, Query, WebSocket
+from fastapi import APIRouter, UploadFile, Query, WebSocket, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import ORJSONResponse, JSONResponse, FileResponse
 from werkzeug.utils import secure_filename
 import mmh3
 import shutil
 import logging
+import tempfile
+import hashlib
+import asyncio
+import uuid
 
 import sys
 import os
 from library.config import Settings
 
-from library.utilities_api.inference import get_prediction, get_metadata
+from library.utilities_api.inference import get_metadata, get_model_version
+from library.utilities_api.catalog import model_catalog
+from library.utilities_api.cache import InferenceCache, PersistentCache
+from library.utilities_api.preprocessing import ImageSource
+from library.utilities_api.storage import blob_store, upload_path
+from library.utilities_api.scheduler import inference_scheduler
+from library.utilities_api.executor import inference_executor, QueueFullError
+from library.auth_api.cache import Principal
+from library.auth_api.principals import optional_principal
+from library.database.database import AsyncSessionLocal, get_async_engine
+from library.database import async_crud
 import time
 import traceback
 
@@ -21,7 +36,12 @@ img_path = Settings.UPLOAD_FOLDER
 models_path = Settings.MODEL_FOLDER
 isProduction = Settings.ENV_TYPE == 'production'
 
-inference_cache = {}
+inference_cache = InferenceCache(
+    persistent=PersistentCache() if Settings.PERSISTENT_CACHE else None)
+
+# Cache prewarm jobs by id, the most recent ones are kept
+prewarm_jobs = {}
+prewarm_tasks = set()
 
 ################ Helper Functions ################
 
@@ -35,63 +55,221 @@ def is_file_allowed(filename, model=None):
         return False
     ext = filename.rsplit(".", 1)[1]
     if model:
-        return ext.upper() in get_metadata(model)["fileTypes"]
+        return ext.upper() in model_catalog.file_types(model)
     else:
         return ext.upper() in Settings.ALLOWED_IMAGE_EXTENSIONS
 
+
+def read_upload(file):
+    """
+        Reads an upload once, in chunks, hashing it as it goes.
+        Uploads up to UPLOAD_MEMORY_LIMIT bytes are kept in memory, larger ones are
+        spilled to a temporary file next to the blob store instead.
+        Returns (hash, digest, size, data, temp_path), only one of data and temp_path is set.
+    """
+    hasher = mmh3.mmh3_32()
+    digest = hashlib.sha256()
+    chunks = []
+    size = 0
+    temp = None
+    file.file.seek(0)  # Ensure we're at the start of the file
+    try:
+        while chunk := file.file.read(Settings.UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+            if temp is not None:
+                temp.write(chunk)
+                continue
+            chunks.append(chunk)
+            if size > Settings.UPLOAD_MEMORY_LIMIT:
+                os.makedirs(blob_store.root, exist_ok=True)
+                temp = tempfile.NamedTemporaryFile(dir=blob_store.root, suffix=".part", delete=False)
+                temp.writelines(chunks)
+                chunks = None
+    except BaseException:
+        if temp is not None:
+            temp.close()
+            os.remove(temp.name)
+        raise
+
+    # sintdigest() is the same value mmh3.hash() returns for the whole file
+    if temp is None:
+        return hasher.sintdigest(), digest.hexdigest(), size, b"".join(chunks), None
+    temp.close()
+    return hasher.sintdigest(), digest.hexdigest(), size, None, temp.name
+
+
+def save_uploads(files, model, top_k):
+    """
+        Serves cached predictions and saves the rest of the uploads to the blob store.
+        Returns the results in upload order and the (image, result, digest) triples still to be predicted.
+    """
+    returnList = []
+    uncached = []
+    version = get_model_version(model)
+
+    for file in files:
+        # Hash the file in the same pass that reads it
+        hash, digest, size, data, temp_path = read_upload(file)
+
+        result = {"name": file.filename, "pred": None, "hash": hash, "model": model}
+        returnList.append(result)
+
+        # Stored even when its prediction is cached, so the upload can be fetched (and exported) under
+        # this name. Content already in the store isn't written again, only its name is added
+        file_path = blob_store.put(
+            file.filename, hash, digest, size, data, temp_path,
+            expiry_time=int(time.time()) + Settings.IMAGE_DEFAULT_EXPIRY_PERIOD)
+
+        # Keyed on the SHA-256 digest, two images sharing a 32 bit hash would get each other's predictions
+        prediction = inference_cache.get(inference_cache.key(digest, model, version, top_k))
+        if prediction is not None:
+            logging.info(
+                f"Inference Cache Hit: Served {hash} ({file.filename})")
+            result["pred"] = prediction
+        else:
+            logging.info(
+                f"Inference Cache Miss: Inferered {hash} ({file.filename})")
+            # Small images are decoded from the bytes already in memory, large ones from disk
+            uncached.append((ImageSource(file_path, data), result, digest))
+
+    return returnList, uncached, version
+
+
+async def record_uploads(principal, results):
+    """
+        Records a signed in user's uploads in one transaction, and keeps their files for as long as the records.
+    """
+    try:
+        images = [(result["hash"], result["name"]) for result in results]
+        get_async_engine()
+        async with AsyncSessionLocal() as db:
+            expiry_time = await async_crud.create_images(db, images, principal.id)
+        await run_in_threadpool(
+            blob_store.extend_expiry, [(name, hash) for hash, name in images], expiry_time)
+    except Exception:
+        # The predictions are still returned
+        logging.error(f"Upload record error: {traceback.format_exc()}")
+
+
+def prewarm_files(directory, model):
+    """
+        The paths of the images in a directory the model accepts, by name.
+    """
+    return [entry.path for entry in sorted(os.scandir(directory), key=lambda entry: entry.name)
+            if entry.is_file() and is_file_allowed(entry.name, model)]
+
+
+def read_prewarm_batch(paths, model, version, top_k):
+    """
+        Reads and hashes images, returns the (image, digest) pairs of those not cached yet.
+    """
+    batch = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        if inference_cache.get(inference_cache.key(digest, model, version, top_k)) is None:
+            batch.append((ImageSource(path, data), digest))
+    return batch
+
+
+async def prewarm_cache(job, paths, model, top_k):
+    """
+        Predicts the images that aren't cached yet batch by batch, through the scheduler like
+        uploads are, and caches them. Each batch waits for room in the inference queue, so
+        prewarming never gets requests rejected.
+    """
+    job["status"] = "running"
+    try:
+        version = get_model_version(model)
+        for i in range(0, len(paths), Settings.INFERENCE_BATCH_SIZE):
+            batch = await run_in_threadpool(
+                read_prewarm_batch, paths[i:i + Settings.INFERENCE_BATCH_SIZE], model, version, top_k)
+            if batch:
+                while not inference_executor.try_reserve(len(batch)):
+                    await asyncio.sleep(0.1)
+                try:
+                    predictions = await inference_scheduler.submit_many(model, [image for image, _ in batch], top_k)
+                finally:
+                    inference_executor.release(len(batch))
+                for (_, digest), prediction in zip(batch, predictions):
+                    inference_cache.put(inference_cache.key(digest, model, version, top_k), prediction)
+                job["predicted"] += len(batch)
+            job["done"] = min(i + Settings.INFERENCE_BATCH_SIZE, len(paths))
+        job["status"] = "done"
+        logging.info(f"Prewarmed inference cache with {job['predicted']} images from {job['directory']} ({model})")
+    except Exception as e:
+        logging.error(f"Cache prewarm error: {traceback.format_exc()}")
+        job["status"] = "failed"
+        job["error"] = "Internal Server Error" if isProduction else str(e)
+
+
+async def start_prewarm(directory, model, top_k):
+    """
+        Starts prewarming the inference cache with the images of a directory in the background.
+        Returns the job, its progress is updated as it runs.
+    """
+    paths = await run_in_threadpool(prewarm_files, directory, model)
+    job = {"id": uuid.uuid4().hex, "directory": directory, "model": model, "status": "queued",
+           "images": len(paths), "done": 0, "predicted": 0, "error": None}
+    prewarm_jobs[job["id"]] = job
+    while len(prewarm_jobs) > 100:
+        del prewarm_jobs[next(iter(prewarm_jobs))]
+
+    task = asyncio.get_running_loop().create_task(prewarm_cache(job, paths, model, top_k))
+    # Tasks are only weakly referenced by the loop
+    prewarm_tasks.add(task)
+    task.add_done_callback(prewarm_tasks.discard)
+    return job
+
 ################ API Endpoints ################
 
 
-@utils_api.post('/image_inference', responses={200: {"description": "Success"}, 400: {"description": "Bad Request"}, 405: {"description": "Method Not Allowed"}, 500: {"description": "Internal Server Error"}}, tags=["Utilities"])
+@utils_api.post('/image_inference', responses={200: {"description": "Success"}, 400: {"description": "Bad Request"}, 405: {"description": "Method Not Allowed"}, 500: {"description": "Internal Server Error"}, 503: {"description": "Service Unavailable (Inference queue is full)"}}, tags=["Utilities"])
 # NOTE: currently files does not support documenation:
 # Intended documentation: "List of files to upload"
-def get_inference(files: list[UploadFile], model: str | None = Query(None, description="Model to use for prediction.")):
+async def get_inference(files: list[UploadFile], model: str | None = Query(None, description="Model to use for prediction."), top_k: int = Query(Settings.DEFAULT_TOP_K, ge=1, le=Settings.MAX_TOP_K, description="Number of predictions to return per image."), principal: Principal | None = Depends(optional_principal)):
     """
      Takes in a list of Image files and returns a list of predictions in JSON format.
+     Uploads of signed in users (with a bearer token) are recorded against their account.
     """
     try:
         # Checks if the model is valid before uploading
-        if not model or model not in available_models():
+        if not model or model not in model_catalog:
             return ORJSONResponse(content={"error": "Invalid Model"}, status_code=400)
-        returnList = []
 
+        # Check if the file extensions are allowed
         for file in files:
-            # Check if the file extension is allowed
             if not is_file_allowed(file.filename, model):
                 return ORJSONResponse(content={"error": "File type not allowed"}, status_code=405)
 
-            # Get the hash of the file
-            file.file.seek(0)  # Ensure we're at the start of the file
-            hash = mmh3.hash(file.file.read())
-
-            if (hash, file.filename) in inference_cache and time.time() - inference_cache[(hash, file.filename)]["time"] < Settings.CACHE_TIMEOUT_PERIOD:
-                logging.info(
-                    f"Inference Cache Hit: Served {hash} ({file.filename})")
-                del inference_cache[(hash, file.filename)]["time"]
-                returnList.append(inference_cache[(hash, file.filename)])
-                inference_cache[(hash, file.filename)]["time"] = time.time()
-            else:
-                logging.info(
-                    f"Inference Cache Miss: Inferered {hash} ({file.filename})")
-                file_path = os.path.join(
-                    img_path, secure_filename(file.filename))
-                file_ext = os.path.splitext(file_path)[1]
-                filename_without_ext = os.path.splitext(
-                    secure_filename(file.filename))[0]
-                file_path = os.path.join(
-                    img_path, f"{filename_without_ext}.{str(hash)}{file_ext}")
-
-                # Save the file to disk
-                with open(file_path, "wb") as buffer:
-                    file.file.seek(0)  # Go back to the start of the file
-                    shutil.copyfileobj(file.file, buffer)
-
-                # Get the prediction
-                prediction = get_prediction(file_path, model)
-                inference_cache[(hash, file.filename)] = {
-                    "name": file.filename, "pred": prediction, "hash": hash, "model": model, "time": time.time()}
-                returnList.append(
-                    {"name": file.filename, "pred": prediction, "hash": hash, "model": model})
+        # Refuse the request up front rather than queueing unbounded work
+        try:
+            inference_executor.reserve(len(files))
+        except QueueFullError:
+            logging.warning(f"Inference queue full: Rejected {len(files)} files")
+            return ORJSONResponse(content={"error": "Server Busy"}, status_code=503,
+                                  headers={"Retry-After": str(Settings.INFERENCE_RETRY_AFTER)})
+
+        try:
+            # Hashing and saving is blocking file I/O, keep it off the event loop
+            # (and off the inference pool, so it doesn't take threads models are waiting for)
+            returnList, uncached, version = await run_in_threadpool(save_uploads, files, model, top_k)
+
+            if uncached:
+                # Queued with other requests' images and predicted together
+                predictions = await inference_scheduler.submit_many(
+                    model, [image for image, _, _ in uncached], top_k)
+                for (_, result, digest), prediction in zip(uncached, predictions):
+                    result["pred"] = prediction
+                    inference_cache.put(inference_cache.key(digest, model, version, top_k), prediction)
+        finally:
+            inference_executor.release(len(files))
+
+        if principal is not None:
+            await record_uploads(principal, returnList)
 
         return JSONResponse(content=returnList)
     except Exception as e:
@@ -100,9 +278,7 @@ def get_inference(files: list[UploadFile], model: str | None = Query(None, descr
 
 
 def available_models():
-    subfolders = [os.path.basename(f.path)
-                  for f in os.scandir(models_path) if f.is_dir()]
-    return sorted(subfolders, key=str.lower)
+    return model_catalog.names()
 
 
 @utils_api.get('/available_models', tags=["Utilities"])
@@ -115,7 +291,7 @@ def get_available_models():
 
 @utils_api.get('/model_file_types', tags=["Utilities"])
 def get_model_file_types(model_name: str):
-    if model_name in available_models():
+    if model_name in model_catalog:
         return get_metadata(model_name)["fileTypes"]
     else:
         return {"error": "Invalid Model"}
@@ -127,14 +303,9 @@ def get_image(image_name: str, hash: str):
         Returns an image from the uploads folder.
     """
     try:
-        filename = secure_filename(image_name)
-        file_ext = os.path.splitext(filename)[1]
-        filename_without_ext = os.path.splitext(filename)[0]
-        filename_with_hash = f"{filename_without_ext}.{hash}{file_ext}"
-
-        filepath = os.path.join(img_path, filename_with_hash)
+        filepath = upload_path(image_name, hash)
 
-        if not os.path.isfile(filepath) or is_file_allowed(filename) == False:
+        if filepath is None or is_file_allowed(secure_filename(image_name)) == False:
             return {"error": "File not found"}
 
         return FileResponse(filepath)
@@ -0,0 +1,281 @@
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from library.config import Settings
+from library.utilities_api.inference import ModelRegistry, load_plugin, format_predictions
+from library.utilities_api.catalog import active_version, resolve_model_path, read_labels
+from library.utilities_api.preprocessing import preprocess_images, stack_images, split_images
+
+################ Worker Process ################
+
+
+def to_shared_memory(array):
+    """
+        Copies an array into a new shared memory block, returns the block.
+    """
+    shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm
+
+
+def from_shared_memory(name, shape, dtype, unlink=False):
+    """
+        Copies an array out of a shared memory block, optionally freeing the block.
+    """
+    shm = SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def worker_main(worker_id, models_path, task_queue, result_queue, max_jobs):
+    """
+        Entry point of a worker process. Keeps its own resident models and serves
+        jobs until it is told to stop or has served max_jobs jobs.
+    """
+    model_registry = ModelRegistry(models_path)
+    if Settings.PRELOAD_MODELS:
+        model_registry.warm_up(Settings.PRELOAD_MODELS)
+
+    jobs = 0
+    while True:
+        job = task_queue.get()
+        if job is None:
+            break
+        job_id, model_name, version, shm_name, shape, dtype, top_k = job
+        shm = imgs = logits = None
+        try:
+            # Read the images straight out of the API process' block, no copy
+            shm = SharedMemory(name=shm_name)
+            imgs = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            # A job for another version than the loaded one follows a model swap
+            model = model_registry.get(model_name, version)
+            if model.has_logits():
+                logits = np.asarray(model.logits(imgs), dtype=np.float32)
+                out = to_shared_memory(logits)
+                # The API process unlinks the block once it has read the logits
+                result_queue.put((job_id, worker_id, "logits", (out.name, logits.shape, logits.dtype.str)))
+                out.close()
+            else:
+                # Plugins without predict_logits() send back their formatted predictions
+                predictions = model.predict_images(split_images(imgs), top_k=top_k)
+                result_queue.put((job_id, worker_id, "predictions", predictions))
+        except Exception:
+            result_queue.put((job_id, worker_id, "error", traceback.format_exc()))
+        finally:
+            # Views into the block must be gone before it can be closed
+            imgs = logits = None
+            if shm is not None:
+                shm.close()
+
+        jobs += 1
+        if max_jobs and jobs >= max_jobs:
+            # Exit to be recycled by the pool, this returns any memory the models grew into
+            break
+
+################ Worker Pool ################
+
+
+class WorkerCrashedError(Exception):
+    pass
+
+
+class InferenceWorkerPool:
+    """
+        Supervised pool of inference processes fed by the API process.
+        Preprocessed images and logits are handed over through shared memory,
+        only job descriptions travel through the queues.
+        Crashed workers are restarted, and workers are recycled after max_jobs jobs.
+    """
+
+    def __init__(self, processes=None, max_jobs=None, models_path=None):
+        self.processes = processes
+        self.models_path = models_path or Settings.MODEL_FOLDER
+        self.max_jobs = max_jobs
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._workers = {}
+        self._preprocessors = {}
+        self._labels = {}
+        self._result_queue = None
+        self._supervisor = None
+        self._running = False
+        self.restarts = 0
+        self.recycles = 0
+        self.jobs = 0
+
+    def _processes(self):
+        return self.processes or Settings.INFERENCE_PROCESSES
+
+    def _max_jobs(self):
+        return self.max_jobs if self.max_jobs is not None else Settings.WORKER_MAX_JOBS
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._result_queue = self._context.Queue()
+            for worker_id in range(self._processes()):
+                self._start_worker(worker_id)
+            self._supervisor = threading.Thread(
+                target=self._supervise, name="inference-supervisor", daemon=True)
+            self._supervisor.start()
+
+    def _start_worker(self, worker_id):
+        task_queue = self._context.Queue()
+        process = self._context.Process(
+            target=worker_main, args=(worker_id, self.models_path, task_queue, self._result_queue, self._max_jobs()),
+            name=f"inference-worker-{worker_id}", daemon=True)
+        process.start()
+        # jobs maps job_id -> (job, future) for the jobs sent to this worker
+        self._workers[worker_id] = {"process": process, "queue": task_queue, "jobs": {}}
+
+    def stop(self):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            workers = list(self._workers.values())
+            self._workers = {}
+        for worker in workers:
+            worker["queue"].put(None)
+        for worker in workers:
+            worker["process"].join(timeout=5)
+            if worker["process"].is_alive():
+                worker["process"].kill()
+            for job, future in worker["jobs"].values():
+                self._fail(job, future, WorkerCrashedError("Worker pool stopped"))
+
+    ################ Jobs ################
+
+    def _preprocessor(self, model_name, version):
+        # Only the preprocess plugin and labels are needed in the API process
+        if (model_name, version) not in self._preprocessors:
+            model_path = resolve_model_path(os.path.join(self.models_path, model_name), version)
+            self._preprocessors[(model_name, version)] = load_plugin(model_path, model_name, "preprocess")
+        return self._preprocessors[(model_name, version)]
+
+    def _get_labels(self, model_name, version):
+        if (model_name, version) not in self._labels:
+            model_path = resolve_model_path(os.path.join(self.models_path, model_name), version)
+            self._labels[(model_name, version)] = read_labels(model_path)
+        return self._labels[(model_name, version)]
+
+    def predict(self, model_name, images, top_k=None):
+        """
+            Preprocesses the images in this process and predicts them on a worker.
+            Blocks until the predictions are back.
+        """
+        self.start()
+        version = active_version(os.path.join(self.models_path, model_name))
+        imgs = stack_images(preprocess_images(self._preprocessor(model_name, version), images))
+        imgs = np.ascontiguousarray(imgs, dtype=np.float32)
+
+        shm = to_shared_memory(imgs)
+        job = (next(self._job_ids), model_name, version, shm.name, imgs.shape, imgs.dtype.str, top_k)
+        future = Future()
+        try:
+            self._dispatch(job, future)
+            kind, result = future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+        if kind == "logits":
+            return format_predictions(from_shared_memory(*result, unlink=True), self._get_labels(model_name, version), top_k)
+        return result
+
+    def _dispatch(self, job, future):
+        with self._lock:
+            if not self._workers:
+                raise WorkerCrashedError("No inference workers are running")
+            # Send the job to the least busy worker
+            worker = min(self._workers.values(), key=lambda worker: len(worker["jobs"]))
+            worker["jobs"][job[0]] = (job, future)
+            worker["queue"].put(job)
+
+    def _fail(self, job, future, error):
+        if not future.done():
+            future.set_exception(error)
+
+    ################ Supervision ################
+
+    def _supervise(self):
+        while self._running:
+            try:
+                self._complete(*self._result_queue.get(timeout=0.5))
+                # Drain every result before checking on the workers, so a worker
+                # that exited after its last job isn't mistaken for one with work left
+                while True:
+                    self._complete(*self._result_queue.get_nowait())
+            except queue.Empty:
+                pass
+            except Exception:
+                logging.error(f"Inference supervisor error: {traceback.format_exc()}")
+            self._check_workers()
+
+    def _complete(self, job_id, worker_id, kind, result):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            job, future = worker["jobs"].pop(job_id) if worker and job_id in worker["jobs"] else (None, None)
+        if future is None:
+            # The job already failed, free the logits nobody is waiting for
+            if kind == "logits":
+                from_shared_memory(*result, unlink=True)
+            return
+        self.jobs += 1
+        if kind == "error":
+            future.set_exception(RuntimeError(result))
+        else:
+            future.set_result((kind, result))
+
+    def _check_workers(self):
+        with self._lock:
+            if not self._running:
+                return
+            dead = [(worker_id, worker) for worker_id, worker in self._workers.items()
+                    if not worker["process"].is_alive()]
+            for worker_id, worker in dead:
+                exitcode = worker["process"].exitcode
+                if exitcode == 0:
+                    self.recycles += 1
+                    logging.info(f"Recycling inference worker {worker_id}")
+                else:
+                    self.restarts += 1
+                    logging.error(f"Inference worker {worker_id} crashed (exit code {exitcode}), restarting")
+                self._start_worker(worker_id)
+
+                for job, future in worker["jobs"].values():
+                    if exitcode == 0:
+                        # Recycled with jobs still queued, hand them to the new worker
+                        self._workers[worker_id]["jobs"][job[0]] = (job, future)
+                        self._workers[worker_id]["queue"].put(job)
+                    else:
+                        self._fail(job, future, WorkerCrashedError(f"Inference worker {worker_id} crashed"))
+
+    def stats(self):
+        return {
+            "running": self._running,
+            "workers": {str(worker_id): {"pid": worker["process"].pid, "jobs": len(worker["jobs"])}
+                        for worker_id, worker in list(self._workers.items())},
+            "jobs": self.jobs,
+            "restarts": self.restarts,
+            "recycles": self.recycles,
+        }
+
+
+worker_pool = InferenceWorkerPool()
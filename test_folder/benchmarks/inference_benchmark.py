@@ -0,0 +1,325 @@
+"""
+Inference benchmark.
+Sends synthetic images of several sizes and formats to /api/v1/image_inference at increasing
+concurrency, in process (ASGI) and over real HTTP (uvicorn), and reports latency percentiles,
+images/sec, peak RSS and the inference cache's hit ratio for each level.
+
+    python -m test_folder.benchmarks.inference_benchmark --models Birds Insects --output results.json
+    python -m test_folder.benchmarks.inference_benchmark --baseline baseline.json --tolerance 0.2
+
+With --baseline, the run fails (exit code 1) when a level's p95 latency or images/sec regressed
+by more than the tolerance compared to the same level in the baseline.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+content_types = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+
+################ Workload ################
+
+
+def synthetic_image(rng, size, format):
+    """
+        An encoded image of noise over a gradient, unique for each call.
+    """
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    img = (gradient[None, :, None] + rng.normal(0, 40, (size, size, 3))).clip(0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def build_requests(rng, count, files_per_request, sizes, formats, repeat):
+    """
+        The files of each request. Each file is, with probability repeat, one
+        already sent before (a cache hit once its prediction is cached), otherwise a new image.
+    """
+    sent = []
+    requests = []
+    for i in range(count):
+        files = []
+        for j in range(files_per_request):
+            if sent and rng.random() < repeat:
+                files.append(sent[rng.integers(len(sent))])
+                continue
+            size = int(rng.choice(sizes))
+            format = str(rng.choice(formats))
+            ext = "jpg" if format == "JPEG" else format.lower()
+            file = (f"bench_{i}_{j}_{size}.{ext}", synthetic_image(rng, size, format), content_types[format])
+            sent.append(file)
+            files.append(file)
+        requests.append(files)
+    return requests
+
+################ Measurements ################
+
+
+def current_rss():
+    """
+        Resident memory of this process in bytes, or its peak where /proc isn't available
+        (0 where neither is, e.g. on Windows).
+    """
+    try:
+        with open("/proc/self/statm", 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        # Unix only, Windows has neither /proc nor resource
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RSSSampler:
+    """
+        Samples the process' RSS in a thread, inference runs outside of the event loop.
+    """
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def summarize(latencies, images, elapsed):
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000
+    if not len(latencies):
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None, "mean_ms": None, "images_per_sec": 0.0}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist()
+    return {
+        "p50_ms": round(p50, 2),
+        "p95_ms": round(p95, 2),
+        "p99_ms": round(p99, 2),
+        "mean_ms": round(float(latencies.mean()), 2),
+        "images_per_sec": round(images / elapsed, 2) if elapsed else 0.0,
+    }
+
+
+def result_key(result):
+    return (result["mode"], result["model"], result["concurrency"], result["files_per_request"])
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+        Lists the levels whose p95 latency or images/sec regressed by more than tolerance
+        (a fraction) against the matching level of the baseline.
+    """
+    previous = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = previous.get(result_key(result))
+        if base is None:
+            continue
+        name = "{} {} concurrency={} files={}".format(*result_key(result))
+        if base["p95_ms"] and result["p95_ms"] and result["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {result['p95_ms']}ms, baseline {base['p95_ms']}ms")
+        if base["images_per_sec"] and result["images_per_sec"] < base["images_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['images_per_sec']} images/sec, baseline {base['images_per_sec']}")
+    return regressions
+
+################ Runner ################
+
+
+async def run_level(client, model, requests, concurrency, top_k):
+    """
+        Sends the requests with at most concurrency in flight, returns the level's measurements.
+    """
+    from library.utilities_api.utilities import inference_cache
+
+    latencies = []
+    statuses = {}
+    images = 0
+    pending = iter(requests)
+
+    async def send():
+        nonlocal images
+        for files in pending:
+            start = time.perf_counter()
+            response = await client.post("/api/v1/image_inference", params={"model": model, "top_k": top_k},
+                                         files=[("files", file) for file in files])
+            latency = time.perf_counter() - start
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                latencies.append(latency)
+                images += len(files)
+
+    hits, misses = inference_cache.hits, inference_cache.misses
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*[send() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    hits, misses = inference_cache.hits - hits, inference_cache.misses - misses
+
+    return {
+        **summarize(latencies, images, elapsed),
+        "requests": len(requests),
+        "images": images,
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+        "cache_hit_ratio": round(hits / (hits + misses), 3) if hits + misses else None,
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerThread:
+    """
+        Serves the app with uvicorn in a thread of this process, so its memory and cache are measured too.
+    """
+
+    def __init__(self, app):
+        import uvicorn
+        self.port = free_port()
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{self.port}"
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join()
+
+
+async def run_mode(mode, app, args, rng):
+    import httpx
+    from library.utilities_api.utilities import clear_cache
+    from library.utilities_api.catalog import model_catalog
+
+    if mode == "inprocess":
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None)
+    else:
+        client = httpx.AsyncClient(base_url=args.base_url, timeout=None)
+
+    results = []
+    async with client:
+        for model in args.models:
+            formats = [format for format in args.formats
+                       if format in model_catalog.file_types(model) or (format == "JPEG" and "JPG" in model_catalog.file_types(model))]
+            if not args.no_warm_up:
+                # The first request loads the model, it isn't measured
+                await run_level(client, model, build_requests(rng, 1, 1, args.sizes[:1], formats, 0), 1, args.top_k)
+            for concurrency in args.concurrency:
+                requests = build_requests(rng, args.requests, args.files_per_request, args.sizes, formats, args.repeat)
+                clear_cache()
+                result = {"mode": mode, "model": model, "concurrency": concurrency,
+                          "files_per_request": args.files_per_request}
+                result.update(await run_level(client, model, requests, concurrency, args.top_k))
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def print_result(result):
+    print(f"{result['mode']:>9} {result['model']:>12} c={result['concurrency']:<3} "
+          f"p50={result['p50_ms']}ms p95={result['p95_ms']}ms p99={result['p99_ms']}ms "
+          f"{result['images_per_sec']} img/s rss={result['peak_rss_mb']}MiB hits={result['cache_hit_ratio']} "
+          f"statuses={result['statuses']}", flush=True)
+
+
+def environment():
+    from library.config import Settings
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {name: getattr(Settings, name) for name in (
+            "INFERENCE_EXECUTOR", "INFERENCE_WORKERS", "INFERENCE_BATCH_SIZE", "BATCH_MAX_WAIT_MS",
+            "INFERENCE_QUEUE_LIMIT", "PERSISTENT_CACHE")},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image inference endpoint.")
+    parser.add_argument("--models", nargs="+", default=["Birds", "Insects"])
+    parser.add_argument("--modes", nargs="+", choices=["inprocess", "http"], default=["inprocess", "http"])
+    parser.add_argument("--url", help="Benchmark an already running server instead of starting one (http mode only)")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=50, help="Requests per concurrency level")
+    parser.add_argument("--files-per-request", type=int, default=4)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[224, 640, 1280], help="Image widths/heights")
+    parser.add_argument("--formats", nargs="+", choices=sorted(content_types), default=["PNG", "JPEG", "WEBP"])
+    parser.add_argument("--repeat", type=float, default=0.5, help="Fraction of files that were sent before")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-warm-up", action="store_true")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Fail on regressions against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed regression against the baseline")
+    args = parser.parse_args(argv)
+
+    from library import create_app
+    app = create_app(disable_database=True)
+    rng = np.random.default_rng(args.seed)
+
+    results = []
+    for mode in args.modes:
+        if mode == "http" and args.url:
+            args.base_url = args.url
+            mode_results = asyncio.run(run_mode(mode, app, args, rng))
+            # The server's memory and cache aren't this process'
+            for result in mode_results:
+                result["peak_rss_mb"] = result["cache_hit_ratio"] = None
+        elif mode == "http":
+            with ServerThread(app) as args.base_url:
+                mode_results = asyncio.run(run_mode(mode, app, args, rng))
+        else:
+            mode_results = asyncio.run(run_mode(mode, app, args, rng))
+        results.extend(mode_results)
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,13 @@
+import os
+import tempfile
 import pytest
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from library import create_app
 from library.database import models
+from library.database import database
+from library.database.database import create_db_engine, create_async_db_engine
 from fastapi.testclient import TestClient
 
 
@@ -21,12 +25,20 @@ def client():
     return TestClient(my_app)
 
 
-engine = create_engine(
-    "sqlite+pysqlite:///:memory:", echo=True, future=True
-)
+# Point TEST_DATABASE_URL at a scratch database (e.g. a local PostgreSQL) to run the tests against it.
+# By default it is an SQLite file for the session, an in memory database can't be shared with the async engine
+test_database_folder = tempfile.TemporaryDirectory()
+test_database_url = os.environ.get(
+    "TEST_DATABASE_URL", f"sqlite+pysqlite:///{os.path.join(test_database_folder.name, 'test.db')}")
+engine = create_db_engine(test_database_url, echo=True, future=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 models.Base.metadata.create_all(bind=engine)
 
+# The app's sessions (sync and async) use the test database too
+database.SessionLocal.configure(bind=engine)
+database.async_engine = create_async_db_engine(test_database_url)
+database.AsyncSessionLocal.configure(bind=database.async_engine)
+
 
 @pytest.fixture()
 def get_db():
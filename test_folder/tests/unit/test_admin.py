@@ -1,6 +1,7 @@
 from pathlib import Path
 import pytest
-from test_folder.tests.unit.test_auth import test_login, test_admin_login
+# Imported under other names, so test_auth's tests aren't collected (and run before its users exist) here
+from test_folder.tests.unit.test_auth import test_login as login, test_admin_login as admin_login
 
 
 @pytest.mark.skip(reason="I have no idea how to get a token with OAUTH2 scopes")
@@ -8,8 +9,8 @@ from test_folder.tests.unit.test_auth import test_login, test_admin_login
 def test_get_user(client):
     path = "/api/v1/admin/clear_inference_cache"
 
-    token = test_login(client)
-    admin_token = test_admin_login(client)
+    token = login(client)
+    admin_token = admin_login(client)
     unauth_response = client.get(
         path
     )
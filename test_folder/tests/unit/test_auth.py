@@ -1,6 +1,7 @@
 from pathlib import Path
 import pytest
-from test_folder.tests.unit.test_crud import test_set_admin
+# Imported under another name, so test_crud's test isn't collected (and run before its user exists) here
+from test_folder.tests.unit.test_crud import test_set_admin as set_admin
 
 from fastapi.security import OAuth2PasswordBearer
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", scopes={
@@ -35,7 +36,7 @@ def test_create_user(client, user=test_user):
 @pytest.mark.dependency(depends=["test_create_user", "test_set_admin"])
 def test_create_admin(client, get_db):
     test_create_user(client, test_admin)
-    test_set_admin(get_db, username=test_admin["username"])
+    set_admin(get_db, username=test_admin["username"])
 
     token = test_admin_login(client)
     response = client.get(
@@ -43,8 +44,8 @@ def test_create_admin(client, get_db):
         headers={"Authorization": f"Bearer {token}"}
     )
     assert response.status_code == 200
-    assert response.json()["email"] == test_user["email"]
-    assert response.json()["username"] == test_user["username"]
+    assert response.json()["email"] == test_admin["email"]
+    assert response.json()["username"] == test_admin["username"]
     assert response.json()["uid"] != None
     assert response.json()["admin"] == True
 
@@ -0,0 +1,47 @@
+import asyncio
+import time
+import pytest
+from library.auth_api.cache import AuthCache, Principal, auth_cache
+from library.database import crud
+
+
+def test_claims_are_cached_until_the_token_expires():
+    cache = AuthCache(ttl=60, max_entries=10)
+    decoded = []
+
+    def decode(token):
+        decoded.append(token)
+        return {"sub": token, "exp": time.time() + (60 if token == "valid" else -1)}
+
+    assert cache.claims("valid", decode)["sub"] == "valid"
+    assert cache.claims("valid", decode)["sub"] == "valid"
+    cache.claims("expired", decode)
+    cache.claims("expired", decode)
+
+    assert decoded == ["valid", "expired", "expired"]
+
+
+def test_users_are_cached_and_evicted():
+    cache = AuthCache(ttl=60, max_entries=2)
+    loaded = []
+
+    async def load(username):
+        loaded.append(username)
+        return None if username == "unknown" else Principal(username, username, None, False)
+
+    for username in ["a", "a", "unknown", "unknown", "b", "c", "a"]:
+        asyncio.run(cache.user(username, load))
+
+    # Unknown users aren't cached, and "a" was evicted as the least recently used
+    assert loaded == ["a", "unknown", "unknown", "b", "c", "a"]
+    assert cache.stats()["users"] == 2
+
+
+def test_crud_changes_invalidate_the_user(get_db):
+    crud.create_user(get_db, username="pytestAuthCache", email=None, password="pytestauthcache")
+    async def load(username):
+        return Principal.from_user(crud.get_users_by_username(get_db, username))
+
+    assert asyncio.run(auth_cache.user("pytestAuthCache", load)).is_admin is False
+    crud.set_user_admin_by_username(get_db, "pytestAuthCache", True)
+    assert asyncio.run(auth_cache.user("pytestAuthCache", load)).is_admin is True
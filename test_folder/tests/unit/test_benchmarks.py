@@ -0,0 +1,45 @@
+import numpy as np
+from test_folder.benchmarks.inference_benchmark import build_requests, compare_to_baseline, summarize
+
+
+def test_summarize_percentiles():
+    summary = summarize([i / 1000 for i in range(1, 101)], images=400, elapsed=2.0)
+
+    assert summary["p50_ms"] == 50.5 and summary["p95_ms"] == 95.05 and summary["p99_ms"] == 99.01
+    assert summary["images_per_sec"] == 200.0
+    assert summarize([], images=0, elapsed=1.0)["p95_ms"] is None
+
+
+def test_build_requests_repeats_files():
+    rng = np.random.default_rng(0)
+    requests = build_requests(rng, 10, 4, [16], ["PNG", "JPEG"], repeat=0.5)
+    files = [file for request in requests for file in request]
+
+    assert len(requests) == 10 and all(len(request) == 4 for request in requests)
+    assert 0 < len({data for _, data, _ in files}) < len(files)
+    assert {name.rsplit(".", 1)[1] for name, _, _ in files} == {"png", "jpg"}
+
+
+def test_compare_to_baseline():
+    level = {"mode": "inprocess", "model": "Birds", "concurrency": 4, "files_per_request": 4}
+    baseline = {"results": [{**level, "p95_ms": 100.0, "images_per_sec": 50.0}]}
+
+    assert compare_to_baseline([{**level, "p95_ms": 115.0, "images_per_sec": 45.0}], baseline, 0.2) == []
+    regressions = compare_to_baseline([{**level, "p95_ms": 130.0, "images_per_sec": 30.0}], baseline, 0.2)
+    assert len(regressions) == 2
+    # Levels missing from the baseline aren't compared
+    assert compare_to_baseline([{**level, "concurrency": 16, "p95_ms": 500.0, "images_per_sec": 1.0}], baseline, 0.2) == []
+
+
+def test_current_rss_without_proc_or_resource(monkeypatch):
+    import sys
+    from test_folder.benchmarks import inference_benchmark
+
+    def no_proc(*args, **kwargs):
+        raise FileNotFoundError(args[0])
+
+    assert inference_benchmark.current_rss() > 0
+    # As on Windows
+    monkeypatch.setattr(inference_benchmark, "open", no_proc, raising=False)
+    monkeypatch.setitem(sys.modules, "resource", None)
+    assert inference_benchmark.current_rss() == 0
@@ -0,0 +1,77 @@
+import pytest
+from library.utilities_api.cache import InferenceCache, PersistentCache, prediction_size, encode_prediction, decode_prediction
+
+prediction = [[0.9, "cat"], [0.1, "dog"]]
+
+
+def test_cache_key_separates_models_versions_and_top_k():
+    cache = InferenceCache(max_entries=10, max_bytes=10000, ttl=60)
+    cache.put(cache.key(1, "Birds", "a", 5), prediction)
+
+    assert cache.get(cache.key(1, "Birds", "a", 5)) == prediction
+    assert cache.get(cache.key(1, "Insects", "a", 5)) is None
+    assert cache.get(cache.key(1, "Birds", "b", 5)) is None
+    assert cache.get(cache.key(1, "Birds", "a", 10)) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 3
+
+
+def test_cache_lru_eviction():
+    cache = InferenceCache(max_entries=2, max_bytes=10000, ttl=60)
+    cache.put("a", prediction)
+    cache.put("b", prediction)
+    cache.get("a")
+    cache.put("c", prediction)
+
+    # b was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == prediction
+    assert cache.get("c") == prediction
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_byte_bound():
+    cache = InferenceCache(max_entries=100, max_bytes=prediction_size(prediction) * 2, ttl=60)
+    for key in range(5):
+        cache.put(key, prediction)
+
+    assert len(cache) == 2
+    assert cache.stats()["bytes"] <= prediction_size(prediction) * 2
+
+
+def test_cache_ttl_expiry(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("library.utilities_api.cache.time.time", lambda: now[0])
+    cache = InferenceCache(max_entries=10, max_bytes=10000, ttl=10)
+    cache.put("a", prediction)
+    cache.put("b", prediction)
+
+    now[0] += 5
+    assert cache.get("a") == prediction
+    now[0] += 6
+    # a was refreshed when it was used, b expired
+    assert cache.get("a") == prediction
+    assert cache.get("b") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_prediction_encoding_round_trip():
+    encoded = encode_prediction(prediction)
+    assert decode_prediction(encoded) == [[pytest.approx(0.9), "cat"], [pytest.approx(0.1), "dog"]]
+    assert decode_prediction(encode_prediction([])) == []
+    # Older string scores are stored as floats
+    assert decode_prediction(encode_prediction([["0.5", "cat"]])) == [[0.5, "cat"]]
+
+
+def test_persistent_cache_second_tier(tmp_path):
+    db_path = str(tmp_path / "inference_cache.db")
+    cache = InferenceCache(max_entries=10, max_bytes=10000, ttl=60, persistent=PersistentCache(db_path))
+    cache.put(cache.key(1, "Birds", "a", 5), [[0.5, "cat"]])
+    cache.flush()
+
+    # A fresh process (or a restart) finds it on disk
+    restarted = InferenceCache(max_entries=10, max_bytes=10000, ttl=60, persistent=PersistentCache(db_path))
+    assert restarted.get(restarted.key(1, "Birds", "a", 5)) == [[0.5, "cat"]]
+    assert restarted.get(restarted.key(1, "Birds", "a", 5)) == [[0.5, "cat"]]
+    assert restarted.stats()["persistent_hits"] == 1
+    assert restarted.stats()["persistent_entries"] == 1
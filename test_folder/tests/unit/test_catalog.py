@@ -0,0 +1,93 @@
+import os
+
+from library.utilities_api.catalog import ModelCatalog
+
+
+def make_model(models_path, name, file_types="png,jpg"):
+    model_path = models_path / name
+    model_path.mkdir()
+    (model_path / "metadata.txt").write_text(f"1\ntensorflow\n{file_types}\n")
+    (model_path / "labels.txt").write_text("cat\ndog\n")
+    return model_path
+
+
+def test_catalog_lists_models(tmp_path):
+    make_model(tmp_path, "Dogs")
+    make_model(tmp_path, "cats")
+    (tmp_path / "__pycache__").mkdir()
+    catalog = ModelCatalog(str(tmp_path), check_interval=0)
+
+    assert catalog.names() == ["cats", "Dogs"]
+    assert "Dogs" in catalog and "__pycache__" not in catalog
+    assert catalog.file_types("Dogs") == {"PNG", "JPG"}
+    assert catalog.labels("Dogs").tolist() == ["cat", "dog"]
+
+
+def test_catalog_hot_adds_and_invalidates(tmp_path):
+    model_path = make_model(tmp_path, "Dogs")
+    catalog = ModelCatalog(str(tmp_path), check_interval=0)
+    version = catalog.version("Dogs")
+    entry = catalog.get("Dogs")
+
+    # Unchanged models keep their parsed entry
+    assert catalog.get("Dogs") is entry
+
+    make_model(tmp_path, "Birds")
+    assert catalog.names() == ["Birds", "Dogs"]
+
+    (model_path / "metadata.txt").write_text("1\ntensorflow\ngif\n")
+    os.utime(model_path / "metadata.txt", ns=(10 ** 19, 10 ** 19))
+    assert catalog.file_types("Dogs") == {"GIF"}
+    assert catalog.version("Dogs") != version
+
+    # Plugins being imported doesn't change the version
+    version = catalog.version("Dogs")
+    (model_path / "__pycache__").mkdir()
+    assert catalog.version("Dogs") == version
+
+
+def test_catalog_checks_at_most_every_interval(tmp_path):
+    catalog = ModelCatalog(str(tmp_path), check_interval=3600)
+    assert catalog.names() == []
+    make_model(tmp_path, "Dogs")
+    assert catalog.names() == []
+    catalog.refresh()
+    assert catalog.names() == ["Dogs"]
+
+
+def test_catalog_versioned_models(tmp_path):
+    from library.utilities_api.catalog import active_version, set_active_version
+    folder = tmp_path / "Dogs"
+    folder.mkdir()
+    make_model(folder, "v2")
+    make_model(folder, "v10", file_types="gif")
+    catalog = ModelCatalog(str(tmp_path), check_interval=0)
+
+    # The latest version is active by default
+    assert catalog.names() == ["Dogs"]
+    assert active_version(str(folder)) == "v10"
+    assert catalog.version("Dogs").startswith("v10-")
+    assert catalog.file_types("Dogs") == {"GIF"}
+
+    set_active_version(str(folder), "v2")
+    assert catalog.version("Dogs").startswith("v2-")
+    assert catalog.file_types("Dogs") == {"PNG", "JPG"}
+
+
+def test_catalog_versioned_model_edits(tmp_path):
+    folder = tmp_path / "Dogs"
+    folder.mkdir()
+    model_path = make_model(folder, "v1")
+    (model_path / "saved_model" / "variables").mkdir(parents=True)
+    catalog = ModelCatalog(str(tmp_path), check_interval=0)
+
+    # Edited in place, in the version folder and in a folder of its own
+    for i, path in enumerate([model_path / "predict.py", model_path / "saved_model" / "variables" / "data"], 1):
+        version = catalog.version("Dogs")
+        path.write_text("edited")
+        os.utime(path, ns=(10 ** 19 + i, 10 ** 19 + i))
+        assert catalog.version("Dogs") != version
+
+    version = catalog.version("Dogs")
+    (model_path / "__pycache__").mkdir()
+    assert catalog.version("Dogs") == version
@@ -27,3 +27,16 @@ def test_set_admin(get_db, username=test_user["username"]):
     user = get_users_by_username(get_db, username)
     assert user.is_admin == True
     return user
+
+
+def test_create_images_in_bulk(get_db):
+    user = create_user(get_db, username="pytestImages", email=None, password="pytestimages")
+    update_image_expiry_by_uid(get_db, user.id, 60)
+
+    expiry_time = create_images(get_db, [(1, "a.png"), (2, "b.png"), (3, "c.png")], user.id, batch_size=2)
+    image = create_image(get_db, "4", "d.png", user.id)
+
+    images = get_db.query(models.Image).filter(models.Image.uid == user.id).all()
+    assert sorted(image.image_name for image in images) == ["a.png", "b.png", "c.png", "d.png"]
+    assert {image.expiry_time for image in images if image.image_name != "d.png"} == {expiry_time}
+    assert abs(expiry_time - 60 - time()) <= 1 and image.expiry_time >= expiry_time
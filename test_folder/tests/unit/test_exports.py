@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+from library import Settings
+
+results = [{"name": f"img{i}.png", "model": "Birds", "hash": i, "pred": [[0.9, "cat"], [0.1, "dog"]]} for i in range(50)]
+
+
+def wait_for(client, job_id):
+    for _ in range(100):
+        job = client.get(f'/api/v1/exports/{job_id}').json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.05)
+    raise TimeoutError(job_id)
+
+
+def test_export_job(client, tmp_path, monkeypatch):
+    monkeypatch.setattr(Settings, "STORAGE_FOLDER", str(tmp_path))
+
+    response = client.post('/api/v1/exports?format=csv', json=results)
+    assert response.status_code == 202
+    job_id = response.json()["id"]
+    assert job_id.endswith(".csv")
+
+    # Identical requests share the job
+    assert client.post('/api/v1/exports?format=csv', json=results).json()["id"] == job_id
+
+    job = wait_for(client, job_id)
+    assert job["status"] == "done"
+    assert job["rows_done"] == job["rows_total"] == 50
+
+    full = client.get(f'/api/v1/exports/{job_id}/download')
+    assert full.status_code == 200
+    assert full.headers["Accept-Ranges"] == "bytes"
+    assert full.text.startswith("Filename,Model,Predictions,Label,Rank\n")
+
+    # Resuming a download
+    partial = client.get(f'/api/v1/exports/{job_id}/download', headers={"Range": "bytes=10-"})
+    assert partial.status_code == 206
+    assert partial.content == full.content[10:]
+    assert partial.headers["Content-Range"] == f"bytes 10-{len(full.content) - 1}/{len(full.content)}"
+
+    suffix = client.get(f'/api/v1/exports/{job_id}/download', headers={"Range": "bytes=-5"})
+    assert suffix.content == full.content[-5:]
+
+    unsatisfiable = client.get(f'/api/v1/exports/{job_id}/download', headers={"Range": f"bytes={len(full.content)}-"})
+    assert unsatisfiable.status_code == 416
+
+
+def test_export_job_not_found(client):
+    assert client.get('/api/v1/exports/config.py').status_code == 404
+    assert client.get(f'/api/v1/exports/{"0" * 32}.csv').status_code == 404
+    assert client.post('/api/v1/exports?format=pdf', json=results).status_code == 400
+
+
+def test_ndjson_stream(client):
+    import orjson
+    response = client.post('/api/v1/create_ndjson', json=results[:2], headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert [orjson.loads(line) for line in response.text.splitlines()] == [
+        {"name": result["name"], "pred": result["pred"], "model": "Birds", "hash": result["hash"]} for result in results[:2]]
+
+
+def test_parquet_export(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from library.utilities_api.file_exports import build_parquet
+
+    file_path = str(tmp_path / "export.parquet")
+    build_parquet(file_path, results[:2] + [{"name": "none.png", "model": "Insects", "hash": 3, "pred": []}])
+
+    table = pq.read_table(file_path)
+    assert str(table.schema.field("model").type) == "dictionary<values=string, indices=int32, ordered=0>"
+    rows = table.to_pylist()
+    assert [row["name"] for row in rows] == ["img0.png", "img1.png", "none.png"]
+    assert [(pytest.approx(pred["score"]), pred["label"]) for pred in rows[0]["pred"]] == [(0.9, "cat"), (0.1, "dog")]
+    assert rows[2]["pred"] == [] and rows[2]["model"] == "Insects"
+
+
+def test_failed_export_leaves_no_temporary_file(tmp_path):
+    from library.utilities_api.file_exports import build_csv
+
+    # A prediction that isn't a (score, label) pair fails partway through the export
+    malformed = results[:2] + [{"name": "bad.png", "model": "Birds", "hash": 3, "pred": [[0.5]]}]
+    with pytest.raises(ValueError):
+        build_csv(str(tmp_path / "export.csv"), malformed)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_export_jobs_shutdown(tmp_path, monkeypatch):
+    from library.utilities_api.export_jobs import ExportJobs
+    monkeypatch.setattr(Settings, "STORAGE_FOLDER", str(tmp_path))
+
+    def slow_build(file_path, results, progress):
+        time.sleep(0.2)
+        with open(file_path, "w") as file:
+            file.write("built")
+
+    jobs = ExportJobs(workers=1)
+    running = jobs.submit("0" * 32 + ".csv", results, slow_build)
+    queued = jobs.submit("1" * 32 + ".csv", results, slow_build)
+    while running.status == "queued":
+        time.sleep(0.01)
+    jobs.shutdown()
+
+    # The running export is finished, the queued one never starts
+    assert running.status == "done" and (tmp_path / running.id).read_text() == "built"
+    assert (queued.status, queued.error) == ("failed", "Cancelled")
+    assert not (tmp_path / queued.id).exists()
@@ -0,0 +1,376 @@
+import asyncio
+import time
+import io
+import types
+import numpy as np
+import pytest
+from PIL import Image as PILimg
+from library.utilities_api import scheduler, executor
+from library.utilities_api.inference import ModelRegistry, format_predictions
+from library.utilities_api.workers import InferenceWorkerPool, WorkerCrashedError
+from library.utilities_api.preprocessing import ImageSource, preprocess_images
+
+# Plugin files for a model that doesn't need tensorflow
+fake_preprocess = '''
+def img_preprocess(image_path):
+    return image_path
+'''
+
+fake_predict = '''
+load_count = 0
+
+def load_model(path):
+    global load_count
+    load_count += 1
+    return {"labels": ["cat", "dog"]}
+
+def predict(img, path, model=None):
+    if model is None:
+        model = load_model(path)
+    return [["0.9", model["labels"][0]], ["0.1", model["labels"][1]]]
+'''
+
+
+fake_batch_preprocess = '''
+import numpy as np
+
+def img_preprocess(image_path):
+    return np.full((1, 2), float(image_path))
+'''
+
+fake_batch_predict = '''
+import os
+batch_sizes = []
+
+def predict_logits(imgs, path, model=None):
+    if (imgs < 0).any():
+        os._exit(1)
+    batch_sizes.append(len(imgs))
+    # Class 1 scores higher the bigger the number
+    return imgs * [[-1, 1]]
+
+def predict(img, path, model=None):
+    return predict_logits(img, path, model)[0]
+'''
+
+
+@pytest.fixture
+def models_path(tmp_path):
+    for name in ["Cats", "Dogs"]:
+        model_path = tmp_path / name
+        model_path.mkdir()
+        (model_path / "preprocess.py").write_text(fake_preprocess)
+        (model_path / "predict.py").write_text(fake_predict)
+        (model_path / "labels.txt").write_text("cat\ndog\n")
+        (model_path / "metadata.txt").write_text("1\ntensorflow\npng\n")
+
+    model_path = tmp_path / "Numbers"
+    model_path.mkdir()
+    (model_path / "preprocess.py").write_text(fake_batch_preprocess)
+    (model_path / "predict.py").write_text(fake_batch_predict)
+    (model_path / "labels.txt").write_text("small\nbig\n")
+    (model_path / "metadata.txt").write_text("1\ntensorflow\npng\n")
+    return str(tmp_path)
+
+
+def test_registry_loads_once(models_path):
+    registry = ModelRegistry(models_path)
+    assert not registry.is_loaded("Cats")
+
+    first = registry.get("Cats")
+    assert registry.get("Cats") is first
+    assert first.predict.load_count == 1
+    assert first.labels.tolist() == ["cat", "dog"]
+    assert first.run("image.png")[0] == ["0.9", "cat"]
+
+
+def test_registry_models_are_isolated(models_path):
+    registry = ModelRegistry(models_path)
+    cats = registry.get("Cats")
+    dogs = registry.get("Dogs")
+
+    assert cats.predict is not dogs.predict
+    assert cats.predict.load_count == 1
+    assert dogs.predict.load_count == 1
+
+
+def test_registry_warm_up_and_unload(models_path, tmp_path):
+    registry = ModelRegistry(models_path)
+    # Only model folders are warmed up
+    (tmp_path / "__pycache__").mkdir()
+    registry.warm_up(["*"])
+    assert registry.is_loaded("Cats") and registry.is_loaded("Dogs")
+    assert not registry.is_loaded("__pycache__")
+
+    assert registry.unload("Cats")
+    assert not registry.unload("Cats")
+    assert "Cats" not in [model["name"] for model in registry.loaded_models()]
+
+
+def test_registry_reload(models_path):
+    registry = ModelRegistry(models_path)
+    old = registry.get("Cats")
+    new = registry.reload("Cats")
+
+    assert new is not old
+    assert registry.get("Cats") is new
+
+
+def test_registry_swaps_versions_after_draining(tmp_path):
+    import threading
+    folder = tmp_path / "Cats"
+    for version, label in [("v1", "cat"), ("v2", "kitten")]:
+        (folder / version).mkdir(parents=True)
+        (folder / version / "metadata.txt").write_text("1\ntensorflow\npng\n")
+        (folder / version / "preprocess.py").write_text(fake_preprocess)
+        (folder / version / "predict.py").write_text(fake_predict.replace('["cat", "dog"]', f'["{label}", "dog"]'))
+    (folder / "ACTIVE").write_text("v1")
+
+    registry = ModelRegistry(str(tmp_path))
+    old = registry.get("Cats")
+    assert old.version == "v1"
+    assert old.run("a.png")[0][1] == "cat"
+
+    # A batch is still being predicted by v1 while swapping
+    with old.in_use():
+        swap = threading.Thread(target=registry.swap, args=("Cats", "v2"))
+        swap.start()
+        for _ in range(100):
+            if registry.versions("Cats")["swap"]["status"] == "draining":
+                break
+            swap.join(0.05)
+        assert registry.versions("Cats")["swap"]["status"] == "draining"
+        assert old.model is not None
+        # New requests already go to v2
+        assert registry.get("Cats").run("a.png")[0][1] == "kitten"
+    swap.join(5)
+
+    assert registry.versions("Cats") == {"versions": ["v1", "v2"], "active": "v2", "loaded": "v2",
+                                         "swap": {"version": "v2", "status": "done", "error": None}}
+    assert old.model is None
+    assert (folder / "ACTIVE").read_text() == "v2"
+
+    # Other processes follow the active version they are sent
+    assert ModelRegistry(str(tmp_path)).get("Cats", "v1").version == "v1"
+
+
+def test_registry_one_swap_and_load_at_a_time(models_path, monkeypatch):
+    import threading
+    from library.utilities_api.inference import SwapInProgressError
+    registry = ModelRegistry(models_path)
+
+    # A swap holds the model's swap lock until it's done
+    with registry._swap_lock("Cats"):
+        with pytest.raises(SwapInProgressError):
+            registry.swap("Cats", "v2")
+        with pytest.raises(SwapInProgressError):
+            registry.start_swap("Cats", "v2")
+
+    # Threads loading the same version share one load
+    loads = []
+    load = registry._load
+
+    def slow_load(model_name, version=None):
+        loads.append(model_name)
+        time.sleep(0.1)
+        return load(model_name, version)
+
+    monkeypatch.setattr(registry, "_load", slow_load)
+    models = []
+    threads = [threading.Thread(target=lambda: models.append(registry.get("Dogs"))) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ["Dogs"]
+    assert all(model is models[0] for model in models)
+
+
+def test_registry_batches_in_chunks(models_path):
+    registry = ModelRegistry(models_path)
+    model = registry.get("Numbers")
+    predictions = model.run_batch([str(i) for i in range(1, 6)], batch_size=2, top_k=1)
+
+    assert model.predict.batch_sizes == [2, 2, 1]
+    assert predictions == [[[float(i), "big"]] for i in range(1, 6)]
+
+
+def test_registry_predicts_one_at_a_time_without_predict_batch(models_path):
+    registry = ModelRegistry(models_path)
+    predictions = registry.get("Cats").run_batch(["a.png", "b.png"])
+
+    assert predictions == [[["0.9", "cat"], ["0.1", "dog"]]] * 2
+    assert registry.get("Cats").run_batch(["a.png"], top_k=1) == [[["0.9", "cat"]]]
+
+
+def test_format_predictions_top_k():
+    logits = np.array([[0.1, 0.5, 0.2, 0.9], [0.4, 0.3, 0.2, 0.1]], dtype=np.float32)
+    labels = np.array(["a", "b", "c", "d"])
+
+    predictions = format_predictions(logits, labels, top_k=2)
+    assert [[label for _, label in prediction] for prediction in predictions] == [["d", "b"], ["a", "b"]]
+    assert all(isinstance(score, float) for prediction in predictions for score, _ in prediction)
+    # top_k larger than the number of labels returns every label
+    assert len(format_predictions(logits, labels, top_k=10)[0]) == 4
+
+
+def test_scheduler_batches_across_requests(monkeypatch):
+    batches = []
+
+    def fake_predictions(image_paths, model_name, top_k, version=None):
+        batches.append((list(image_paths), top_k))
+        return [[[1.0, f"{model_name}:{image_path}"], [0.5, "other"]] for image_path in image_paths]
+
+    monkeypatch.setattr(executor, "get_predictions", fake_predictions)
+    inference_scheduler = scheduler.InferenceScheduler(max_batch_size=4, max_wait_ms=50)
+
+    async def requests():
+        # Five separate requests for one model, one for another
+        return await asyncio.gather(
+            *(inference_scheduler.submit("Cats", str(i), top_k=1 + i % 2) for i in range(5)),
+            inference_scheduler.submit("Dogs", "a", top_k=1))
+
+    results = asyncio.run(requests())
+
+    assert [result[0][1] for result in results] == [f"Cats:{i}" for i in range(5)] + ["Dogs:a"]
+    # Each request gets its own top_k out of a batch run with the largest one
+    assert [len(result) for result in results] == [1, 2, 1, 2, 1, 1]
+    assert sorted(len(paths) for paths, _ in batches) == [1, 1, 4]
+    assert (["0", "1", "2", "3"], 2) in batches
+    stats = inference_scheduler.stats()
+    assert stats["Cats"]["batch_sizes"] == {"1": 1, "4": 1}
+    assert stats["Cats"]["requests"] == 5
+    assert stats["Dogs"]["queue_depth"] == 0
+
+
+def test_scheduler_isolates_failing_images(monkeypatch):
+    batches = []
+
+    def fake_predictions(image_paths, model_name, top_k, version=None):
+        batches.append(list(image_paths))
+        if "garbage" in image_paths:
+            raise ValueError("cannot identify image file")
+        return [[[1.0, image_path]] for image_path in image_paths]
+
+    monkeypatch.setattr(executor, "get_predictions", fake_predictions)
+    inference_scheduler = scheduler.InferenceScheduler(max_batch_size=4, max_wait_ms=50)
+
+    async def requests():
+        return await asyncio.gather(
+            inference_scheduler.submit("Cats", "valid"),
+            inference_scheduler.submit("Cats", "garbage"),
+            inference_scheduler.submit("Cats", "other"),
+            return_exceptions=True)
+
+    valid, garbage, other = asyncio.run(requests())
+
+    # Only the request of the undecodable image fails
+    assert valid == [[1.0, "valid"]] and other == [[1.0, "other"]]
+    assert isinstance(garbage, ValueError)
+    assert batches[0] == ["valid", "garbage", "other"]
+    assert sorted(batches[1:]) == [["garbage"], ["other"], ["valid"]]
+    assert inference_scheduler.stats()["Cats"]["batch_sizes"] == {"3": 1}
+
+
+def test_worker_pool_shared_memory_and_recycling(models_path):
+    pool = InferenceWorkerPool(processes=1, max_jobs=2, models_path=models_path)
+    try:
+        for i in range(3):
+            predictions = pool.predict("Numbers", ["1", "2"], top_k=1)
+            assert predictions == [[[1.0, "big"]], [[2.0, "big"]]]
+        assert pool.stats()["recycles"] >= 1
+    finally:
+        pool.stop()
+
+
+def test_worker_pool_restarts_crashed_workers(models_path):
+    pool = InferenceWorkerPool(processes=1, max_jobs=0, models_path=models_path)
+    try:
+        with pytest.raises(WorkerCrashedError):
+            pool.predict("Numbers", ["-1"])
+        assert pool.stats()["restarts"] == 1
+        assert pool.predict("Numbers", ["1"])[0][0][1] == "big"
+    finally:
+        pool.stop()
+
+
+def test_declarative_preprocessing(tmp_path):
+    preprocess = types.SimpleNamespace(INPUT_SIZE=(4, 2), SCALE=1 / 255.0, OFFSET=-1.0)
+
+    buffer = io.BytesIO()
+    PILimg.new("RGB", (64, 32), (255, 0, 51)).save(buffer, format="JPEG", quality=100)
+    PILimg.new("RGBA", (8, 8), (0, 255, 0, 0)).save(tmp_path / "image.png")
+    sources = [ImageSource("unused.jpg", buffer.getvalue()), ImageSource(str(tmp_path / "image.png"))]
+
+    imgs = preprocess_images(preprocess, sources)
+
+    assert imgs.shape == (2, 2, 4, 3) and imgs.dtype == np.float32
+    # JPEG from memory, decoded at reduced size
+    assert np.allclose(imgs[0, :, :, 0], 0.0, atol=0.02) and np.allclose(imgs[0, :, :, 1], -1.0, atol=0.02)
+    # PNG from disk, alpha dropped
+    assert np.allclose(imgs[1], [-1.0, 0.0, -1.0])
+
+
+def test_onnx_backend_and_parity(tmp_path):
+    onnx = pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from onnx import helper, numpy_helper, TensorProto
+    from library.utilities_api.convert import check_parity
+
+    # Flattens a 2x2 image and scores it on its red (class 0) and green (class 1) channels
+    weights = np.zeros((12, 2), dtype=np.float32)
+    weights[0::3, 0] = 1
+    weights[1::3, 1] = 1
+    graph = helper.make_graph(
+        [helper.make_node("Flatten", ["images"], ["flat"]), helper.make_node("MatMul", ["flat", "weights"], ["logits"])],
+        "colours",
+        [helper.make_tensor_value_info("images", TensorProto.FLOAT, [None, 2, 2, 3])],
+        [helper.make_tensor_value_info("logits", TensorProto.FLOAT, [None, 2])],
+        [numpy_helper.from_array(weights, "weights")])
+    model_path = tmp_path / "Colours"
+    model_path.mkdir()
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8),
+              model_path / "model.onnx")
+    (model_path / "metadata.txt").write_text("1\nonnx\nPNG\n")
+    (model_path / "preprocess.py").write_text("INPUT_SIZE = (2, 2)\nSCALE = 1 / 255.0\n")
+    (model_path / "labels.txt").write_text("red\ngreen\n")
+    for name, colour in [("red.png", (255, 0, 0)), ("green.png", (0, 255, 0))]:
+        PILimg.new("RGB", (8, 8), colour).save(tmp_path / name)
+
+    registry = ModelRegistry(str(tmp_path))
+    model = registry.get("Colours")
+    assert model.info()["framework"] == "onnx"
+    results = model.run_batch([ImageSource(str(tmp_path / "red.png")), ImageSource(str(tmp_path / "green.png"))])
+    assert [result[0][1] for result in results] == ["red", "green"]
+
+    reference = np.array([[4.0, 0.0], [0.0, 4.0]])
+    parity = check_parity(reference, reference + 0.01)
+    assert parity["top1_agreement"] == 1.0 and parity["max_abs_diff"] == pytest.approx(0.01, abs=1e-6)
+    assert check_parity(reference, reference[::-1])["top1_agreement"] == 0.0
+
+
+def test_scheduler_runs_batches_in_parallel(monkeypatch):
+    running = []
+    peak = []
+
+    def slow_predictions(image_paths, model_name, top_k, version=None):
+        running.append(1)
+        peak.append(len(running))
+        time.sleep(0.1)
+        running.pop()
+        return [[[1.0, image_path]] for image_path in image_paths]
+
+    monkeypatch.setattr(executor, "get_predictions", slow_predictions)
+    monkeypatch.setattr(executor.inference_executor, "workers", 4)
+    monkeypatch.setattr(executor.inference_executor, "_thread_pool", None)
+    inference_scheduler = scheduler.InferenceScheduler(max_batch_size=2, max_wait_ms=0)
+
+    async def requests():
+        return await inference_scheduler.submit_many("Cats", [str(i) for i in range(8)], top_k=1)
+
+    start = time.perf_counter()
+    results = asyncio.run(requests())
+
+    assert [result[0][1] for result in results] == [str(i) for i in range(8)]
+    # 4 batches of 2 on 4 workers
+    assert max(peak) > 1 and time.perf_counter() - start < 0.35
@@ -0,0 +1,45 @@
+import asyncio
+import threading
+import pytest
+from library.config import Settings
+from library.auth_api.passwords import (PasswordHasher, ConcurrencyLimiter, ConcurrencyLimitError,
+                                        PasswordQueueFullError)
+
+
+def test_hash_and_verify_with_configured_costs(monkeypatch):
+    monkeypatch.setattr(Settings, "ARGON2_TIME_COST", 1)
+    monkeypatch.setattr(Settings, "ARGON2_MEMORY_COST", 1024)
+    monkeypatch.setattr(Settings, "ARGON2_PARALLELISM", 1)
+    hasher = PasswordHasher(workers=1)
+
+    password_hash = hasher.hash("pytestpassword")
+
+    assert "m=1024,t=1,p=1" in password_hash
+    assert asyncio.run(hasher.verify_async("pytestpassword", password_hash)) is True
+    assert asyncio.run(hasher.verify_async("wrong", password_hash)) is False
+    assert hasher.pending == 0
+
+
+def test_queue_limit():
+    hasher = PasswordHasher(workers=1, queue_limit=1)
+    release = threading.Event()
+    blocked = hasher._submit(release.wait)
+
+    with pytest.raises(PasswordQueueFullError):
+        hasher.hash("pytestpassword")
+    release.set()
+    blocked.result()
+    assert hasher.stats()["rejected"] == 1
+
+
+def test_concurrency_limiter():
+    limiter = ConcurrencyLimiter(lambda: 1)
+
+    with limiter.hold("pytest"):
+        with pytest.raises(ConcurrencyLimitError):
+            with limiter.hold("pytest"):
+                pass
+        with limiter.hold("other"):
+            pass
+    with limiter.hold("pytest"):
+        pass
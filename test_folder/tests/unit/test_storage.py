@@ -0,0 +1,65 @@
+import hashlib
+import os
+
+from library.utilities_api.storage import BlobStore
+
+
+def put(store, name, hash, data, **kwargs):
+    return store.put(name, hash, hashlib.sha256(data).hexdigest(), len(data), data, **kwargs)
+
+
+def test_blob_store_deduplicates(tmp_path):
+    store = BlobStore(str(tmp_path))
+    first = put(store, "cat.png", 1, b"cat")
+    second = put(store, "kitten.png", 1, b"cat")
+
+    # Stored once, sharded by its digest
+    digest = hashlib.sha256(b"cat").hexdigest()
+    assert first == second == os.path.join(str(tmp_path), digest[:2], digest[2:4], f"{digest}.png")
+    assert store.path("kitten.png", 1) == first
+    assert store.path("dog.png", 1) is None
+    assert store.stats()["blobs"] == 1
+    assert store.stats()["names"] == 2
+    assert store.stats()["writes"] == 1
+
+    # Same name uploaded again doesn't add a reference
+    put(store, "cat.png", 1, b"cat")
+    assert store.stats()["names"] == 2
+
+
+def test_blob_store_reference_counting(tmp_path):
+    store = BlobStore(str(tmp_path))
+    path = put(store, "cat.png", 1, b"cat")
+    put(store, "kitten.png", 1, b"cat")
+
+    assert store.remove("cat.png", 1) == 0
+    assert os.path.isfile(path)
+    assert store.remove("kitten.png", 1) == 3
+    assert not os.path.isfile(path)
+    assert store.stats()["blobs"] == 0
+
+
+def test_blob_store_consumes_temp_files(tmp_path):
+    store = BlobStore(str(tmp_path))
+    temp_path = tmp_path / "upload.part"
+    temp_path.write_bytes(b"cat")
+    path = store.put("cat.png", 1, hashlib.sha256(b"cat").hexdigest(), 3, temp_path=str(temp_path))
+
+    duplicate = tmp_path / "duplicate.part"
+    duplicate.write_bytes(b"cat")
+    store.put("kitten.png", 1, hashlib.sha256(b"cat").hexdigest(), 3, temp_path=str(duplicate))
+
+    assert not temp_path.exists() and not duplicate.exists()
+    with open(path, "rb") as f:
+        assert f.read() == b"cat"
+
+
+def test_blob_store_extends_expiry(tmp_path):
+    store = BlobStore(str(tmp_path))
+    put(store, "cat.png", 1, b"cat", expiry_time=100)
+    put(store, "dog.png", 2, b"dog", expiry_time=300)
+
+    store.extend_expiry([("cat.png", 1), ("dog.png", 2), ("missing.png", 3)], 200)
+
+    expiry_times = dict(store._connection().execute("SELECT name, expiry_time FROM names").fetchall())
+    assert expiry_times == {"cat.png": 200, "dog.png": 300}
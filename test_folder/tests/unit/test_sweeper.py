@@ -0,0 +1,79 @@
+import hashlib
+import os
+import time
+
+from library import Settings
+from library.utilities_api.storage import BlobStore
+from library.utilities_api.sweeper import ExpirySweeper
+
+
+def test_sweep_expired_uploads(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr("library.utilities_api.sweeper.blob_store", store)
+    monkeypatch.setattr(Settings, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(Settings, "STORAGE_FOLDER", str(tmp_path / "storage"))
+
+    now = time.time()
+    digest = hashlib.sha256(b"cat").hexdigest()
+    expired = store.put("cat.png", 1, digest, 3, b"cat", expiry_time=now - 10)
+    store.put("kitten.png", 1, digest, 3, b"cat", expiry_time=now + 1000)
+    dog = store.put("dog.png", 2, hashlib.sha256(b"dog").hexdigest(), 3, b"dog", expiry_time=now - 10)
+
+    sweeper = ExpirySweeper(batch_size=1, sweep_database=False)
+    assert sweeper.sweep() == 3
+
+    # The cat blob is still used by kitten.png
+    assert os.path.isfile(expired) and not os.path.isfile(dog)
+    assert store.path("cat.png", 1) is None
+    assert store.path("kitten.png", 1) == expired
+    assert sweeper.stats()["uploads_deleted"] == 2
+    assert sweeper.stats()["last_duration"] is not None
+
+
+def test_sweep_orphaned_temporary_files(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr("library.utilities_api.sweeper.blob_store", store)
+    monkeypatch.setattr(Settings, "UPLOAD_FOLDER", str(tmp_path))
+    monkeypatch.setattr(Settings, "SWEEP_TEMP_FILE_GRACE_PERIOD", 60)
+
+    blob = store.put("cat.png", 1, hashlib.sha256(b"cat").hexdigest(), 3, b"cat")
+    shard = os.path.dirname(blob)
+    for path in (tmp_path / "blobs" / "upload.part", os.path.join(shard, "write.part")):
+        with open(path, 'wb') as file:
+            file.write(b"12345")
+        os.utime(path, (1000, 1000))
+    # Still being written
+    with open(os.path.join(shard, "recent.part"), 'wb') as file:
+        file.write(b"12345")
+
+    sweeper = ExpirySweeper(sweep_database=False)
+    assert sweeper.sweep_uploads(time.time()) == 10
+    assert sorted(os.listdir(shard)) == sorted([os.path.basename(blob), "recent.part"])
+    assert not os.path.exists(tmp_path / "blobs" / "upload.part")
+
+
+def test_sweep_exports_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(Settings, "STORAGE_FOLDER", str(tmp_path))
+    monkeypatch.setattr(Settings, "EXPORT_CACHE_MAX_BYTES", 10)
+    for i, name in enumerate(["old.csv", "used.xlsx", "new.csv"]):
+        path = tmp_path / name
+        path.write_bytes(b"12345")
+        os.utime(path, (1000 + i, 1000 + i))
+    # Served again, so it's the most recently used
+    os.utime(tmp_path / "used.xlsx")
+
+    sweeper = ExpirySweeper()
+    assert sweeper.sweep_exports() == 5
+    assert sorted(os.listdir(tmp_path)) == ["new.csv", "used.xlsx"]
+
+
+def test_sweep_interrupted_exports(tmp_path, monkeypatch):
+    monkeypatch.setattr(Settings, "STORAGE_FOLDER", str(tmp_path))
+    monkeypatch.setattr(Settings, "SWEEP_TEMP_FILE_GRACE_PERIOD", 60)
+    (tmp_path / "old.csv.1.part").write_bytes(b"12345")
+    os.utime(tmp_path / "old.csv.1.part", (1000, 1000))
+    # Still being written
+    (tmp_path / "new.xlsx.2.part").write_bytes(b"12345")
+
+    assert ExpirySweeper().sweep_exports() == 5
+    assert os.listdir(tmp_path) == ["new.xlsx.2.part"]
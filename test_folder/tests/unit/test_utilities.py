@@ -95,3 +95,178 @@ def test_xlsx(client):
 
     # assert response.status_code == 200
     # assert response.headers['Content-Type'] == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Test that a csv file is streamed, and gzip compressed when the client accepts it
+
+
+def test_csv_stream(client):
+    import gzip
+    results = [{"name": "cat, 1.png", "model": "Birds", "hash": 1, "pred": [[0.9, "cat"], [0.1, "dog"]]}]
+    expected = "Filename,Model,Predictions,Label,Rank\n\"cat, 1.png\",Birds,0.9,cat,1\n\"cat, 1.png\",Birds,0.1,dog,2\n"
+
+    response = client.post('/api/v1/create_csv', json=results, headers={"Accept-Encoding": "identity"})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith("text/csv")
+    assert response.text == expected
+
+    from library.utilities_api.file_exports import csv_chunks, gzip_chunks
+    assert gzip.decompress(b"".join(gzip_chunks(csv_chunks(results, rows_per_chunk=1)))).decode() == expected
+
+# Test that xlsx files are written with thumbnails generated outside of the uploads
+
+
+def test_build_xlsx(tmp_path, monkeypatch):
+    import hashlib
+    import io as bytes_io
+    from PIL import Image
+    from openpyxl import load_workbook
+    from library.utilities_api import file_exports
+    from library.utilities_api.storage import BlobStore
+
+    store = BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr("library.utilities_api.storage.blob_store", store)
+    monkeypatch.setattr(Settings, "THUMBNAIL_FOLDER", str(tmp_path / "thumbnails"))
+
+    buffer = bytes_io.BytesIO()
+    Image.new("RGB", (300, 200), "red").save(buffer, format="PNG")
+    data = buffer.getvalue()
+    blob = store.put("cat.png", 1, hashlib.sha256(data).hexdigest(), len(data), data)
+
+    results = [{"name": "cat.png", "hash": 1, "model": "Birds", "pred": [[0.9, "cat"]]},
+               {"name": "missing.png", "hash": 2, "model": "Birds", "pred": [[0.8, "dog"]]}]
+    file_path = str(tmp_path / "export.xlsx")
+    file_exports.build_xlsx(file_path, results)
+
+    ws = load_workbook(file_path).active
+    assert [[cell.value for cell in row] for row in ws.iter_rows()] == [
+        ["Filename", "Image", "Model", "Predictions", None],
+        ["cat.png", None, "Birds", 0.9, "cat"],
+        ["missing.png", None, "Birds", 0.8, "dog"],
+    ]
+    assert len(ws._images) == 1
+    # The upload is untouched, the thumbnail is cached separately
+    with open(blob, "rb") as f:
+        assert f.read() == data
+    assert len(os.listdir(tmp_path / "thumbnails")) == 1
+
+# Test that inference is refused with a 503 when the inference queue is full
+
+
+def test_image_inference_queue_full(client):
+    from library.utilities_api.executor import inference_executor
+    inference_executor.reserve(Settings.INFERENCE_QUEUE_LIMIT)
+    try:
+        response = client.post(
+            '/api/v1/image_inference?model=Birds',
+            files=[("files", ("placeholder.png", b"placeholder", "image/png"))]
+        )
+    finally:
+        inference_executor.release(Settings.INFERENCE_QUEUE_LIMIT)
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(Settings.INFERENCE_RETRY_AFTER)
+    assert inference_executor.pending == 0
+
+# Test that uploads are hashed in one pass and spilled to disk past the memory limit
+
+
+def test_read_upload_streams_large_files(tmp_path, monkeypatch):
+    import io
+    import hashlib
+    import mmh3
+    from library.utilities_api import utilities
+
+    class Upload:
+        def __init__(self, data):
+            self.file = io.BytesIO(data)
+
+    monkeypatch.setattr(utilities.blob_store, "root", str(tmp_path))
+    monkeypatch.setattr(Settings, "UPLOAD_CHUNK_SIZE", 4)
+    monkeypatch.setattr(Settings, "UPLOAD_MEMORY_LIMIT", 8)
+
+    hash, digest, size, data, temp_path = utilities.read_upload(Upload(b"small"))
+    assert (hash, size, data, temp_path) == (mmh3.hash(b"small"), 5, b"small", None)
+    assert digest == hashlib.sha256(b"small").hexdigest()
+
+    large = b"larger than the memory limit"
+    hash, digest, size, data, temp_path = utilities.read_upload(Upload(large))
+    assert (hash, digest, size) == (mmh3.hash(large), hashlib.sha256(large).hexdigest(), len(large))
+    assert data is None
+    with open(temp_path, "rb") as f:
+        assert f.read() == large
+
+# Test that an upload served from the inference cache can still be fetched under its own name
+
+
+def test_cached_uploads_are_stored(tmp_path, monkeypatch):
+    import io
+    import hashlib
+    from library.utilities_api import utilities, storage
+    from library.utilities_api.cache import InferenceCache
+
+    class Upload:
+        def __init__(self, filename, data):
+            self.filename = filename
+            self.file = io.BytesIO(data)
+
+    store = storage.BlobStore(str(tmp_path / "blobs"))
+    monkeypatch.setattr(utilities, "blob_store", store)
+    monkeypatch.setattr(storage, "blob_store", store)
+    cache = InferenceCache(max_entries=10, max_bytes=10000, ttl=60)
+    monkeypatch.setattr(utilities, "inference_cache", cache)
+    monkeypatch.setattr(utilities, "get_model_version", lambda model: "1")
+
+    data = b"the same image"
+    cache.put(cache.key(hashlib.sha256(data).hexdigest(), "Birds", "1", 5), [[0.5, "cat"]])
+    results, uncached, _ = utilities.save_uploads(
+        [Upload("a.png", data), Upload("b.png", data)], "Birds", 5)
+
+    assert uncached == []
+    assert [result["pred"] for result in results] == [[[0.5, "cat"]], [[0.5, "cat"]]]
+    # Both names point at the one stored blob
+    assert storage.upload_path("a.png", results[0]["hash"]) == storage.upload_path("b.png", results[1]["hash"])
+    assert storage.upload_path("b.png", results[1]["hash"]) is not None
+    assert store.stats()["blobs"] == 1 and store.stats()["names"] == 2
+
+# Test that prewarming runs in the background through the scheduler, within the inference queue's limit
+
+
+def test_prewarm_cache_in_background(tmp_path, monkeypatch):
+    import asyncio
+    import hashlib
+    from library.utilities_api import utilities, executor, scheduler
+    from library.utilities_api.cache import InferenceCache
+
+    for i in range(5):
+        (tmp_path / f"img{i}.png").write_bytes(f"image {i}".encode())
+    (tmp_path / "notes.txt").write_text("not an image")
+
+    pending = []
+
+    def fake_predictions(images, model_name, top_k, version=None):
+        pending.append(executor.inference_executor.pending)
+        return [[[1.0, image.path]] for image in images]
+
+    monkeypatch.setattr(executor, "get_predictions", fake_predictions)
+    monkeypatch.setattr(utilities, "inference_scheduler", scheduler.InferenceScheduler(max_wait_ms=0))
+    cache = InferenceCache(max_entries=10, max_bytes=10000, ttl=60)
+    monkeypatch.setattr(utilities, "inference_cache", cache)
+    monkeypatch.setattr(utilities, "get_model_version", lambda model: "1")
+    monkeypatch.setattr(Settings, "INFERENCE_BATCH_SIZE", 2)
+
+    async def prewarm():
+        # Already cached images aren't predicted again
+        cache.put(cache.key(hashlib.sha256(b"image 0").hexdigest(), "Birds", "1", 5), [[1.0, "cached"]])
+        job = await utilities.start_prewarm(str(tmp_path), "Birds", 5)
+        assert job["status"] == "queued" and job["images"] == 5
+        while job["status"] in ("queued", "running"):
+            await asyncio.sleep(0.01)
+        return job
+
+    job = asyncio.run(prewarm())
+    assert utilities.prewarm_jobs[job["id"]] is job
+    assert (job["status"], job["done"], job["predicted"]) == ("done", 5, 4)
+    assert len(cache) == 5
+    # Each batch was reserved in the inference queue, and released
+    assert pending and all(1 <= count <= 2 for count in pending)
+    assert executor.inference_executor.pending == 0